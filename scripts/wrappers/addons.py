@@ -11,7 +11,13 @@ import click
 import jsonschema
 import yaml
 
-from common.utils import get_current_arch, snap_common, snap, exit_if_no_root
+from common.utils import (
+    get_current_arch,
+    snap_common,
+    snap,
+    exit_if_no_root,
+    invalidate_addons_catalog,
+)
 from common.cluster.utils import get_group
 
 GIT = os.path.expandvars("$SNAP/git.wrapper")
@@ -95,6 +101,7 @@ def validate_addons_file(repo_dir: Path) -> None:
                                 "description": {"type": "string"},
                                 "version": {"type": "string"},
                                 "check_status": {"type": "string"},
+                                "requires": {"type": "array", "items": {"type": "string"}},
                                 "supported_architectures": {
                                     "type": "array",
                                     "items": {
@@ -215,6 +222,8 @@ def add(name: str, repository: str, reference: str, force: bool):
         shutil.rmtree(repo_dir)
         sys.exit(1)
 
+    invalidate_addons_catalog()
+
 
 @repository.command("remove", help="Remove a MicroK8s addons repository")
 @click.argument("name")
@@ -226,6 +235,7 @@ def remove(name: str):
 
     click.echo("Removing {}".format(repo_dir))
     shutil.rmtree(repo_dir)
+    invalidate_addons_catalog()
 
 
 @repository.command("update", help="Update a MicroK8s addons repository")
@@ -269,6 +279,8 @@ def update(name: str, skip_check_root: bool):
     else:
         pull_and_validate(name, repo_dir)
 
+    invalidate_addons_catalog()
+
 
 class GettingGitCommitError(Exception):
     def __init__(self, exit_code, stderr):
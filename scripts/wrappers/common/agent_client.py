@@ -0,0 +1,72 @@
+import threading
+import time
+
+import requests
+import urllib3
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+AGENT_CONNECT_TIMEOUT = 5
+AGENT_TIMEOUT = (AGENT_CONNECT_TIMEOUT, 60)
+AGENT_RETRIES = 2
+AGENT_POOL_SIZE = 4
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_agent_session(node_ep):
+    """
+    Return the keep-alive session of a cluster agent. Requests to the same agent reuse
+    its pooled connections, so only the first one does a TCP and TLS handshake.
+
+    :param node_ep: the cluster agent endpoint
+    """
+    with _lock:
+        session = _sessions.get(node_ep)
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            session.mount(
+                "https://",
+                requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=AGENT_POOL_SIZE),
+            )
+            _sessions[node_ep] = session
+        return session
+
+
+def is_connect_error(e):
+    """
+    Check if a request failed before anything was sent to the agent
+
+    :param e: the requests exception
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.exceptions.ConnectionError) or not e.args:
+        return False
+    reason = getattr(e.args[0], "reason", e.args[0])
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def agent_post(node_ep, path, timeout=AGENT_TIMEOUT, retries=AGENT_RETRIES, **kwargs):
+    """
+    POST to a cluster agent. Requests that fail to connect are retried with a backoff,
+    requests that may have reached the agent, e.g. a dropped connection, are not.
+
+    :param node_ep: the cluster agent endpoint
+    :param path: the API path, e.g. cluster/api/v1.0/configure
+    :param timeout: the (connect, read) timeout, a read timeout of None waits forever
+    :param retries: how many times to retry connection errors, pass 0 for request
+                    bodies that can be read only once
+    :param kwargs: passed to requests
+    :return: the response
+    """
+    url = "https://{}/{}".format(node_ep, path)
+    for attempt in range(retries + 1):
+        try:
+            return get_agent_session(node_ep).post(url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            if attempt == retries or not is_connect_error(e):
+                raise
+            time.sleep(2**attempt)
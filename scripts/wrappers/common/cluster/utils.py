@@ -1,7 +1,6 @@
 import base64
 import datetime
 import ipaddress
-import json
 import os
 import random
 import re
@@ -48,6 +47,18 @@ def snap_data() -> Path:
         return Path("/var/snap/microk8s/current")
 
 
+def get_kine_socket(backend_dir=None):
+    """
+    Return the path of the unix socket kine serves on. kine names the socket after
+    its endpoint, so the port is part of the file name.
+
+    :param backend_dir: the dqlite backend directory, defaults to the one of this node
+    """
+    if backend_dir is None:
+        backend_dir = snap_data() / "var/kubernetes/backend"
+    return "{}/kine.sock:12379".format(backend_dir)
+
+
 def try_set_file_permissions(file):
     """
     Try setting the ownership group and permission of the file
@@ -240,19 +251,10 @@ def get_control_plane_nodes_internal_ips():
 
     :return: list of node internal IPs
     """
-    snap_path = os.environ.get("SNAP")
-    control_plane_label = "node.kubernetes.io/microk8s-controlplane=microk8s-controlplane"
-    nodes_info = subprocess.check_output(
-        "{}/microk8s-kubectl.wrapper get no -o json -l {}".format(
-            snap_path, control_plane_label
-        ).split()
-    )
-    info = json.loads(nodes_info.decode())
-    node_ips = []
-    for node_info in info["items"]:
-        node_ip = get_internal_ip_from_get_node(node_info)
-        node_ips.append(node_ip)
-    return node_ips
+    # the inventory imports this module
+    from common.inventory import get_nodes
+
+    return [node["ip"] for node in get_nodes() if node["control_plane"]]
 
 
 def get_internal_ip_from_get_node(node_info):
@@ -368,6 +370,17 @@ def is_kubelite():
     return os.path.exists(kubelite_lock)
 
 
+def service_daemon(service_name):
+    """
+    Return the snap daemon running a service. Handle case where kubelite is enabled.
+
+    :param service_name: The service name
+    """
+    if service_name in ["apiserver", "proxy", "kubelet", "scheduler", "controller-manager"]:
+        return "microk8s.daemon-kubelite"
+    return "microk8s.daemon-{}".format(service_name)
+
+
 def service(operation, service_name):
     """
     Restart a service. Handle case where kubelite is enabled.
@@ -375,12 +388,42 @@ def service(operation, service_name):
     :param service_name: The service name
     :param operation: Operation to perform on the service
     """
-    if service_name in ["apiserver", "proxy", "kubelet", "scheduler", "controller-manager"]:
-        daemon = "microk8s.daemon-kubelite"
-    else:
-        daemon = "microk8s.daemon-{}".format(service_name)
+    subprocess.check_call(["snapctl", operation, service_daemon(service_name)])
+
+
+def is_service_active(service_name):
+    """
+    Check if the daemon of a service is running
+
+    :param service_name: The service name
+    """
+    daemon = service_daemon(service_name)
+    out = subprocess.check_output(["snapctl", "services", daemon]).decode()
+    for line in out.splitlines()[1:]:
+        # Service Startup Current Notes
+        parts = line.split()
+        if len(parts) > 2 and parts[0] == daemon:
+            return parts[2] == "active"
+    return False
 
-    subprocess.check_call(["snapctl", operation, daemon])
+
+def wait_for(condition, timeout, backoff_min=0.1, backoff_max=2):
+    """
+    Wait for a condition, checking it again with an exponential backoff
+
+    :param condition: function returning True once the condition is met
+    :param timeout: the maximum time to wait in seconds
+    :return: True if the condition was met in time
+    """
+    deadline = time.time() + timeout
+    delay = backoff_min
+    while not condition():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, backoff_max)
+    return True
 
 
 def mark_no_cert_reissue():
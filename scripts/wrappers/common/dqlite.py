@@ -0,0 +1,368 @@
+import socket
+import ssl
+import struct
+
+import yaml
+
+from common.cluster.utils import snap_data
+
+PROTOCOL_VERSION = 1
+REQUEST_LEADER = 0
+REQUEST_OPEN = 3
+REQUEST_EXEC_SQL = 8
+REQUEST_QUERY_SQL = 9
+REQUEST_CLUSTER = 16
+RESPONSE_FAILURE = 0
+RESPONSE_NODE = 1
+RESPONSE_NODES = 3
+RESPONSE_DB = 4
+RESPONSE_RESULT = 6
+RESPONSE_ROWS = 7
+CLUSTER_FORMAT_V1 = 1
+DQLITE_TIMEOUT = 4
+
+# column and parameter types
+TYPE_INTEGER = 1
+TYPE_FLOAT = 2
+TYPE_TEXT = 3
+TYPE_BLOB = 4
+TYPE_NULL = 5
+TYPE_ISO8601 = 10
+TYPE_BOOLEAN = 11
+
+ROWS_DONE = 0xEEEEEEEEEEEEEEEE
+ROWS_PART = 0xFFFFFFFFFFFFFFFF
+
+ROLES = {0: "voter", 1: "standby", 2: "spare"}
+
+
+class DqliteError(Exception):
+    pass
+
+
+def backend_dir():
+    return snap_data() / "var/kubernetes/backend"
+
+
+def encode_message(mtype, body):
+    """
+    Frame a request, the header holds the body size in 8 byte words and the message type
+    """
+    return struct.pack("<IBBH", len(body) // 8, mtype, 0, 0) + body
+
+
+def encode_text(text):
+    """
+    Encode a zero terminated string padded to 8 bytes
+    """
+    data = text.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 8)
+
+
+def encode_params(params):
+    """
+    Encode the parameters of a statement, a count and a type byte for each padded
+    to 8 bytes, followed by the values
+    """
+    types = b""
+    values = b""
+    for value in params:
+        if value is None:
+            types += bytes([TYPE_NULL])
+            values += struct.pack("<Q", 0)
+        elif isinstance(value, bool):
+            types += bytes([TYPE_BOOLEAN])
+            values += struct.pack("<Q", value)
+        elif isinstance(value, int):
+            types += bytes([TYPE_INTEGER])
+            values += struct.pack("<q", value)
+        elif isinstance(value, float):
+            types += bytes([TYPE_FLOAT])
+            values += struct.pack("<d", value)
+        elif isinstance(value, str):
+            types += bytes([TYPE_TEXT])
+            values += encode_text(value)
+        else:
+            types += bytes([TYPE_BLOB])
+            values += struct.pack("<Q", len(value)) + value + b"\0" * (-len(value) % 8)
+    header = bytes([len(params)]) + types
+    return header + b"\0" * (-len(header) % 8) + values
+
+
+def decode_text(body, offset):
+    """
+    Decode a zero terminated string padded to 8 bytes
+
+    :return: (text, offset of the next field)
+    """
+    end = body.index(b"\0", offset)
+    return body[offset:end].decode(), (end + 8) // 8 * 8
+
+
+def decode_failure(body):
+    (code,) = struct.unpack_from("<Q", body)
+    message, _ = decode_text(body, 8)
+    return DqliteError("dqlite error {}: {}".format(code, message))
+
+
+def decode_node(body):
+    """
+    Decode a node response
+
+    :return: (node id, node address)
+    """
+    (node_id,) = struct.unpack_from("<Q", body)
+    address, _ = decode_text(body, 8)
+    return node_id, address
+
+
+def decode_nodes(body):
+    """
+    Decode a nodes response in the V1 format
+
+    :return: list of {"ID": ..., "Address": ..., "Role": ...} dicts, as `dqlite .cluster` prints
+    """
+    (count,) = struct.unpack_from("<Q", body)
+    offset = 8
+    nodes = []
+    for _ in range(count):
+        (node_id,) = struct.unpack_from("<Q", body, offset)
+        address, offset = decode_text(body, offset + 8)
+        (role,) = struct.unpack_from("<Q", body, offset)
+        offset += 8
+        nodes.append({"ID": node_id, "Address": address, "Role": role})
+    return nodes
+
+
+def decode_rows(body):
+    """
+    Decode a rows response
+
+    :return: (list of row tuples, True if more rows follow in another response)
+    """
+    (columns,) = struct.unpack_from("<Q", body)
+    offset = 8
+    for _ in range(columns):
+        _, offset = decode_text(body, offset)
+
+    rows = []
+    while True:
+        (marker,) = struct.unpack_from("<Q", body, offset)
+        if marker in (ROWS_DONE, ROWS_PART):
+            return rows, marker == ROWS_PART
+        # a 4 bit type for each column, padded to 8 bytes
+        header = body[offset : offset + (columns + 1) // 2]
+        offset += -(-columns // 16) * 8
+        row = []
+        for i in range(columns):
+            ctype = (header[i // 2] >> (4 * (i % 2))) & 0x0F
+            if ctype == TYPE_INTEGER:
+                (value,) = struct.unpack_from("<q", body, offset)
+                offset += 8
+            elif ctype == TYPE_FLOAT:
+                (value,) = struct.unpack_from("<d", body, offset)
+                offset += 8
+            elif ctype in (TYPE_TEXT, TYPE_ISO8601):
+                value, offset = decode_text(body, offset)
+            elif ctype == TYPE_BLOB:
+                (size,) = struct.unpack_from("<Q", body, offset)
+                value = body[offset + 8 : offset + 8 + size]
+                offset += 8 + -(-size // 8) * 8
+            elif ctype == TYPE_NULL:
+                value = None
+                offset += 8
+            elif ctype == TYPE_BOOLEAN:
+                (value,) = struct.unpack_from("<Q", body, offset)
+                value = bool(value)
+                offset += 8
+            else:
+                raise DqliteError("unsupported column type {}".format(ctype))
+            row.append(value)
+        rows.append(tuple(row))
+
+
+def split_address(address):
+    host, port = address.rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+class DqliteClient:
+    """
+    Minimal client of the dqlite wire protocol, enough to query the cluster membership.
+    It authenticates with the cluster certificate of the backend directory, which is
+    shared by all the members.
+    """
+
+    def __init__(self, cluster_dir=None, timeout=DQLITE_TIMEOUT):
+        self.cluster_dir = cluster_dir or backend_dir()
+        self.timeout = timeout
+
+    def tls_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # members are identified by the shared cluster certificate, not by name
+        context.check_hostname = False
+        context.load_verify_locations("{}/cluster.crt".format(self.cluster_dir))
+        context.load_cert_chain(
+            "{}/cluster.crt".format(self.cluster_dir), "{}/cluster.key".format(self.cluster_dir)
+        )
+        return context
+
+    def addresses(self):
+        """
+        Return the addresses to contact, the local node first
+        """
+        addresses = []
+        for name in ("info.yaml", "cluster.yaml"):
+            try:
+                with open("{}/{}".format(self.cluster_dir, name)) as f:
+                    data = yaml.safe_load(f)
+            except (OSError, yaml.YAMLError):
+                continue
+            entries = data if isinstance(data, list) else [data]
+            for entry in entries:
+                if isinstance(entry, dict) and entry.get("Address") not in (None, *addresses):
+                    addresses.append(entry["Address"])
+        return addresses
+
+    def connect(self, address):
+        sock = socket.create_connection(split_address(address), timeout=self.timeout)
+        try:
+            sock = self.tls_context().wrap_socket(sock)
+            sock.sendall(struct.pack("<Q", PROTOCOL_VERSION))
+        except (OSError, ssl.SSLError):
+            sock.close()
+            raise
+        return sock
+
+    def query(self, sock):
+        """
+        Ask a node for the leader and the cluster members. Both requests are sent at
+        once, so this takes a single round trip.
+
+        :return: (leader address, members), members is None if the node cannot tell
+        """
+        sock.sendall(
+            encode_message(REQUEST_LEADER, struct.pack("<Q", 0))
+            + encode_message(REQUEST_CLUSTER, struct.pack("<Q", CLUSTER_FORMAT_V1))
+        )
+
+        mtype, body = read_message(sock)
+        if mtype == RESPONSE_FAILURE:
+            raise decode_failure(body)
+        if mtype != RESPONSE_NODE:
+            raise DqliteError("unexpected response {} to the leader request".format(mtype))
+        _, leader = decode_node(body)
+
+        mtype, body = read_message(sock)
+        if mtype == RESPONSE_FAILURE:
+            return leader, None
+        if mtype != RESPONSE_NODES:
+            raise DqliteError("unexpected response {} to the cluster request".format(mtype))
+        return leader, decode_nodes(body)
+
+    def request(self, sock, mtype, body, expected):
+        """
+        Send a request and read its response
+
+        :param expected: the expected response type
+        :return: the response body
+        """
+        sock.sendall(encode_message(mtype, body))
+        rtype, body = read_message(sock)
+        if rtype == RESPONSE_FAILURE:
+            raise decode_failure(body)
+        if rtype != expected:
+            raise DqliteError("unexpected response {} to request {}".format(rtype, mtype))
+        return body
+
+    def leader(self, sock):
+        """
+        Ask a node for the leader address, the cheapest request there is
+        """
+        body = self.request(sock, REQUEST_LEADER, struct.pack("<Q", 0), RESPONSE_NODE)
+        return decode_node(body)[1]
+
+    def open_database(self, sock, name):
+        """
+        Open a database on the leader
+
+        :return: the database id to run statements against
+        """
+        # an empty VFS name picks the default one of the node
+        body = encode_text(name) + struct.pack("<Q", 0) + encode_text("")
+        body = self.request(sock, REQUEST_OPEN, body, RESPONSE_DB)
+        (db_id,) = struct.unpack_from("<I", body)
+        return db_id
+
+    def exec_sql(self, sock, db_id, sql, params=()):
+        """
+        Run a statement on the leader, it returns once the change is committed
+
+        :return: (last insert id, rows affected)
+        """
+        body = struct.pack("<Q", db_id) + encode_text(sql) + encode_params(params)
+        body = self.request(sock, REQUEST_EXEC_SQL, body, RESPONSE_RESULT)
+        return struct.unpack_from("<QQ", body)
+
+    def query_sql(self, sock, db_id, sql, params=()):
+        """
+        Run a query on the leader
+
+        :return: list of row tuples
+        """
+        body = struct.pack("<Q", db_id) + encode_text(sql) + encode_params(params)
+        rows, more = decode_rows(self.request(sock, REQUEST_QUERY_SQL, body, RESPONSE_ROWS))
+        while more:
+            rtype, body = read_message(sock)
+            if rtype == RESPONSE_FAILURE:
+                raise decode_failure(body)
+            part, more = decode_rows(body)
+            rows.extend(part)
+        return rows
+
+    def cluster(self):
+        """
+        Return the leader and the members of the dqlite cluster, asking the leader for
+        the members if the node contacted first cannot tell.
+
+        :return: (leader address, list of {"ID": ..., "Address": ..., "Role": ...} dicts)
+        """
+        errors = []
+        for address in self.addresses():
+            try:
+                with self.connect(address) as sock:
+                    leader, members = self.query(sock)
+                if members is None and leader and leader != address:
+                    with self.connect(leader) as sock:
+                        leader, members = self.query(sock)
+                if members is not None:
+                    return leader, members
+                errors.append("{}: no cluster information".format(address))
+            except (OSError, ssl.SSLError, DqliteError, struct.error, ValueError) as e:
+                errors.append("{}: {}".format(address, e))
+        raise DqliteError("cannot reach the dqlite cluster ({})".format("; ".join(errors)))
+
+
+def read_message(sock):
+    header = recv_exactly(sock, 8)
+    words, mtype, _, _ = struct.unpack("<IBBH", header)
+    return mtype, recv_exactly(sock, words * 8)
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise DqliteError("connection closed by the dqlite node")
+        data += chunk
+    return data
+
+
+def get_dqlite_cluster(timeout=DQLITE_TIMEOUT):
+    """
+    Return the leader and the members of the dqlite cluster of this node
+
+    :return: (leader address, list of {"ID": ..., "Address": ..., "Role": ...} dicts)
+    """
+    return DqliteClient(timeout=timeout).cluster()
@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+BUNDLE_INDEX = "bundle.json"
+BUNDLE_VERSION = 1
+BLOCK_SIZE = tarfile.BLOCKSIZE
+CHUNK_SIZE = 1024 * 1024
+
+
+class BundleError(Exception):
+    pass
+
+
+def blob_digest(name):
+    """
+    Return the digest of an OCI archive member, None if it is not a blob
+
+    :param name: the archive member name, e.g. blobs/sha256/<hex>
+    """
+    parts = os.path.normpath(name).split("/")
+    if len(parts) == 3 and parts[0] == "blobs":
+        return "{}:{}".format(parts[1], parts[2])
+    return None
+
+
+def _padded(size):
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def _layout(index, sizes):
+    """
+    Set the offset of every member of a bundle, given the stored size of each. All
+    members are plain USTAR entries with short names, so each has a single header block.
+    """
+    while True:
+        data = json.dumps(index, sort_keys=True).encode()
+        offset = BLOCK_SIZE + _padded(len(data))
+        for section, key in sizes:
+            index[section][key]["offset"] = offset + BLOCK_SIZE
+            offset += BLOCK_SIZE + _padded(index[section][key]["size"])
+        if json.dumps(index, sort_keys=True).encode() == data:
+            return data
+
+
+class _Section:
+    """
+    Read-only view of a byte range of a file.
+    """
+
+    def __init__(self, fin, offset, size):
+        self.fin = fin
+        self.offset = offset
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        self.fin.seek(self.offset)
+        data = self.fin.read(size)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+
+def write_bundle(archive, fout, base=None):
+    """
+    Write an image bundle from an OCI image archive. The bundle is a tar file that starts
+    with an index of its members and their offsets, followed by the archive metadata and
+    every blob once by digest, gzip compressed unless that does not make it smaller.
+
+    :param archive: path to the OCI image archive, as written by `ctr image export`
+    :param fout: binary file object to write the bundle to
+    :param base: index of an earlier bundle, its blobs are left out of a delta bundle
+    :return: the bundle index
+    """
+    base_blobs = set()
+    if base is not None:
+        base_blobs = set(base["blobs"]) | set(base["base_blobs"])
+
+    index = {
+        "version": BUNDLE_VERSION,
+        "base": base["id"] if base is not None else None,
+        "base_blobs": sorted(base_blobs),
+        "files": {},
+        "blobs": {},
+    }
+    contents = {}
+    with (
+        tempfile.TemporaryDirectory(prefix="microk8s-bundle-") as spool,
+        tarfile.open(archive) as src,
+    ):
+        for member in src:
+            if not member.isfile():
+                continue
+            digest = blob_digest(member.name)
+            if digest is None:
+                index["files"][member.name] = {"size": member.size}
+                contents[("files", member.name)] = src.extractfile(member).read()
+                continue
+            if digest in base_blobs or digest in index["blobs"]:
+                continue
+
+            path = os.path.join(spool, str(len(contents)))
+            with src.extractfile(member) as fin, gzip.open(path, "wb") as compressed:
+                shutil.copyfileobj(fin, compressed, CHUNK_SIZE)
+            entry = {"length": member.size, "compression": "gzip"}
+            if os.path.getsize(path) >= member.size:
+                with src.extractfile(member) as fin, open(path, "wb") as stored:
+                    shutil.copyfileobj(fin, stored, CHUNK_SIZE)
+                entry["compression"] = "none"
+            entry["size"] = os.path.getsize(path)
+            index["blobs"][digest] = entry
+            contents[("blobs", digest)] = path
+
+        ids = hashlib.sha256()
+        for name in sorted(index["files"]):
+            ids.update(contents[("files", name)])
+        ids.update(json.dumps(sorted(index["blobs"])).encode())
+        index["id"] = "sha256:{}".format(ids.hexdigest())
+
+        data = _layout(index, list(contents))
+        with tarfile.open(fileobj=fout, mode="w|", format=tarfile.USTAR_FORMAT) as dst:
+            info = tarfile.TarInfo(BUNDLE_INDEX)
+            info.size = len(data)
+            dst.addfile(info, io.BytesIO(data))
+            for section, key in contents:
+                name = key if section == "files" else "blobs/{}".format(key.replace(":", "/"))
+                info = tarfile.TarInfo(name)
+                info.size = index[section][key]["size"]
+                if section == "files":
+                    dst.addfile(info, io.BytesIO(contents[(section, key)]))
+                else:
+                    with open(contents[(section, key)], "rb") as fin:
+                        dst.addfile(info, fin)
+    return index
+
+
+def read_bundle_index(path):
+    """
+    Read the index of an image bundle
+
+    :param path: path to the bundle
+    :return: the bundle index, None if the file is not a bundle
+    """
+    try:
+        with tarfile.open(path, mode="r|") as tar:
+            member = tar.next()
+            if member is None or member.name != BUNDLE_INDEX:
+                return None
+            index = json.load(tar.extractfile(member))
+    except (OSError, tarfile.TarError, ValueError):
+        return None
+
+    if not isinstance(index, dict) or index.get("version") != BUNDLE_VERSION:
+        raise BundleError("Unsupported image bundle format in {}".format(path))
+    return index
+
+
+def open_blob(fin, index, digest):
+    """
+    Open a blob of a bundle for reading, without reading any of the other members
+
+    :param fin: the bundle, opened as a seekable binary file
+    :param index: the bundle index
+    :param digest: the blob digest
+    :return: a binary file object with the uncompressed blob
+    """
+    entry = index["blobs"][digest]
+    section = _Section(fin, entry["offset"], entry["size"])
+    if entry["compression"] == "gzip":
+        return gzip.GzipFile(fileobj=section, mode="rb")
+    return section
+
+
+def write_oci_archive(path, index, fout):
+    """
+    Write the OCI image archive stored in a bundle. The archive of a delta bundle
+    lacks the blobs of its base, which the nodes are expected to have already.
+
+    :param path: path to the bundle
+    :param index: the bundle index
+    :param fout: binary file object to write the archive to
+    """
+    with open(path, "rb") as fin, tarfile.open(fileobj=fout, mode="w|") as dst:
+        for name, entry in sorted(index["files"].items()):
+            info = tarfile.TarInfo(name)
+            info.size = entry["size"]
+            dst.addfile(info, _Section(fin, entry["offset"], entry["size"]))
+        for digest, entry in sorted(index["blobs"].items()):
+            info = tarfile.TarInfo("blobs/{}".format(digest.replace(":", "/")))
+            info.size = entry["length"]
+            dst.addfile(info, open_blob(fin, index, digest))
@@ -0,0 +1,120 @@
+import json
+import time
+
+from common.cluster.utils import get_internal_ip_from_get_node, snap_data
+from common.dqlite import get_dqlite_cluster
+from common.kubeclient import get_kube_client
+from common.utils import write_json_atomically
+
+INVENTORY_VERSION = 1
+INVENTORY_TTL = 30
+CLUSTER_AGENT_PORT = 25000
+CONTROL_PLANE_LABEL = "node.kubernetes.io/microk8s-controlplane"
+CONTROL_PLANE_VALUE = "microk8s-controlplane"
+
+
+def inventory_file():
+    return snap_data() / "var/cache/cluster-inventory.json"
+
+
+def invalidate_inventory():
+    """
+    Drop the cluster inventory. It is fetched again on the next lookup. Call this
+    whenever the node joins or leaves a cluster or a node is removed.
+    """
+    try:
+        inventory_file().unlink()
+    except OSError:
+        pass
+
+
+def load_inventory():
+    try:
+        with open(inventory_file(), "r") as fin:
+            inventory = json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(inventory, dict) or inventory.get("version") != INVENTORY_VERSION:
+        return {}
+    return inventory
+
+
+def save_inventory(inventory):
+    """
+    Store the cluster inventory. Failing to store it is not an error, as for the
+    addons catalog.
+    """
+    try:
+        write_json_atomically(inventory_file(), inventory)
+    except OSError:
+        pass
+
+
+def fetch_nodes():
+    """
+    List the Kubernetes nodes with their internal IP, whether they run the control plane
+    and their cluster agent endpoint.
+    """
+    nodes = []
+    for node in get_kube_client().list("nodes"):
+        labels = node["metadata"].get("labels") or {}
+        ip = get_internal_ip_from_get_node(node)
+        nodes.append(
+            {
+                "name": node["metadata"]["name"],
+                "ip": ip,
+                "control_plane": labels.get(CONTROL_PLANE_LABEL) == CONTROL_PLANE_VALUE,
+                "agent_endpoint": "{}:{}".format(ip, CLUSTER_AGENT_PORT),
+            }
+        )
+    return nodes
+
+
+def fetch_dqlite_members():
+    """
+    List the members of the dqlite cluster with their address and role.
+    """
+    _, members = get_dqlite_cluster()
+    return [{"address": ep["Address"], "role": ep["Role"]} for ep in members]
+
+
+def get_inventory_section(section, fetch, refresh=False):
+    """
+    Return a section of the cluster inventory shared by all commands. The section is
+    fetched again once it is older than INVENTORY_TTL seconds.
+
+    :param section: the inventory section
+    :param fetch: function returning the section contents
+    :param refresh: fetch the section even if the stored one is recent
+    """
+    inventory = load_inventory()
+    entry = inventory.get(section)
+    if not refresh and entry is not None and 0 <= time.time() - entry["time"] < INVENTORY_TTL:
+        return entry["items"]
+
+    items = fetch()
+    # reload, another command may have stored other sections in the meantime
+    inventory = load_inventory()
+    inventory["version"] = INVENTORY_VERSION
+    inventory[section] = {"time": time.time(), "items": items}
+    save_inventory(inventory)
+    return items
+
+
+def get_nodes(refresh=False):
+    """
+    Return the cluster nodes
+
+    :return: list of {"name": ..., "ip": ..., "control_plane": ..., "agent_endpoint": ...} dicts
+    """
+    return get_inventory_section("nodes", fetch_nodes, refresh)
+
+
+def get_dqlite_members(refresh=False):
+    """
+    Return the dqlite cluster members
+
+    :return: list of {"address": "ip:port", "role": ...} dicts, role 0 is a voter
+    """
+    return get_inventory_section("dqlite", fetch_dqlite_members, refresh)
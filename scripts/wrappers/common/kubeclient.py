@@ -0,0 +1,284 @@
+import atexit
+import base64
+import json
+import os
+import tempfile
+from urllib.parse import quote
+
+import requests
+import yaml
+
+from common.cluster.utils import snap_data
+
+DEFAULT_TIMEOUT = (5, 30)
+
+# API group prefix of the resources the wrappers work with
+API_PATHS = {
+    "configmaps": "api/v1",
+    "endpoints": "api/v1",
+    "namespaces": "api/v1",
+    "nodes": "api/v1",
+    "pods": "api/v1",
+    "secrets": "api/v1",
+    "services": "api/v1",
+    "daemonsets": "apis/apps/v1",
+    "deployments": "apis/apps/v1",
+    "replicasets": "apis/apps/v1",
+    "statefulsets": "apis/apps/v1",
+    "customresourcedefinitions": "apis/apiextensions.k8s.io/v1",
+    "ingressclasses": "apis/networking.k8s.io/v1",
+    "ingresses": "apis/networking.k8s.io/v1",
+    "clusterroles": "apis/rbac.authorization.k8s.io/v1",
+    "priorityclasses": "apis/scheduling.k8s.io/v1",
+    "storageclasses": "apis/storage.k8s.io/v1",
+}
+
+# resources of the kinds printed by "kubectl get -o name", e.g. "deployment.apps/coredns"
+KIND_RESOURCES = {
+    "pod": "pods",
+    "service": "services",
+    "daemonset.apps": "daemonsets",
+    "deployment.apps": "deployments",
+    "replicaset.apps": "replicasets",
+    "statefulset.apps": "statefulsets",
+    "ingress.networking.k8s.io": "ingresses",
+    "ingressclass.networking.k8s.io": "ingressclasses",
+    "clusterrole.rbac.authorization.k8s.io": "clusterroles",
+}
+
+
+class KubeApiError(Exception):
+    """
+    Raised when the API server cannot be reached or rejects a request.
+    status_code is None if no response was received.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def resource_path(resource, namespace=None, name=None):
+    """
+    Return the API path of a resource collection or object
+
+    :param resource: the plural resource name, e.g. "nodes"
+    :param namespace: the namespace of namespaced resources
+    :param name: the object name, None for the whole collection
+    :return: the API path
+    """
+    try:
+        path = API_PATHS[resource]
+    except KeyError:
+        raise ValueError("Unknown resource {}".format(resource))
+
+    if namespace:
+        path = "{}/namespaces/{}".format(path, quote(namespace))
+    path = "{}/{}".format(path, resource)
+    if name:
+        path = "{}/{}".format(path, quote(name))
+    return path
+
+
+class KubeClient:
+    """
+    A minimal Kubernetes API client that keeps a pooled keep-alive session to the
+    API server, so many calls can be issued without spawning kubectl.
+    """
+
+    def __init__(self, server, ca=None, cert=None, token=None, auth=None):
+        """
+        :param server: the API server URL
+        :param ca: path to the CA bundle used to verify the API server
+        :param cert: (certificate, key) paths of the client certificate
+        :param token: bearer token
+        :param auth: (username, password) for basic authentication
+        """
+        self.server = server.rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10)
+        self.session.mount("https://", adapter)
+        self.session.verify = ca if ca else True
+        if cert:
+            self.session.cert = cert
+        if token:
+            self.session.headers["Authorization"] = "Bearer {}".format(token)
+        if auth:
+            self.session.auth = auth
+
+    @classmethod
+    def from_kubeconfig(cls, kubeconfig=None):
+        """
+        Create a client from the current context of a kubeconfig file
+
+        :param kubeconfig: path to the kubeconfig, defaults to the MicroK8s admin client config
+        :return: the client
+        """
+        if not kubeconfig:
+            kubeconfig = snap_data() / "credentials" / "client.config"
+
+        try:
+            with open(kubeconfig) as f:
+                config = yaml.safe_load(f)
+
+            context = named(config["contexts"], config["current-context"])["context"]
+            cluster = named(config["clusters"], context["cluster"])["cluster"]
+            user = named(config["users"], context["user"])["user"]
+        except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+            raise KubeApiError("Failed to load kubeconfig {}: {}".format(kubeconfig, e))
+
+        ca = file_or_data(cluster, "certificate-authority")
+        cert = None
+        client_cert = file_or_data(user, "client-certificate")
+        if client_cert:
+            cert = (client_cert, file_or_data(user, "client-key"))
+        auth = None
+        if "username" in user:
+            auth = (user["username"], user.get("password", ""))
+
+        return cls(cluster["server"], ca=ca, cert=cert, token=user.get("token"), auth=auth)
+
+    def request(self, method, path, params=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+        """
+        Issue a request against the API server
+
+        :param method: the HTTP method
+        :param path: the API path, e.g. "api/v1/nodes" or "readyz"
+        :param params: query parameters
+        :param timeout: (connect, read) timeout in seconds
+        :return: the response
+        """
+        url = "{}/{}".format(self.server, path.lstrip("/"))
+        try:
+            res = self.session.request(method, url, params=params, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise KubeApiError("Failed to reach the API server: {}".format(e))
+
+        if res.status_code >= 400:
+            message = res.reason
+            try:
+                message = res.json()["message"]
+            except (ValueError, KeyError, TypeError):
+                pass
+            res.close()
+            raise KubeApiError(message, status_code=res.status_code)
+
+        return res
+
+    def get(self, resource, name, namespace=None):
+        """
+        Get a single object
+
+        :return: the object
+        """
+        return self.request("GET", resource_path(resource, namespace, name)).json()
+
+    def list(self, resource, namespace=None, label_selector=None, field_selector=None):
+        """
+        List objects, across all namespaces if no namespace is given
+
+        :return: the list of objects
+        """
+        params = selectors(label_selector, field_selector)
+        return self.request("GET", resource_path(resource, namespace), params=params).json()[
+            "items"
+        ]
+
+    def delete(self, resource, name, namespace=None, missing_ok=False):
+        """
+        Delete a single object
+
+        :param missing_ok: do not raise if the object does not exist
+        """
+        try:
+            self.request("DELETE", resource_path(resource, namespace, name))
+        except KubeApiError as e:
+            if not missing_ok or e.status_code != 404:
+                raise
+
+    def watch(
+        self,
+        resource,
+        namespace=None,
+        label_selector=None,
+        field_selector=None,
+        resource_version=None,
+        timeout=None,
+    ):
+        """
+        Watch objects for changes
+
+        :param resource_version: start watching after this resource version
+        :param timeout: ask the API server to close the watch after this many seconds
+        :return: a generator of (event type, object) tuples
+        """
+        params = selectors(label_selector, field_selector)
+        params["watch"] = "true"
+        params["allowWatchBookmarks"] = "true"
+        if resource_version:
+            params["resourceVersion"] = resource_version
+        if timeout:
+            params["timeoutSeconds"] = max(1, int(timeout))
+
+        res = self.request(
+            "GET",
+            resource_path(resource, namespace),
+            params=params,
+            timeout=(DEFAULT_TIMEOUT[0], timeout + DEFAULT_TIMEOUT[0] if timeout else None),
+            stream=True,
+        )
+        with res:
+            try:
+                for line in res.iter_lines():
+                    if line:
+                        event = json.loads(line)
+                        yield event["type"], event["object"]
+            except requests.exceptions.RequestException as e:
+                raise KubeApiError("Watch on {} interrupted: {}".format(resource, e))
+
+
+def named(entries, name):
+    for entry in entries:
+        if entry["name"] == name:
+            return entry
+    raise KeyError(name)
+
+
+def selectors(label_selector=None, field_selector=None):
+    params = {}
+    if label_selector:
+        params["labelSelector"] = label_selector
+    if field_selector:
+        params["fieldSelector"] = field_selector
+    return params
+
+
+def file_or_data(config, key):
+    """
+    Return the path of a file referenced by a kubeconfig entry. Inline "<key>-data"
+    values are written to a temporary file removed when the process exits.
+    """
+    if config.get(key):
+        return os.path.expandvars(config[key])
+    data = config.get("{}-data".format(key))
+    if not data:
+        return None
+
+    fd, path = tempfile.mkstemp(prefix="microk8s-", suffix=".pem")
+    with os.fdopen(fd, "wb") as f:
+        f.write(base64.b64decode(data))
+    atexit.register(os.remove, path)
+    return path
+
+
+_client = None
+
+
+def get_kube_client():
+    """
+    Return the shared client for the local MicroK8s API server
+    """
+    global _client
+    if _client is None:
+        _client = KubeClient.from_kubeconfig()
+    return _client
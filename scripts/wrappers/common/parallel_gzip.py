@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_CHUNK_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL = 6
+
+
+def default_threads():
+    return min(os.cpu_count() or 1, 8)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write-only file object that gzip compresses on several cores. The data is cut in
+    chunks compressed concurrently into separate gzip members, which are written in
+    order. Concatenated members are a valid gzip file for gunzip, tar and Python.
+    zlib releases the GIL while compressing, so threads are enough.
+    """
+
+    def __init__(self, fout, threads=None, level=GZIP_LEVEL, chunk_size=GZIP_CHUNK_SIZE):
+        """
+        :param fout: binary file object to write the compressed stream to
+        :param threads: the number of compression threads, defaults to the cores available
+        :param level: the gzip compression level
+        :param chunk_size: the amount of data compressed into each gzip member
+        """
+        super().__init__()
+        self.fout = fout
+        self.threads = threads or default_threads()
+        self.level = level
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._submit(bytes(self.buffer[: self.chunk_size]))
+            del self.buffer[: self.chunk_size]
+        return len(data)
+
+    def _submit(self, chunk):
+        # bound the memory held by chunks in flight
+        while len(self.pending) >= 2 * self.threads:
+            self._write_member(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(gzip.compress, chunk, self.level, mtime=0))
+
+    def _write_member(self, member):
+        self.fout.write(member)
+        self.sha256.update(member)
+        self.size += len(member)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.size and not self.pending:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_member(self.pending.popleft().result())
+            self.fout.flush()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            super().close()
+
+    def hexdigest(self):
+        """
+        Return the sha256 of the compressed stream written so far
+        """
+        return self.sha256.hexdigest()
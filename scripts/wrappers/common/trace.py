@@ -0,0 +1,87 @@
+import contextlib
+import functools
+import json
+import os
+import socket
+import threading
+import time
+
+from common.cluster.utils import snap_data
+
+_lock = threading.Lock()
+
+
+def is_tracing():
+    """
+    Tracing is enabled with MICROK8S_TRACE=1 and is inherited by the addon hooks
+    and any microk8s commands they run.
+    """
+    return os.environ.get("MICROK8S_TRACE") == "1"
+
+
+def enable_tracing():
+    os.environ["MICROK8S_TRACE"] = "1"
+
+
+def trace_file():
+    return snap_data() / "var/log/microk8s-trace.jsonl"
+
+
+def write_event(event):
+    """
+    Append an event to the trace file. Each line is an event in the Chrome trace
+    event format, so `jq -s . microk8s-trace.jsonl` can be loaded in chrome://tracing
+    or Perfetto. Tracing never fails the traced operation.
+    """
+    try:
+        with _lock, open(trace_file(), "a") as f:
+            f.write(json.dumps(event) + "\n")
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Record the duration of the enclosed block as a span.
+
+    :param name: the span name
+    :param args: extra details to record with the span
+    """
+    if not is_tracing():
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        write_event(
+            {
+                "name": name,
+                "cat": "microk8s",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int((end - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {"host": socket.gethostname(), **args},
+            }
+        )
+
+
+def traced(name):
+    """
+    Decorator recording every call of the function as a span.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **{k: str(v) for k, v in kwargs.items()}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,8 +1,11 @@
+import bisect
+import concurrent.futures
 import fcntl
 import getpass
 import json
 import os
 import platform
+import socket
 import subprocess
 import sys
 import time
@@ -13,13 +16,23 @@ import click
 import yaml
 
 from common.cluster.utils import (
+    get_arg,
     try_set_file_permissions,
     is_strict,
 )
+from common.dqlite import ROLES, DqliteError, get_dqlite_cluster
+from common.kubeclient import KubeApiError, get_kube_client
+from common.trace import span, traced
 
 LOG = logging.getLogger(__name__)
 
 KUBECTL = os.path.expandvars("$SNAP/microk8s-kubectl.wrapper")
+ADDONS_CATALOG_VERSION = 1
+READY_PROBE_TIMEOUT = (2, 5)
+READY_WATCH_TIMEOUT = 30
+READY_BACKOFF_MIN = 0.25
+READY_BACKOFF_MAX = 2
+MAX_PARALLEL_ADDONS = 4
 
 
 def get_current_arch():
@@ -79,11 +92,47 @@ def run(*args, die=True):
     return result.stdout.decode("utf-8")
 
 
+def get_node_name():
+    """
+    Return the name of the local node, as registered by the kubelet
+    """
+    try:
+        hostname_override = get_arg("--hostname-override", "kubelet")
+    except OSError:
+        hostname_override = None
+    if hostname_override:
+        return hostname_override.strip().strip("\"'")
+    return socket.gethostname().lower()
+
+
+def is_node_ready(node):
+    for condition in node["status"].get("conditions") or []:
+        if condition["type"] == "Ready":
+            return condition["status"] == "True"
+    return False
+
+
 def is_cluster_ready(with_ready_node=True):
+    """
+    Check if the API server reports ready and, optionally, if the local node is Ready.
+    Only /readyz and the local node are queried, so this is cheap on loaded clusters.
+
+    :param with_ready_node: also require the local node to be Ready
+    :return: True if the cluster is ready
+    """
     try:
-        return "service/kubernetes" in kubectl_get("all") and (
-            not with_ready_node or " Ready " in kubectl_get("nodes")
-        )
+        client = get_kube_client()
+        client.request("GET", "readyz", timeout=READY_PROBE_TIMEOUT)
+        if not with_ready_node:
+            return True
+
+        try:
+            return is_node_ready(client.get("nodes", get_node_name()))
+        except KubeApiError as e:
+            if e.status_code != 404:
+                raise
+        # the node is registered under another name, any Ready node will do
+        return any(is_node_ready(node) for node in client.list("nodes"))
     except Exception:
         return False
 
@@ -95,7 +144,6 @@ def is_ha_enabled():
 
 def get_dqlite_info():
     cluster_dir = os.path.expandvars("${SNAP_DATA}/var/kubernetes/backend")
-    snap_path = os.environ.get("SNAP")
 
     info = []
 
@@ -107,34 +155,21 @@ def get_dqlite_info():
         try:
             with open("{}/info.yaml".format(cluster_dir), mode="r") as f:
                 data = yaml.safe_load(f)
-                out = subprocess.check_output(
-                    "{snappath}/bin/dqlite -s file://{dbdir}/cluster.yaml -c {dbdir}/cluster.crt "
-                    "-k {dbdir}/cluster.key -f json k8s .cluster".format(
-                        snappath=snap_path, dbdir=cluster_dir
-                    ).split(),
-                    timeout=4,
-                    stderr=subprocess.DEVNULL,
-                )
-                if data["Address"] in out.decode():
-                    break
-                else:
-                    time.sleep(5)
-                    waits -= 1
-        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-            time.sleep(2)
+            _, nodes = get_dqlite_cluster()
+            if any(n["Address"] == data["Address"] for n in nodes):
+                break
+            time.sleep(1)
+            waits -= 1
+        except (OSError, DqliteError):
+            time.sleep(1)
             waits -= 1
 
     if waits == 0:
         return info
 
-    nodes = json.loads(out.decode())
     for n in nodes:
-        if n["Role"] == 0:
-            info.append((n["Address"], "voter"))
-        if n["Role"] == 1:
-            info.append((n["Address"], "standby"))
-        if n["Role"] == 2:
-            info.append((n["Address"], "spare"))
+        if n["Role"] in ROLES:
+            info.append((n["Address"], ROLES[n["Role"]]))
     return info
 
 
@@ -185,17 +220,66 @@ def is_cluster_locked():
         sys.exit(1)
 
 
+def wait_for_ready_event(timeout, with_ready_node=True):
+    """
+    Block on a watch until the local node reports Ready or, when the node is not
+    considered, until the kubernetes service is present.
+
+    :param timeout: the maximum time to wait in seconds
+    :param with_ready_node: watch the local node rather than the kubernetes service
+    :return: True if a relevant event was observed, False if the watch expired
+    :raises KubeApiError: if the watch cannot be established
+    """
+    client = get_kube_client()
+    if with_ready_node:
+        selector = "metadata.name={}".format(get_node_name())
+        for event_type, obj in client.watch("nodes", field_selector=selector, timeout=timeout):
+            if event_type in ("ADDED", "MODIFIED") and is_node_ready(obj):
+                return True
+    else:
+        selector = "metadata.name=kubernetes"
+        events = client.watch("services", "default", field_selector=selector, timeout=timeout)
+        for event_type, _ in events:
+            if event_type in ("ADDED", "MODIFIED"):
+                return True
+    return False
+
+
+@traced("wait_for_ready")
 def wait_for_ready(timeout, with_ready_node=True):
-    start_time = time.time()
-    end_time = start_time + timeout
+    """
+    Wait for the cluster to become ready. Changes are picked up through a watch on
+    the local node (or the kubernetes service), falling back to probing /readyz
+    with a short backoff while the API server cannot serve watches.
+
+    :param timeout: the maximum time to wait in seconds, 0 to wait forever
+    :param with_ready_node: also wait for the local node to be Ready
+    :return: True if the cluster is ready
+    """
+    end_time = time.time() + timeout
+    delay = READY_BACKOFF_MIN
 
     while True:
         if is_cluster_ready(with_ready_node=with_ready_node):
             return True
-        elif timeout and time.time() > end_time:
+
+        remaining = end_time - time.time() if timeout else READY_WATCH_TIMEOUT
+        if remaining <= 0:
             return False
+
+        try:
+            if wait_for_ready_event(min(remaining, READY_WATCH_TIMEOUT), with_ready_node):
+                if is_cluster_ready(with_ready_node=with_ready_node):
+                    return True
+        except KubeApiError:
+            pass
+
+        # the API server cannot serve watches yet or it is still not ready, back off
+        if timeout:
+            time.sleep(max(0, min(delay, end_time - time.time())))
         else:
-            time.sleep(2)
+            time.sleep(delay)
+        delay = min(delay * 2, READY_BACKOFF_MAX)
 
 
 def exit_if_no_root():
@@ -250,15 +334,153 @@ def kubectl_get(cmd, namespace="--all-namespaces"):
         return run(KUBECTL, "get", cmd, "-n", namespace, die=False)
 
 
-def kubectl_get_clusterroles():
-    return run(
-        KUBECTL,
-        "get",
-        "clusterroles",
-        "--show-kind",
-        "--no-headers",
-        die=False,
-    )
+def kubectl_get_names(cmd):
+    return run(KUBECTL, "get", cmd, "--all-namespaces", "-o", "name", die=False)
+
+
+def addons_catalog_file() -> Path:
+    return snap_data() / "var/cache/addons-catalog.json"
+
+
+def invalidate_addons_catalog():
+    """
+    Drop the compiled addons catalog. It is rebuilt on the next lookup.
+    """
+    try:
+        addons_catalog_file().unlink()
+    except OSError:
+        pass
+
+
+def new_addons_catalog(arch):
+    return {
+        "version": ADDONS_CATALOG_VERSION,
+        "snap": str(snap()),
+        "arch": arch,
+        "strict": is_strict(),
+        "repositories": {},
+        "community": None,
+    }
+
+
+def load_addons_catalog(arch):
+    """
+    Load the compiled addons catalog.
+
+    :param arch: architecture the catalog was compiled for
+    :return: the catalog, or None if it is missing or was compiled for another snap revision
+    """
+    try:
+        with open(addons_catalog_file(), "r") as fin:
+            catalog = json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        not isinstance(catalog, dict)
+        or catalog.get("version") != ADDONS_CATALOG_VERSION
+        or catalog.get("snap") != str(snap())
+        or catalog.get("arch") != arch
+    ):
+        return None
+
+    return catalog
+
+
+def write_json_atomically(path, data):
+    """
+    Write a JSON file so that readers see either the old or the new contents. The data
+    goes to a temporary file of this process first, concurrent writers do not clash.
+
+    :param path: the file to write
+    :param data: the JSON serializable data to store
+    :raises OSError: if the file could not be written
+    """
+    path = Path(path)
+    tmp_file = path.with_name("{}.tmp.{}".format(path.name, os.getpid()))
+    path.parent.mkdir(exist_ok=True)
+    try:
+        with open(tmp_file, "w") as fout:
+            json.dump(data, fout, separators=(",", ":"))
+        try:
+            try_set_file_permissions(tmp_file)
+        except OSError:
+            pass
+        os.replace(tmp_file, path)
+    except OSError:
+        try:
+            tmp_file.unlink()
+        except OSError:
+            pass
+        raise
+
+
+def save_addons_catalog(catalog):
+    """
+    Store the compiled addons catalog. Failing to store the catalog is not an error,
+    e.g. users in the microk8s group may not be able to write under $SNAP_DATA.
+
+    :param catalog: the catalog to store
+    """
+    catalog_file = addons_catalog_file()
+    try:
+        write_json_atomically(catalog_file, catalog)
+    except OSError:
+        LOG.debug("could not store addons catalog in %s", catalog_file)
+
+
+def filter_addons(addons, arch, strict=None):
+    """
+    Filter the addons of an addons.yaml by architecture and confinement.
+
+    :param addons: the addons listed in addons.yaml
+    :param arch: the architecture to keep addons for
+    :param strict: the confinement to keep addons for, None to skip the confinement check
+    :return: the list of addons matching the filters
+    """
+    filtered = []
+    for addon in addons:
+        if arch not in addon["supported_architectures"]:
+            continue
+
+        if strict is not None and "confinement" in addon:
+            if strict and "strict" not in addon["confinement"]:
+                continue
+            if not strict and "classic" not in addon["confinement"]:
+                continue
+
+        filtered.append(addon)
+
+    return filtered
+
+
+def compile_addons_yaml(addons_yaml, arch, strict=None, entry=None):
+    """
+    Return the catalog entry of an addons.yaml file. The file is only parsed if
+    the cached entry is missing or its mtime and size do not match the file.
+
+    :param addons_yaml: path to the addons.yaml file
+    :param arch: the architecture to keep addons for
+    :param strict: the confinement to keep addons for, None to skip the confinement check
+    :param entry: the cached catalog entry, if any
+    :return: the catalog entry
+    """
+    try:
+        st = os.stat(addons_yaml)
+        stamp = [st.st_mtime_ns, st.st_size]
+    except OSError:
+        stamp = None
+
+    if stamp is not None and entry is not None and entry["stamp"] == stamp:
+        return entry
+
+    with open(addons_yaml, "r") as fin:
+        addons = yaml.safe_load(fin)
+
+    return {
+        "stamp": stamp,
+        "addons": filter_addons(addons["microk8s-addons"]["addons"], arch, strict),
+    }
 
 
 def is_community_addon(arch, addon_name):
@@ -271,13 +493,14 @@ def is_community_addon(arch, addon_name):
     """
     try:
         addons_yaml = f"{os.environ['SNAP']}/addons/community/addons.yaml"
-        with open(addons_yaml, "r") as fin:
-            addons = yaml.safe_load(fin)
-
-        for addon in addons["microk8s-addons"]["addons"]:
-            if arch in addon["supported_architectures"]:
-                if addon_name == addon["name"]:
-                    return True
+        catalog = load_addons_catalog(arch) or new_addons_catalog(arch)
+        entry = compile_addons_yaml(addons_yaml, arch, entry=catalog["community"])
+        if entry != catalog["community"]:
+            save_addons_catalog({**catalog, "community": entry})
+
+        for addon in entry["addons"]:
+            if addon_name == addon["name"]:
+                return True
     except Exception:
         LOG.exception("could not load addons from %s", addons_yaml)
 
@@ -286,28 +509,24 @@ def is_community_addon(arch, addon_name):
 
 def get_available_addons(arch):
     available = []
-    strict = is_strict()
+    catalog = load_addons_catalog(arch) or new_addons_catalog(arch)
+    repositories = {}
     for dir in os.listdir(snap_common() / "addons"):
         try:
             addons_yaml = snap_common() / "addons" / dir / "addons.yaml"
-            with open(addons_yaml, "r") as fin:
-                addons = yaml.safe_load(fin)
-
-            for addon in addons["microk8s-addons"]["addons"]:
-                if arch not in addon["supported_architectures"]:
-                    continue
-
-                if "confinement" in addon:
-                    if strict and "strict" not in addon["confinement"]:
-                        continue
-                    if not strict and "classic" not in addon["confinement"]:
-                        continue
-
+            entry = compile_addons_yaml(
+                addons_yaml, arch, catalog["strict"], catalog["repositories"].get(dir)
+            )
+            repositories[dir] = entry
+            for addon in entry["addons"]:
                 available.append({**addon, "repository": dir})
 
         except Exception:
             LOG.exception("could not load addons from %s", addons_yaml)
 
+    if repositories != catalog["repositories"]:
+        save_addons_catalog({**catalog, "repositories": repositories})
+
     available = sorted(available, key=lambda k: (k["repository"], k["name"]))
     return available
 
@@ -463,14 +682,15 @@ def parse_xable_single_arg(addon_arg: str, available_addons: list):
         sys.exit(1)
 
 
-def xable(action: str, addon_args: list):
-    if os.getenv("MICROK8S_ADDONS_SKIP_LOCK") == "1":
-        unprotected_xable(action, addon_args)
-    else:
-        protected_xable(action, addon_args)
+def xable(action: str, addon_args: list, parallel: bool = False):
+    with span(action, addons=" ".join(addon_args)):
+        if os.getenv("MICROK8S_ADDONS_SKIP_LOCK") == "1":
+            unprotected_xable(action, addon_args, parallel)
+        else:
+            protected_xable(action, addon_args, parallel)
 
 
-def protected_xable(action: str, addon_args: list):
+def protected_xable(action: str, addon_args: list, parallel: bool = False):
     """
     Get an exclusive lock file and then perform enable/disable of addons.
 
@@ -486,7 +706,8 @@ def protected_xable(action: str, addon_args: list):
             pass
 
         try:
-            fcntl.lockf(f, fcntl.LOCK_EX)
+            with span("lock wait"):
+                fcntl.lockf(f, fcntl.LOCK_EX)
 
             # NOTE(neoaggelos): We now have the lock, ensure any recursive
             # invocations will not deadlock. One example is addons that
@@ -495,12 +716,12 @@ def protected_xable(action: str, addon_args: list):
             # See the relevant check in xable().
             os.environ["MICROK8S_ADDONS_SKIP_LOCK"] = "1"
 
-            unprotected_xable(action, addon_args)
+            unprotected_xable(action, addon_args, parallel)
         finally:
             fcntl.lockf(f, fcntl.LOCK_UN)
 
 
-def unprotected_xable(action: str, addon_args: list):
+def unprotected_xable(action: str, addon_args: list, parallel: bool = False):
     """Enables or disables the given addons.
 
     Collated into a single function since the logic is identical other than
@@ -509,9 +730,12 @@ def unprotected_xable(action: str, addon_args: list):
     :param action: "enable" or "disable"
     :param addons: List of addons to enable. Each addon may be prefixed with `repository/`
                    to specify which addon repository it will be sourced from.
+    :param parallel: run the hooks of independent addons concurrently
     """
-    available_addons_info = get_available_addons(get_current_arch())
-    enabled_addons_info, disabled_addons_info = get_status(available_addons_info, True)
+    with span("catalog load"):
+        available_addons_info = get_available_addons(get_current_arch())
+    with span("status detection"):
+        enabled_addons_info, disabled_addons_info = get_status(available_addons_info, True)
     if action == "enable":
         xabled_addons_info = enabled_addons_info
     elif action == "disable":
@@ -526,13 +750,15 @@ def unprotected_xable(action: str, addon_args: list):
     xabled_addons = [(addon["repository"], addon["name"]) for addon in xabled_addons_info]
 
     addons = parse_xable_addon_args(addon_args, available_addons)
-    if len(addons) > 1:
+    if len(addons) > 1 and not parallel:
         click.echo(
             "WARNING: Do not enable or disable multiple addons in one command.\n"
             "         This form of chained operations on addons will be DEPRECATED in the future.\n"
-            f"         Please, {action} one addon at a time: 'microk8s {action} <addon>'"
+            f"         Please, {action} one addon at a time: 'microk8s {action} <addon>'\n"
+            f"         or use 'microk8s {action} --parallel <addon> <addon> ...'"
         )
 
+    pending = []
     for repo_name, addon_name, args in addons:
         if (repo_name, addon_name) not in available_addons:
             click.echo("Addon {}/{} not found".format(repo_name, addon_name))
@@ -540,22 +766,193 @@ def unprotected_xable(action: str, addon_args: list):
         if (repo_name, addon_name) in xabled_addons:
             click.echo("Addon {}/{} is already {}d".format(repo_name, addon_name, action))
             continue
+        pending.append((repo_name, addon_name, args))
 
+    if parallel and len(pending) > 1:
+        enabled_addons = [(addon["repository"], addon["name"]) for addon in enabled_addons_info]
+        graph = addon_dependency_graph(action, pending, available_addons_info, enabled_addons)
         wait_for_ready(timeout=30, with_ready_node=False)
-        p = subprocess.run(
-            [snap_common() / "addons" / repo_name / "addons" / addon_name / action, *args]
-        )
+        returncode = run_addon_hooks_parallel(action, pending, graph, MAX_PARALLEL_ADDONS)
+        if returncode:
+            sys.exit(returncode)
+        wait_for_ready(timeout=30, with_ready_node=False)
+        return
+
+    for repo_name, addon_name, args in pending:
+        wait_for_ready(timeout=30, with_ready_node=False)
+        with span("hook", action=action, addon="{}/{}".format(repo_name, addon_name)):
+            p = subprocess.run(
+                [snap_common() / "addons" / repo_name / "addons" / addon_name / action, *args]
+            )
         if p.returncode:
             sys.exit(p.returncode)
         wait_for_ready(timeout=30, with_ready_node=False)
 
 
-def is_enabled(addon, item):
-    if addon in item:
-        return True
-    else:
-        filepath = os.path.expandvars(addon)
-        return os.path.isfile(filepath)
+def addon_dependency_graph(
+    action: str, addons: list, available_addons_info: list, enabled_addons: list = ()
+):
+    """
+    Build the dependency graph of a batch of addons from the "requires" list in
+    their addons.yaml metadata. Addons are disabled after the addons that require them.
+
+    Addon hooks enable their own requirements without taking the addons lock, so an
+    addon only runs alongside others if it declares its requirements and all of them
+    are in the batch or already enabled. Any other addon runs on its own.
+
+    :param action: "enable" or "disable"
+    :param addons: list of (repo_name, addon_name, args) tuples
+    :param available_addons_info: the available addons
+    :param enabled_addons: (repo_name, addon_name) tuples of the enabled addons
+    :return: dict of (repo_name, addon_name) to the set of (repo_name, addon_name)
+             that have to be processed before it
+    """
+    batch = [(repo_name, addon_name) for repo_name, addon_name, _ in addons]
+    graph = {key: set() for key in batch}
+    exclusive = set(batch)
+    for addon in available_addons_info:
+        key = (addon["repository"], addon["name"])
+        if key not in graph or "requires" not in addon:
+            continue
+        satisfied = True
+        for requirement in addon["requires"]:
+            deps = [dep for dep in batch if dep != key and requirement in (dep[1], "/".join(dep))]
+            for dep in deps:
+                if action == "enable":
+                    graph[key].add(dep)
+                else:
+                    graph[dep].add(key)
+            if not deps and action == "enable":
+                satisfied = satisfied and any(
+                    requirement in (dep[1], "/".join(dep)) for dep in enabled_addons
+                )
+        if satisfied:
+            exclusive.discard(key)
+
+    # refuse to run a batch that can never complete
+    order = []
+    while len(order) < len(graph):
+        ready = [key for key in batch if key not in order and graph[key] <= set(order)]
+        if not ready:
+            cycle = sorted("/".join(key) for key in batch if key not in order)
+            click.echo("Addons {} require each other".format(", ".join(cycle)), err=True)
+            sys.exit(1)
+        order.extend(ready)
+
+    # run the addons that may enable other addons one at a time
+    for i, key in enumerate(order):
+        if key in exclusive:
+            graph[key].update(order[:i])
+            for later in order[i + 1 :]:
+                graph[later].add(key)
+
+    return graph
+
+
+def run_addon_hook(action: str, repo_name: str, addon_name: str, args: list, capture=True):
+    """
+    Run the hook of an addon.
+
+    :param capture: capture the output of the hook instead of attaching it to the terminal,
+                    hooks cannot prompt the user then
+    :return: the completed process, stdout is None if the output was not captured
+    """
+    with span("hook", action=action, addon="{}/{}".format(repo_name, addon_name)):
+        cmd = [snap_common() / "addons" / repo_name / "addons" / addon_name / action, *args]
+        if not capture:
+            return subprocess.run(cmd)
+        return subprocess.run(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+
+
+def run_addon_hooks_parallel(action: str, addons: list, graph: dict, max_workers: int):
+    """
+    Run the hooks of a batch of addons, running addons whose requirements are done
+    concurrently. The output of hooks running alongside others is captured and shown
+    once they finish, a hook running on its own stays attached to the terminal so it
+    can prompt the user. No new hooks are started after a failure.
+
+    :param action: "enable" or "disable"
+    :param addons: list of (repo_name, addon_name, args) tuples
+    :param graph: the dependency graph from addon_dependency_graph
+    :param max_workers: maximum number of concurrent hooks
+    :return: the return code of the first failed hook, 0 on success
+    """
+    args = {(repo_name, addon_name): addon_args for repo_name, addon_name, addon_args in addons}
+    pending = dict(graph)
+    done = set()
+    returncode = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while (pending and not returncode) or running:
+            if not returncode:
+                ready = [key for key, deps in pending.items() if deps <= done]
+                # nothing else starts before a hook started on its own finishes
+                capture = len(ready) > 1 or bool(running)
+                for key in ready:
+                    click.echo("{} {}".format(action.capitalize()[:-1] + "ing", "/".join(key)))
+                    future = executor.submit(run_addon_hook, action, *key, args[key], capture)
+                    running[future] = key
+                    del pending[key]
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                key = running.pop(future)
+                p = future.result()
+                if p.stdout is not None:
+                    click.echo("----- {} {} -----".format(action, "/".join(key)))
+                    click.echo(p.stdout.decode(errors="replace"), nl=False)
+                if p.returncode:
+                    click.echo("Failed to {} {}".format(action, "/".join(key)), err=True)
+                    returncode = returncode or p.returncode
+                else:
+                    done.add(key)
+
+    return returncode
+
+
+def build_resource_index(names):
+    """
+    Index resource names by kind.
+
+    :param names: output of `kubectl get ... -o name`, one `kind/name` per line
+    :return: dict of kind to a sorted list of resource names of that kind
+    """
+    index = {}
+    for line in names.split("\n"):
+        kind, _, name = line.strip().partition("/")
+        if name:
+            index.setdefault(kind, []).append(name)
+
+    for resources in index.values():
+        resources.sort()
+
+    return index
+
+
+def is_addon_enabled(check_status, index):
+    """
+    Check whether an addon is enabled.
+
+    The check_status of an addon is either a `kind/name-prefix` pattern that is
+    matched against the resources in the index, or a path to a file that exists
+    when the addon is enabled.
+
+    :param check_status: the check_status pattern of the addon
+    :param index: the resource index as returned by build_resource_index
+    :return: True if the addon is enabled
+    """
+    kind, _, prefix = check_status.partition("/")
+    resources = index.get(kind)
+    if resources:
+        pos = bisect.bisect_left(resources, prefix)
+        if pos < len(resources) and resources[pos].startswith(prefix):
+            return True
+
+    return os.path.isfile(os.path.expandvars(check_status))
 
 
 def get_status(available_addons, isReady):
@@ -563,17 +960,12 @@ def get_status(available_addons, isReady):
     disabled = []
     if isReady:
         # 'all' does not include ingress
-        kube_output = kubectl_get("all,ingress,ingressclass")
-        cluster_output = kubectl_get_clusterroles()
-        kube_output = kube_output + cluster_output
+        resources = kubectl_get_names("all,ingress,ingressclass,clusterroles")
+        index = build_resource_index(resources)
         for addon in available_addons:
-            found = False
-            for row in kube_output.split("\n"):
-                if is_enabled(addon["check_status"], row):
-                    enabled.append(addon)
-                    found = True
-                    break
-            if not found:
+            if is_addon_enabled(addon["check_status"], index):
+                enabled.append(addon)
+            else:
                 disabled.append(addon)
 
     return enabled, disabled
@@ -4,24 +4,44 @@ import argparse
 
 import tempfile
 import datetime
+import hashlib
+import io
+import random
 import subprocess
+import sys
 import tarfile
+import threading
+import time
 import os.path
 
+from common.cluster.utils import get_kine_socket
+from common.dqlite import ROLES, DqliteClient, DqliteError
+from common.parallel_gzip import ParallelGzipWriter
 from common.utils import (
     exit_if_no_permission,
     is_cluster_locked,
     is_ha_enabled,
-    snap_data,
     safe_extract,
 )
 
+MANIFEST = "SHA256SUMS"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+KINE_DATABASE = "k8s"
+# a database of its own, so that the benchmark never writes to the kine database
+BENCH_DATABASE = "microk8s-bench"
+BENCH_TABLE = "bench"
+BENCH_KEYS = 1000
+BENCH_RTT_SAMPLES = 20
+BENCH_POLL_LIMIT = 500
+BENCH_OPERATIONS = ("read", "write", "poll")
+
 
 def get_kine_endpoint():
     """
     Return the default kine endpoint
     """
-    return "unix://{}/var/kubernetes/backend/kine.sock:12379".format(snap_data())
+    return "unix://{}".format(get_kine_socket())
 
 
 def kine_exists():
@@ -43,10 +63,11 @@ def generate_backup_name():
     return "backup-{}".format(now.strftime("%Y-%m-%d-%H-%M-%S"))
 
 
-def run_command(command):
+def run_command(command, out=None):
     """
     Run a command while printing the output
     :param command: the command to run
+    :param out: the file to print the output to, stdout by default
     :return: the return code of the command
     """
     process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
@@ -55,48 +76,155 @@ def run_command(command):
         if (not output or output == "") and process.poll() is not None:
             break
         if output:
-            print(output.decode().strip())
+            print(output.decode().strip(), file=out)
     rc = process.poll()
     return rc
 
 
+class HashingReader:
+    """
+    Wrap a binary file object, computing the sha256 of what is read from it
+    """
+
+    def __init__(self, fin):
+        self.fin = fin
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def archive_dump(dump_dir, arcname, fout):
+    """
+    Stream a datastore dump into a gzip compressed tar, followed by a manifest with
+    the sha256 of every file. Files are removed once archived, so the dump and the
+    archive do not both take the full space on disk.
+    :param dump_dir: the directory the dump is in
+    :param arcname: the name of the dump directory in the archive
+    :param fout: binary file object to write the archive to
+    :return: the sha256 of the archive
+    """
+    with (
+        ParallelGzipWriter(fout) as gz,
+        tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT) as tar,
+    ):
+        tar.add(dump_dir, arcname=arcname, recursive=False)
+        sums = []
+        for root, dirs, files in os.walk(dump_dir):
+            dirs.sort()
+            rel_root = os.path.relpath(root, dump_dir)
+            for name in dirs:
+                path = os.path.join(root, name)
+                tar.add(
+                    path,
+                    arcname=os.path.normpath(os.path.join(arcname, rel_root, name)),
+                    recursive=False,
+                )
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+                info = tar.gettarinfo(path, arcname=os.path.join(arcname, rel_path))
+                with open(path, "rb") as fin:
+                    reader = HashingReader(fin)
+                    tar.addfile(info, reader)
+                sums.append("{}  {}\n".format(reader.sha256.hexdigest(), rel_path))
+                os.remove(path)
+
+        manifest = "".join(sums).encode()
+        info = tarfile.TarInfo(os.path.join(arcname, MANIFEST))
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(manifest))
+    return gz.hexdigest()
+
+
+def verify_dump(dump_dir):
+    """
+    Check the files of a restored dump against its manifest, which is removed once
+    they match. Backups taken before manifests were added are not checked.
+    :param dump_dir: the directory the dump was extracted to
+    :return: the files that do not match the manifest
+    """
+    manifest = os.path.join(dump_dir, MANIFEST)
+    if not os.path.exists(manifest):
+        return []
+    mismatches = []
+    with open(manifest) as f:
+        for line in f:
+            digest, rel_path = line.rstrip("\n").split("  ", 1)
+            sha256 = hashlib.sha256()
+            try:
+                with open(os.path.join(dump_dir, rel_path), "rb") as fin:
+                    for chunk in iter(lambda: fin.read(COPY_CHUNK_SIZE), b""):
+                        sha256.update(chunk)
+            except OSError:
+                mismatches.append(rel_path)
+                continue
+            if sha256.hexdigest() != digest:
+                mismatches.append(rel_path)
+    # keep the manifest of a corrupted backup for inspection
+    if not mismatches:
+        os.remove(manifest)
+    return mismatches
+
+
 def backup(fname=None, debug=False):
     """
     Backup the database to a provided file
-    :param fname_tar: the tar file
+    :param fname: the tar file, - to stream the backup to stdout
     :param debug: show debug output
     """
     snap_path = os.environ.get("SNAP")
     kine_ep = get_kine_endpoint()
 
-    if not fname:
+    to_stdout = fname == "-"
+    # keep stdout for the backup itself when streaming it
+    out = sys.stderr if to_stdout else sys.stdout
+    if not fname or to_stdout:
         fname = generate_backup_name()
     if fname.endswith(".tar.gz"):
         fname = fname[:-7]
     fname_tar = "{}.tar.gz".format(fname)
+    arcname = os.path.basename(fname)
 
     with tempfile.TemporaryDirectory() as tmpdirname:
+        dump_dir = "{}/{}".format(tmpdirname, arcname)
         backup_cmd = (
             "{}/bin/k8s-dqlite migrator --endpoint {} --mode backup-dqlite --db-dir {}".format(
-                snap_path, kine_ep, "{}/{}".format(tmpdirname, fname)
+                snap_path, kine_ep, dump_dir
             )
         )
         if debug:
             backup_cmd = "{} {}".format(backup_cmd, "--debug")
         try:
-            rc = run_command(backup_cmd)
+            rc = run_command(backup_cmd, out)
             if rc > 0:
-                print("Backup process failed. {}".format(rc))
+                print("Backup process failed. {}".format(rc), file=out)
                 exit(1)
-            with tarfile.open(fname_tar, "w:gz") as tar:
-                tar.add(
-                    "{}/{}".format(tmpdirname, fname),
-                    arcname=os.path.basename("{}/{}".format(tmpdirname, fname)),
-                )
+            if to_stdout:
+                digest = archive_dump(dump_dir, arcname, sys.stdout.buffer)
+                print("The backup sha256 is: {}".format(digest), file=out)
+                return
 
-            print("The backup is: {}".format(fname_tar))
+            tmp_tar = "{}.part".format(fname_tar)
+            try:
+                with open(tmp_tar, "wb") as fout:
+                    digest = archive_dump(dump_dir, arcname, fout)
+                os.replace(tmp_tar, fname_tar)
+            except BaseException:
+                if os.path.exists(tmp_tar):
+                    os.remove(tmp_tar)
+                raise
+            with open("{}.sha256".format(fname_tar), "w") as f:
+                f.write("{}  {}\n".format(digest, os.path.basename(fname_tar)))
+            print("The backup is: {}".format(fname_tar), file=out)
         except subprocess.CalledProcessError as e:
-            print("Backup process failed. {}".format(e))
+            print("Backup process failed. {}".format(e), file=out)
+            exit(2)
+        except OSError as e:
+            print("Backup process failed. {}".format(e), file=out)
             exit(2)
 
 
@@ -116,6 +244,15 @@ def restore(fname_tar, debug=False):
         else:
             fname = fname_tar
         fname = os.path.basename(fname)
+        if not os.path.isdir("{}/{}".format(tmpdirname, fname)):
+            # the file was renamed, e.g. a backup streamed to stdout
+            dirs = os.listdir(tmpdirname)
+            if len(dirs) == 1:
+                fname = dirs[0]
+        mismatches = verify_dump("{}/{}".format(tmpdirname, fname))
+        if mismatches:
+            print("The backup is corrupted, checksum mismatch: {}".format(", ".join(mismatches)))
+            exit(3)
         restore_cmd = (
             "{}/bin/k8s-dqlite migrator --endpoint {} --mode restore-to-dqlite --db-dir {}".format(
                 snap_path, kine_ep, "{}/{}".format(tmpdirname, fname)
@@ -133,6 +270,214 @@ def restore(fname_tar, debug=False):
             exit(4)
 
 
+def positive_int(value):
+    """
+    Parse a positive integer argument
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("expected a positive integer, got {}".format(value))
+    return number
+
+
+def parse_mix(mix):
+    """
+    Parse a read:write:poll mix, e.g. 70:20:10
+    :param mix: the mix string
+    :return: the weight of each operation
+    """
+    try:
+        weights = [int(w) for w in mix.split(":")]
+    except ValueError:
+        weights = []
+    if len(weights) != len(BENCH_OPERATIONS) or min(weights) < 0 or sum(weights) == 0:
+        raise argparse.ArgumentTypeError(
+            "expected read:write:poll weights, e.g. 70:20:10, got {}".format(mix)
+        )
+    return weights
+
+
+def percentile(samples, pct):
+    """
+    Return the nearest rank percentile of some sorted samples
+    """
+    if not samples:
+        return None
+    rank = max(int(len(samples) * pct / 100.0 + 0.5), 1)
+    return samples[min(rank, len(samples)) - 1]
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return "{:.2f}".format(seconds * 1000)
+
+
+def bench_worker(client, leader, weights, value_size, deadline, seed, revision, latencies):
+    """
+    Run a read/write/poll mix against the leader until the deadline. Writes replace
+    rows of the benchmark database, reads fetch them back and polls query the kine
+    table for new revisions, the way kine serves its watchers.
+    :param latencies: dict of operation to the list the latencies are added to
+    """
+    rand = random.Random(seed)
+    value = os.urandom(value_size)
+    with client.connect(leader) as sock:
+        db_id = client.open_database(sock, BENCH_DATABASE)
+        kine_db_id = client.open_database(sock, KINE_DATABASE)
+        while time.monotonic() < deadline:
+            op = rand.choices(BENCH_OPERATIONS, weights)[0]
+            key = "{}/{}".format(seed, rand.randrange(BENCH_KEYS))
+            start = time.perf_counter()
+            if op == "write":
+                client.exec_sql(
+                    sock,
+                    db_id,
+                    "INSERT OR REPLACE INTO {} (name, value) VALUES (?, ?)".format(BENCH_TABLE),
+                    (key, value),
+                )
+            elif op == "read":
+                client.query_sql(
+                    sock, db_id, "SELECT value FROM {} WHERE name = ?".format(BENCH_TABLE), (key,)
+                )
+            else:
+                rows = client.query_sql(
+                    sock,
+                    kine_db_id,
+                    "SELECT id FROM kine WHERE id > ? ORDER BY id LIMIT ?",
+                    (revision, BENCH_POLL_LIMIT),
+                )
+                if rows:
+                    revision = rows[-1][0]
+            latencies[op].append(time.perf_counter() - start)
+
+
+def voter_round_trips(client, members, samples=BENCH_RTT_SAMPLES):
+    """
+    Time the round trip of the cheapest request to each voter
+    :param members: the cluster members
+    :return: dict of voter address to the sorted round trip times, or the error reaching it
+    """
+    round_trips = {}
+    for member in members:
+        if ROLES.get(member["Role"]) != "voter":
+            continue
+        address = member["Address"]
+        try:
+            with client.connect(address) as sock:
+                # the first request may pay for lazy initialisation on the node
+                client.leader(sock)
+                times = []
+                for _ in range(samples):
+                    start = time.perf_counter()
+                    client.leader(sock)
+                    times.append(time.perf_counter() - start)
+            round_trips[address] = sorted(times)
+        except (OSError, DqliteError) as e:
+            round_trips[address] = e
+    return round_trips
+
+
+def bench(duration=10, clients=4, weights=(70, 20, 10), value_size=1024):
+    """
+    Benchmark the datastore and print the latency of each operation, the throughput
+    and the round trip time to each voter
+    :param duration: how long to run the benchmark in seconds
+    :param clients: the number of concurrent clients
+    :param weights: the read:write:poll mix
+    :param value_size: the size of the written values in bytes
+    """
+    client = DqliteClient()
+    try:
+        leader, members = client.cluster()
+        round_trips = voter_round_trips(client, members)
+
+        with client.connect(leader) as sock:
+            db_id = client.open_database(sock, BENCH_DATABASE)
+            client.exec_sql(
+                sock,
+                db_id,
+                "CREATE TABLE IF NOT EXISTS {} (name TEXT PRIMARY KEY, value BLOB)".format(
+                    BENCH_TABLE
+                ),
+            )
+            try:
+                kine_db_id = client.open_database(sock, KINE_DATABASE)
+                revision = client.query_sql(sock, kine_db_id, "SELECT MAX(id) FROM kine")[0][0] or 0
+                results = [{op: [] for op in BENCH_OPERATIONS} for _ in range(clients)]
+                errors = []
+
+                def run(seed):
+                    try:
+                        bench_worker(
+                            client,
+                            leader,
+                            weights,
+                            value_size,
+                            deadline,
+                            seed,
+                            revision,
+                            results[seed],
+                        )
+                    except (OSError, DqliteError) as e:
+                        errors.append(e)
+
+                threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+                start = time.monotonic()
+                deadline = start + duration
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.monotonic() - start
+            finally:
+                client.exec_sql(sock, db_id, "DROP TABLE IF EXISTS {}".format(BENCH_TABLE))
+    except (OSError, DqliteError) as e:
+        print("Benchmark failed. {}".format(e))
+        exit(5)
+    if errors:
+        print("Benchmark failed. {}".format(errors[0]))
+        exit(5)
+
+    print(
+        "{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "operation", "count", "ops/s", "p50 (ms)", "p95 (ms)", "p99 (ms)"
+        )
+    )
+    total = 0
+    for op in BENCH_OPERATIONS:
+        samples = sorted(s for r in results for s in r[op])
+        total += len(samples)
+        print(
+            "{:<10} {:>8} {:>10.1f} {:>10} {:>10} {:>10}".format(
+                op,
+                len(samples),
+                len(samples) / elapsed,
+                format_ms(percentile(samples, 50)),
+                format_ms(percentile(samples, 95)),
+                format_ms(percentile(samples, 99)),
+            )
+        )
+    print("{:<10} {:>8} {:>10.1f}".format("total", total, total / elapsed))
+    print("Write latencies are raft commit latencies, measured on the leader {}.".format(leader))
+    print("Polls query the kine table for new revisions, as kine does to serve watches.")
+
+    print()
+    print("{:<40} {:>10} {:>10}".format("voter", "p50 (ms)", "max (ms)"))
+    for address, times in round_trips.items():
+        if isinstance(times, Exception):
+            print("{:<40} unreachable: {}".format(address, times))
+        else:
+            print(
+                "{:<40} {:>10} {:>10}".format(
+                    address, format_ms(percentile(times, 50)), format_ms(times[-1])
+                )
+            )
+
+
 if __name__ == "__main__":
     exit_if_no_permission()
     is_cluster_locked()
@@ -143,14 +488,41 @@ if __name__ == "__main__":
 
     # initiate the parser with a description
     parser = argparse.ArgumentParser(
-        description="backup and restore the Kubernetes datastore.", prog="microk8s dbctl"
+        description="backup, restore and benchmark the Kubernetes datastore.",
+        prog="microk8s dbctl",
     )
     parser.add_argument("--debug", action="store_true", help="print debug output")
-    commands = parser.add_subparsers(title="commands", help="backup and restore operations")
+    commands = parser.add_subparsers(title="commands", help="backup, restore and bench operations")
     restore_parser = commands.add_parser("restore")
     restore_parser.add_argument("backup-file", help="name of file with the backup")
     backup_parser = commands.add_parser("backup")
-    backup_parser.add_argument("-o", metavar="backup-file", help="output filename")
+    backup_parser.add_argument(
+        "-o", metavar="backup-file", help="output filename, - to write the backup to stdout"
+    )
+    bench_parser = commands.add_parser("bench")
+    bench_parser.add_argument(
+        "--duration",
+        type=positive_int,
+        default=10,
+        help="benchmark duration in seconds (default: 10)",
+    )
+    bench_parser.add_argument(
+        "--clients", type=positive_int, default=4, help="number of concurrent clients (default: 4)"
+    )
+    bench_parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=[70, 20, 10],
+        metavar="READ:WRITE:POLL",
+        help="weights of the operations, polls query the kine table for new revisions "
+        "the way kine serves watches (default: 70:20:10)",
+    )
+    bench_parser.add_argument(
+        "--value-size",
+        type=positive_int,
+        default=1024,
+        help="size of written values (default: 1024)",
+    )
     args = parser.parse_args()
 
     if "backup-file" in args:
@@ -158,7 +530,10 @@ if __name__ == "__main__":
         print("Restoring from {}".format(fname))
         restore(fname, args.debug)
     elif "o" in args:
-        print("Backing up the datastore")
+        print("Backing up the datastore", file=sys.stderr if args.o == "-" else sys.stdout)
         backup(vars(args)["o"], args.debug)
+    elif "mix" in args:
+        print("Benchmarking the datastore for {} seconds".format(args.duration))
+        bench(args.duration, args.clients, args.mix, args.value_size)
     else:
         parser.print_help()
@@ -2,6 +2,7 @@
 
 import click
 
+from common.trace import enable_tracing
 from common.utils import (
     ensure_started,
     exit_if_no_permission,
@@ -19,7 +20,20 @@ from common.utils import (
     },
 )
 @click.argument("addons", nargs=-1, required=True)
-def disable(addons):
+@click.option(
+    "--parallel",
+    is_flag=True,
+    default=False,
+    help="Disable independent addons concurrently, ordered by their requirements.",
+)
+@click.option(
+    "--trace",
+    is_flag=True,
+    default=False,
+    help="Record the time spent in each phase in $SNAP_DATA/var/log/microk8s-trace.jsonl. "
+    "Also enabled with MICROK8S_TRACE=1.",
+)
+def disable(addons, parallel, trace):
     """Disable one or more MicroK8s addons.
 
     For a list of available addons, run `microk8s status`.
@@ -32,12 +46,15 @@ def disable(addons):
     if check_help_flag(addons):
         return
 
+    if trace:
+        enable_tracing()
+
     is_cluster_locked()
     exit_if_no_permission()
     ensure_started()
     wait_for_ready(timeout=30, with_ready_node=False)
 
-    xable("disable", addons)
+    xable("disable", addons, parallel)
 
 
 if __name__ == "__main__":
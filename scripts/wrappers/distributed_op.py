@@ -1,22 +1,32 @@
 #!/usr/bin/python3
+import concurrent.futures
+import contextlib
 import getopt
-import subprocess
+import json
 
 import requests
 import urllib3
 import os
+import queue
+import shlex
 import sys
-import json
+import shutil
 import socket
+import subprocess
+import tarfile
+import tempfile
+import threading
 import time
 
 from common.cluster.utils import (
     get_callback_token,
     get_cluster_agent_port,
     is_node_running_dqlite,
-    get_internal_ip_from_get_node,
     is_same_server,
 )
+from common.agent_client import AGENT_CONNECT_TIMEOUT, agent_post, is_connect_error
+from common.inventory import get_nodes
+from common.kubeclient import KubeApiError
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -29,13 +39,44 @@ callback_token_file = "{}/credentials/callback-token.txt".format(snapdata_path)
 
 KUBECTL = "{}/microk8s-kubectl.wrapper".format(snap_path)
 MICROK8S_STATUS = "{}/microk8s-status.wrapper".format(snap_path)
+CTR = "{}/microk8s-ctr.wrapper".format(snap_path)
+
+MAX_PARALLEL_NODES = 16
+NODE_REACHED = "reached"
+NODE_UNREACHABLE = "unreachable"
+NODE_UNKNOWN = "unknown"
+IMAGE_CHUNK_SIZE = 1024 * 1024
+IMAGE_TEE_DEPTH = 8
+IMAGE_PARALLEL_NODES = 4
+NODES_RETRIES = 10
+NODES_RETRY_DELAY = 0.5
+NODES_MAX_RETRY_DELAY = 3
+
+
+def list_nodes():
+    """
+    List the cluster nodes, retrying with a backoff while the API server is not ready.
+    The stored inventory is not used, it may miss a node that joined through another
+    control plane node in the last INVENTORY_TTL seconds. It is refreshed instead.
+    """
+    delay = NODES_RETRY_DELAY
+    for attempt in range(NODES_RETRIES):
+        try:
+            return get_nodes(refresh=True)
+        except KubeApiError as e:
+            print("Failed to list nodes (try {}): {}".format(attempt + 1, e), file=sys.stderr)
+            if attempt == NODES_RETRIES - 1:
+                raise e
+            time.sleep(delay)
+            delay = min(delay * 2, NODES_MAX_RETRY_DELAY)
 
 
 def get_cluster_agent_endpoints(include_self=False):
     """
-    Get a list of all cluster agent endpoints and their callback token.
+    Get a list of all cluster agent endpoints and their callback token. The nodes are
+    listed once and stored in the cluster inventory shared with the other commands.
 
-    :param include_self: If true, include the current node in the list.
+    :param include_self: If true, include the current node in the list, as 127.0.0.1.
 
     :return: [("node1:25000", "token1"), ("node2:25000", "token2"), ...]
     """
@@ -44,23 +85,11 @@ def get_cluster_agent_endpoints(include_self=False):
         hostname = socket.gethostname()
         token = get_callback_token()
 
-        for attempt in range(10):
-            try:
-                stdout = subprocess.check_output([KUBECTL, "get", "node", "-o", "json"])
-                break
-            except subprocess.CalledProcessError as e:
-                print("Failed to list nodes (try {}): {}".format(attempt + 1, e), file=sys.stderr)
-                if attempt == 9:
-                    raise e
-                time.sleep(3)
-
-        info = json.loads(stdout)
-        for node_info in info["items"]:
-            node_ip = get_internal_ip_from_get_node(node_info)
-            if not include_self and is_same_server(hostname, node_ip):
-                continue
-
-            nodes.append(("{}:25000".format(node_ip), token.rstrip()))
+        for node in list_nodes():
+            if not is_same_server(hostname, node["ip"]):
+                nodes.append((node["agent_endpoint"], token.rstrip()))
+            elif include_self:
+                nodes.append(("127.0.0.1:{}".format(get_cluster_agent_port()), token.rstrip()))
     else:
         if include_self:
             token = get_callback_token()
@@ -69,24 +98,66 @@ def get_cluster_agent_endpoints(include_self=False):
 
         try:
             with open(callback_tokens_file, "r+") as fin:
-                for line in fin:
-                    node_ep, token = line.split()
-                    host = node_ep.split(":")[0]
-
-                    try:
-                        subprocess.check_call(
-                            [KUBECTL, "get", "node", host],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-                        nodes.append((node_ep, token.rstrip()))
-                    except subprocess.CalledProcessError:
-                        print("Node {} not present".format(host))
+                lines = [line.split() for line in fin if line.strip()]
         except OSError:
-            pass
+            lines = []
+
+        if lines:
+            names = {node["name"] for node in list_nodes()}
+            for node_ep, token in lines:
+                host = node_ep.split(":")[0]
+                if host in names:
+                    nodes.append((node_ep, token.rstrip()))
+                else:
+                    print("Node {} not present".format(host))
+
     return nodes
 
 
+def run_on_nodes(func, endpoints, *args, max_workers=MAX_PARALLEL_NODES):
+    """
+    Run a function against many nodes concurrently
+
+    :param func: called as func(node_ep, token, *args) for every endpoint
+    :param endpoints: list of (node_ep, token) tuples
+    :param max_workers: maximum number of nodes to run against at a time
+    :return: list of (node_ep, result) tuples, in the order of endpoints
+    """
+    if not endpoints:
+        return []
+
+    workers = min(max_workers, len(endpoints))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, node_ep, token, *args) for node_ep, token in endpoints]
+        return [(node_ep, f.result()) for (node_ep, _), f in zip(endpoints, futures)]
+
+
+def configure_node(node_ep, token, remote_op):
+    """
+    Perform a /configure operation on a node. Requests that fail to connect are
+    retried with a backoff, requests that may have reached the node are not.
+
+    :param node_ep: the node cluster agent endpoint
+    :param token: the node callback token
+    :param remote_op: the operation json
+    :return: (state, error) where state is one of NODE_REACHED, NODE_UNREACHABLE or
+             NODE_UNKNOWN if the request was sent but no answer came back, and error
+             is None on success
+    """
+    op = {**remote_op, "callback": token.rstrip()}
+    try:
+        res = agent_post(node_ep, "{}/configure".format(CLUSTER_API_V1), json=op)
+    except requests.exceptions.RequestException as e:
+        if is_connect_error(e) or isinstance(e, requests.exceptions.SSLError):
+            return NODE_UNREACHABLE, e
+        # e.g. a read timeout, the node may well have applied the change
+        return NODE_UNKNOWN, e
+
+    if res.status_code != 200:
+        return NODE_REACHED, "status code {}".format(res.status_code)
+    return NODE_REACHED, None
+
+
 def do_configure_op(remote_op):
     """
     Perform a /configure operation on all remote nodes
@@ -95,59 +166,659 @@ def do_configure_op(remote_op):
     """
     try:
         endpoints = get_cluster_agent_endpoints(include_self=False)
-    except subprocess.CalledProcessError as e:
+    except KubeApiError as e:
         print("Could not query for nodes")
         raise SystemExit(e)
 
-    for node_ep, token in endpoints:
-        try:
-            remote_op["callback"] = token.rstrip()
-            # TODO: handle ssl verification
-            res = requests.post(
-                "https://{}/{}/configure".format(node_ep, CLUSTER_API_V1),
-                json=remote_op,
-                verify=False,
+    results = run_on_nodes(configure_node, endpoints, remote_op)
+    unreachable = 0
+    for node_ep, (state, error) in results:
+        if state == NODE_UNREACHABLE:
+            unreachable += 1
+            print("Failed to reach node {}: {}".format(node_ep, error))
+        elif state == NODE_UNKNOWN:
+            print(
+                "Sent a {} to node {}, outcome unknown: {}".format(
+                    remote_op["action_str"], node_ep, error
+                )
+            )
+        elif error:
+            print(
+                "Failed to perform a {} on node {} {}".format(
+                    remote_op["action_str"], node_ep, error
+                )
             )
-            if res.status_code != 200:
+
+    if results:
+        succeeded = len([node_ep for node_ep, (_, error) in results if not error])
+        print(
+            "Performed a {} on {}/{} nodes.".format(
+                remote_op["action_str"], succeeded, len(results)
+            )
+        )
+    if unreachable:
+        raise SystemExit(1)
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return "{:.1f} {}".format(size, unit)
+
+
+class ImageTee:
+    """
+    Read an image once and hand every chunk to a number of concurrent uploads.
+    Every upload buffers at most IMAGE_TEE_DEPTH chunks, so memory use does not
+    depend on the image size. Uploads that stop consuming are skipped.
+    """
+
+    def __init__(self, fin, names, bandwidth_limit=None):
+        """
+        :param fin: binary file object to read the image from
+        :param names: the names of the uploads
+        :param bandwidth_limit: maximum total bytes per second sent to all uploads
+        """
+        self.fin = fin
+        self.queues = {name: queue.Queue(maxsize=IMAGE_TEE_DEPTH) for name in names}
+        self.closed = {name: threading.Event() for name in names}
+        self.bandwidth_limit = bandwidth_limit
+
+    def run(self):
+        """
+        Read the image and distribute it. Runs in its own thread.
+        """
+        read = 0
+        start = last_report = time.time()
+        while True:
+            try:
+                chunk = self.fin.read(IMAGE_CHUNK_SIZE)
+            except OSError:
+                # uploads abort on None rather than sending a truncated image
+                chunk = None
+
+            for name, q in self.queues.items():
+                while not self.closed[name].is_set():
+                    try:
+                        q.put(chunk, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+            if not chunk:
+                break
+
+            read += len(chunk)
+            active = len([e for e in self.closed.values() if not e.is_set()])
+            now = time.time()
+            if self.bandwidth_limit and active:
+                delay = read * active / self.bandwidth_limit - (now - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if sys.stderr.isatty() and now - last_report >= 1:
                 print(
-                    "Failed to perform a {} on node {} {}".format(
-                        remote_op["action_str"], node_ep, res.status_code
-                    )
+                    "\rSent {} to {} nodes ({}/s)  ".format(
+                        format_size(read), active, format_size(read / (now - start))
+                    ),
+                    end="",
+                    file=sys.stderr,
+                    flush=True,
                 )
-        except requests.exceptions.RequestException as e:
-            print("Failed to reach node.")
-            raise SystemExit(e)
+                last_report = now
+
+        if sys.stderr.isatty() and last_report != start:
+            print(file=sys.stderr)
+
+    def stream(self, name):
+        """
+        :return: a generator of the image chunks for an upload
+        """
+        q = self.queues[name]
+        while True:
+            chunk = q.get()
+            if chunk is None:
+                raise OSError("Failed to read the image")
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self, name):
+        self.closed[name].set()
+
+
+def post_image(node_ep, token, chunks, path="image/import", headers=None):
+    """
+    Post an image to the cluster agent of a node
+
+    :param node_ep: the node cluster agent endpoint
+    :param token: the node callback token
+    :param chunks: iterable of image chunks, sent with chunked transfer encoding
+    :param path: the cluster agent API path
+    :param headers: extra request headers
+    :return: (response, error, bytes sent, seconds), error is None on success
+    """
+    sent = 0
+
+    def counted():
+        nonlocal sent
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+
+    start = time.time()
+    res = None
+    try:
+        res = agent_post(
+            node_ep,
+            "{}/{}".format(CLUSTER_API_V2, path),
+            data=counted(),
+            headers={
+                "x-microk8s-callback-token": token,
+                **(headers or {}),
+            },
+            timeout=(AGENT_CONNECT_TIMEOUT, None),
+            retries=0,
+        )
+        error = None
+        if res.status_code != 200:
+            error = res.content.decode().strip() or "status code {}".format(res.status_code)
+    except (requests.exceptions.RequestException, OSError) as e:
+        error = str(e)
+
+    return res, error, sent, time.time() - start
+
+
+def push_image(node_ep, token, chunks):
+    """
+    Push an image to the cluster agent of a node
+
+    :param node_ep: the node cluster agent endpoint
+    :param token: the node callback token
+    :param chunks: iterable of image chunks, sent with chunked transfer encoding
+    :return: (error, bytes sent, seconds), error is None on success
+    """
+    _, error, sent, seconds = post_image(node_ep, token, chunks)
+    return error, sent, seconds
+
 
+def is_local_endpoint(node_ep):
+    """
+    Check if a cluster agent endpoint is the current node, as added by
+    get_cluster_agent_endpoints(include_self=True)
 
-def do_image_import(image_data):
+    :param node_ep: the node cluster agent endpoint
     """
-    Perform a /image/import operation on all nodes
+    return node_ep.rsplit(":", 1)[0] == "127.0.0.1"
 
-    :param image_data: Raw bytes of the OCI image tar file
+
+def import_image_locally(chunks):
+    """
+    Import an image straight into the containerd of the current node, without
+    the TLS round trip and buffering of the cluster agent.
+
+    :param chunks: iterable of image chunks
+    :return: (error, bytes sent, seconds), error is None on success
+    """
+    sent = 0
+    start = time.time()
+    try:
+        with (
+            tempfile.TemporaryFile() as stderr,
+            subprocess.Popen(
+                [CTR, "image", "import", "-"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+            ) as proc,
+        ):
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+                    sent += len(chunk)
+            except BrokenPipeError:
+                # ctr exited early, its error is reported below
+                pass
+            except OSError:
+                proc.kill()
+                raise
+            proc.communicate()
+
+            error = None
+            if proc.returncode != 0:
+                stderr.seek(0)
+                error = stderr.read().decode().strip() or "ctr exited with {}".format(
+                    proc.returncode
+                )
+    except (OSError, subprocess.SubprocessError) as e:
+        error = str(e)
+
+    return error, sent, time.time() - start
+
+
+def build_relay_tree(endpoints, fanout, roots=None, parent=-1):
+    """
+    Arrange the nodes in a tree where every node relays the image to at most
+    `fanout` children, so the image reaches n nodes in log(n) hops. A fanout of
+    one relays the image along a chain.
+
+    :param endpoints: list of (node_ep, token) tuples
+    :param fanout: the number of children of every node
+    :param roots: the number of nodes the local node pushes to, defaults to fanout
+    :param parent: index of the parent node, -1 for the local node
+    :return: the children of the parent, as a list of
+             {"endpoint": node_ep, "token": token, "children": [...]} dicts
+    """
+    roots = roots or fanout
+    if parent < 0:
+        first, count = 0, roots
+    else:
+        first, count = roots + fanout * parent, fanout
+    children = []
+    for i in range(first, min(first + count, len(endpoints))):
+        node_ep, token = endpoints[i]
+        children.append(
+            {
+                "endpoint": node_ep,
+                "token": token,
+                "children": build_relay_tree(endpoints, fanout, roots, i),
+            }
+        )
+    return children
+
+
+def relay_header(tree):
+    """
+    Describe the subtree a node relays the image to. Only the endpoints are sent, each
+    agent authenticates to the nodes it relays to with its own credentials, so no node
+    gets hold of the callback tokens of the others.
+    """
+    return [{"endpoint": n["endpoint"], "children": relay_header(n["children"])} for n in tree]
+
+
+def relay_tree_endpoints(tree):
+    """
+    :return: list of (node_ep, token) tuples of all the nodes in a relay tree
+    """
+    endpoints = []
+    for node in tree:
+        endpoints.append((node["endpoint"], node["token"]))
+        endpoints += relay_tree_endpoints(node["children"])
+    return endpoints
+
+
+def relay_image(node_ep, token, chunks, children):
+    """
+    Push an image to a node and have its cluster agent relay it to the subtree
+    below it. The agent answers with the result of every node in the subtree, e.g.
+    {"nodes": [{"endpoint": "10.0.0.2:25000", "error": null, "size": 1024, "seconds": 2.5}]}
+
+    :param node_ep: the node cluster agent endpoint
+    :param token: the node callback token
+    :param chunks: iterable of image chunks, sent with chunked transfer encoding
+    :param children: the relay tree below the node
+    :return: list of (node_ep, (error, bytes sent, seconds)) tuples for the node and its
+             subtree. Without a relay report, only the node is listed if it imported the
+             image, and None is returned if it failed.
+    """
+    res, error, sent, seconds = post_image(
+        node_ep,
+        token,
+        chunks,
+        "image/relay",
+        {"x-microk8s-relay": json.dumps(relay_header(children))},
+    )
+    try:
+        reports = {n["endpoint"]: n for n in res.json()["nodes"]}
+    except (AttributeError, ValueError, KeyError, TypeError):
+        reports = None
+    if reports is None:
+        # agents that cannot relay answer 404, or drop the connection part way through
+        return None if error else [(node_ep, (None, sent, seconds))]
+
+    results = [(node_ep, (error, sent, seconds))]
+    for ep, _ in relay_tree_endpoints(children):
+        report = reports.get(ep, {"error": "no relay report from {}".format(node_ep)})
+        results.append((ep, (report.get("error"), report.get("size", 0), report.get("seconds", 0))))
+    return results
+
+
+def push_image_to_nodes(fin, endpoints, bandwidth_limit=None, relays=None):
+    """
+    Push an image to many nodes at once, reading it only once
+
+    :param fin: binary file object to read the image from
+    :param endpoints: list of (node_ep, token) tuples
+    :param bandwidth_limit: maximum total bytes per second sent to all nodes
+    :param relays: dict of node_ep to the relay tree the node forwards the image to
+    :return: list of (node_ep, result) tuples, where result is the push_image result,
+             or the relay_image result for the nodes in relays. The current node
+             imports the image directly.
+    """
+    tee = ImageTee(fin, [node_ep for node_ep, _ in endpoints], bandwidth_limit)
+    reader = threading.Thread(target=tee.run, daemon=True)
+    reader.start()
+
+    def push(node_ep, token):
+        try:
+            if relays is not None and node_ep in relays:
+                return relay_image(node_ep, token, tee.stream(node_ep), relays[node_ep])
+            if is_local_endpoint(node_ep):
+                return import_image_locally(tee.stream(node_ep))
+            return push_image(node_ep, token, tee.stream(node_ep))
+        finally:
+            tee.close(node_ep)
+
+    results = run_on_nodes(push, endpoints, max_workers=len(endpoints))
+    reader.join()
+    return results
+
+
+def push_image_in_waves(source, endpoints, parallel, bandwidth_limit=None):
+    """
+    Push an image directly to the nodes, `parallel` nodes at a time
+
+    :return: list of (node_ep, (error, bytes sent, seconds)) tuples
+    """
+    results = []
+    for i in range(0, len(endpoints), parallel):
+        wave = endpoints[i : i + parallel]
+        print("Pushing OCI images to {}".format(", ".join(node_ep for node_ep, _ in wave)))
+        with open(source, "rb") if isinstance(source, str) else source as fin:
+            results += push_image_to_nodes(fin, wave, bandwidth_limit)
+    return results
+
+
+def push_image_relayed(source, endpoints, fanout, parallel, bandwidth_limit=None):
+    """
+    Push an image to the `parallel` roots of a relay tree, which forward it to the
+    other nodes. The nodes of subtrees whose root sends no relay report are pushed to
+    directly, `parallel` nodes at a time. The current node imports the image itself while it is being
+    pushed to the roots.
+
+    :return: list of (node_ep, (error, bytes sent, seconds)) tuples
+    """
+    local = [(node_ep, token) for node_ep, token in endpoints if is_local_endpoint(node_ep)]
+    tree = build_relay_tree([e for e in endpoints if e not in local], fanout, parallel)
+    roots = [(node["endpoint"], node["token"]) for node in tree]
+    relays = {node["endpoint"]: node["children"] for node in tree}
+    print(
+        "Relaying OCI images to {} nodes through {}".format(
+            len(endpoints), ", ".join(node_ep for node_ep, _ in roots)
+        )
+    )
+    with open(source, "rb") as fin:
+        relayed = dict(push_image_to_nodes(fin, local + roots, bandwidth_limit, relays))
+
+    results = [(node_ep, relayed[node_ep]) for node_ep, _ in local]
+    for node in tree:
+        result = relayed[node["endpoint"]] or []
+        done = {node_ep for node_ep, _ in result}
+        subtree = [(node["endpoint"], node["token"])] + relay_tree_endpoints(node["children"])
+        rest = [e for e in subtree if e[0] not in done]
+        if rest:
+            print("{} cannot relay images".format(node["endpoint"]))
+            result += push_image_in_waves(source, rest, parallel, bandwidth_limit)
+        results += result
+    return results
+
+
+def print_image_import_summary(results):
+    print("{:<24} {:<8} {:>10} {:>8} {:>12}".format("NODE", "RESULT", "SIZE", "TIME", "RATE"))
+    for node_ep, (error, size, seconds) in results:
+        print(
+            "{:<24} {:<8} {:>10} {:>7.1f}s {:>10}/s".format(
+                node_ep,
+                "failed" if error else "ok",
+                format_size(size),
+                seconds,
+                format_size(size / max(seconds, 0.001)),
+            )
+        )
+    for node_ep, (error, _, _) in results:
+        if error:
+            print("Failed to import images on {}: {}".format(node_ep, error))
+
+
+def list_image_blobs(image):
+    """
+    List the content blobs of an OCI image archive
+
+    :param image: path to the image archive
+    :return: dict of blob digest to archive member name, empty if the archive holds no OCI blobs
+    """
+    blobs = {}
+    try:
+        with tarfile.open(image) as tar:
+            for member in tar:
+                parts = os.path.normpath(member.name).split("/")
+                if member.isfile() and len(parts) == 3 and parts[0] == "blobs":
+                    blobs["{}:{}".format(parts[1], parts[2])] = member.name
+    except (OSError, tarfile.TarError):
+        return {}
+    return blobs
+
+
+def list_image_metadata(image, blobs):
+    """
+    List the blobs of an OCI image archive that describe the image: the indexes and
+    manifests reachable from index.json and the image configs.
+
+    :param image: path to the image archive
+    :param blobs: dict of blob digest to archive member name
+    :return: set of digests, empty if the archive cannot be read
+    """
+    metadata = set()
+    try:
+        with tarfile.open(image) as tar:
+            index = json.load(tar.extractfile("index.json"))
+            pending = [d["digest"] for d in index.get("manifests", [])]
+            while pending:
+                digest = pending.pop()
+                if digest in metadata or digest not in blobs:
+                    continue
+                metadata.add(digest)
+                doc = json.load(tar.extractfile(blobs[digest]))
+                pending.extend(d["digest"] for d in doc.get("manifests", []))
+                if "layers" in doc and "config" in doc:
+                    metadata.add(doc["config"]["digest"])
+    except (OSError, tarfile.TarError, KeyError, ValueError, TypeError, AttributeError):
+        return set()
+    return metadata
+
+
+def get_missing_blobs(node_ep, token, digests):
+    """
+    Ask the cluster agent of a node which blobs are missing from its content store.
+    Only agents serving /image/blobs can tell, any other answer or failure means
+    the node gets the whole image.
+
+    :param node_ep: the node cluster agent endpoint
+    :param token: the node callback token
+    :param digests: the blob digests to check
+    :return: the set of missing digests, None if the node cannot tell
+    """
+    try:
+        res = agent_post(
+            node_ep,
+            "{}/image/blobs".format(CLUSTER_API_V2),
+            json={"digests": digests},
+            headers={
+                "x-microk8s-callback-token": token,
+            },
+        )
+        if res.status_code != 200:
+            return None
+        missing = res.json()["missing"]
+    except (requests.exceptions.RequestException, OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # only trust a list of the digests asked for
+    if not isinstance(missing, list) or not set(missing) <= set(digests):
+        return None
+    return set(missing)
+
+
+def write_thin_image(image, blobs, missing, fout):
+    """
+    Write a copy of an image archive that only holds some of its blobs. containerd
+    imports it as long as the other blobs are already in its content store.
+
+    :param image: path to the image archive
+    :param blobs: dict of blob digest to archive member name
+    :param missing: the digests of the blobs to keep
+    :param fout: binary file object to write the archive to
+    """
+    skip = {name for digest, name in blobs.items() if digest not in missing}
+    with tarfile.open(image) as src, tarfile.open(fileobj=fout, mode="w") as dst:
+        for member in src:
+            if member.name not in skip:
+                dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+
+
+def plan_image_push(image, endpoints, stack):
+    """
+    Group the nodes by the image blobs they are missing, so that only those blobs
+    are pushed to them, along with the index, manifests and configs of the image.
+    Nodes whose cluster agent cannot report the blobs it has, or that miss all of
+    them, get the whole image.
+
+    :param image: path to the image archive
+    :param endpoints: list of (node_ep, token) tuples
+    :param stack: ExitStack owning the temporary archives
+    :return: list of (image path, endpoints) tuples
+    """
+    blobs = list_image_blobs(image)
+    if not blobs:
+        return [(image, endpoints)]
+
+    groups = {}
+    for node_ep, missing in run_on_nodes(get_missing_blobs, endpoints, sorted(blobs)):
+        key = None if missing is None else frozenset(missing)
+        groups.setdefault(key, []).extend(e for e in endpoints if e[0] == node_ep)
+
+    metadata = list_image_metadata(image, blobs)
+    plan = []
+    for missing, nodes in groups.items():
+        if missing is None or set(blobs) <= missing | metadata:
+            plan.append((image, nodes))
+            continue
+
+        thin = stack.enter_context(tempfile.NamedTemporaryFile(prefix="microk8s-image-"))
+        write_thin_image(image, blobs, missing | metadata, thin)
+        thin.flush()
+        print(
+            "{} of {} image blobs are missing on {}".format(
+                len(missing & set(blobs)), len(blobs), ", ".join(node_ep for node_ep, _ in nodes)
+            )
+        )
+        plan.append((thin.name, nodes))
+    return plan
+
+
+def do_image_import(image, parallel=IMAGE_PARALLEL_NODES, bandwidth_limit=None, relay_fanout=0):
+    """
+    Perform a /image/import operation on all nodes. The image is streamed to up to
+    `parallel` nodes at a time with chunked transfer encoding, so it is never held
+    in memory and it is read once for all the nodes pushed to concurrently.
+    Image archives read from a file only carry the blobs each node is missing.
+    With a relay fanout the nodes forward the image to each other instead, the
+    current node pushes it to `parallel` of them.
+
+    :param image: path to the OCI image tar file, or a binary stream to read it from
+    :param parallel: maximum number of nodes to push the image to concurrently
+    :param bandwidth_limit: maximum total bytes per second sent to all nodes
+    :param relay_fanout: the number of nodes every node relays the image to, 0 to push
+                         the image to every node directly
+    :return: list of (node_ep, (error, bytes sent, seconds)) tuples
     """
 
     try:
         endpoints = get_cluster_agent_endpoints(include_self=True)
-    except subprocess.CalledProcessError as e:
+    except KubeApiError as e:
         print("Could not query for nodes")
         raise SystemExit(e)
 
-    for node_ep, token in endpoints:
-        try:
-            print("Pushing OCI images to {}".format(node_ep))
-            res = requests.post(
-                "https://{}/{}/image/import".format(node_ep, CLUSTER_API_V2),
-                data=image_data,
-                headers={
-                    "x-microk8s-callback-token": token,
-                },
-                verify=False,
+    parallel = max(1, parallel)
+    results = []
+    with contextlib.ExitStack() as stack:
+        if not isinstance(image, str) and (relay_fanout or len(endpoints) > parallel):
+            # a stream can be read only once, spool it to disk for the later waves
+            spool = stack.enter_context(tempfile.NamedTemporaryFile(prefix="microk8s-image-"))
+            shutil.copyfileobj(image, spool, IMAGE_CHUNK_SIZE)
+            spool.flush()
+            image = spool.name
+
+        plan = [(image, endpoints)]
+        if isinstance(image, str):
+            plan = plan_image_push(image, endpoints, stack)
+
+        for source, nodes in plan:
+            if relay_fanout:
+                results += push_image_relayed(
+                    source, nodes, relay_fanout, parallel, bandwidth_limit
+                )
+            else:
+                results += push_image_in_waves(source, nodes, parallel, bandwidth_limit)
+
+    print_image_import_summary(results)
+    return results
+
+
+class ConfigureBatch:
+    """
+    Collect many configuration changes into a single /configure operation. Every node
+    applies the whole operation at once and restarts each affected service once,
+    after all the argument and addon changes.
+    """
+
+    def __init__(self):
+        self.services = {}
+        self.restarts = []
+        self.addons = []
+        self.actions = []
+
+    def service(self, name):
+        if name not in self.services:
+            self.services[name] = {"name": name}
+        return self.services[name]
+
+    def restart(self, service):
+        # restarts name the daemon, e.g. "apiserver" for the "kube-apiserver" arguments
+        if service not in self.restarts:
+            self.restarts.append(service)
+        self.actions.append("restart {}".format(service))
+
+    def update_argument(self, service, key, value):
+        self.service(service).setdefault("arguments_update", []).append({key: value})
+        self.actions.append("change of argument {} to {}".format(key, value))
+
+    def remove_argument(self, service, key):
+        self.service(service).setdefault("arguments_remove", []).append(key)
+        self.actions.append("removal of argument {}".format(key))
+
+    def set_addon(self, addon, state):
+        if state not in ("enable", "disable"):
+            raise ValueError(
+                "Wrong value '{}' for state. Must be one of 'enable' or 'disable'".format(state)
             )
+        self.addons.append({"name": addon, state: "true"})
+        self.actions.append("set of {} to {}".format(addon, state))
+
+    def remote_op(self):
+        remote_op = {"action_str": ", ".join(self.actions)}
+        if self.addons:
+            remote_op["addon"] = self.addons
+        services = list(self.services.values())
+        # the agent handles the entries in order, restart once everything else is set
+        services += [{"name": service, "restart": "yes"} for service in self.restarts]
+        if services:
+            remote_op["service"] = services
+        return remote_op
 
-            if res.status_code != 200:
-                print("Failed to import images on {}: {}".format(node_ep, res.content.decode()))
-        except requests.exceptions.RequestException as e:
-            print("Failed to reach {}: {}".format(node_ep, e))
+    def apply(self):
+        if self.actions:
+            do_configure_op(self.remote_op())
 
 
 def restart(service):
@@ -157,11 +828,9 @@ def restart(service):
     :param service: the service name
     """
     print("Restarting nodes.")
-    remote_op = {
-        "action_str": "restart {}".format(service),
-        "service": [{"name": service, "restart": "yes"}],
-    }
-    do_configure_op(remote_op)
+    batch = ConfigureBatch()
+    batch.restart(service)
+    batch.apply()
 
 
 def update_argument(service, key, value):
@@ -173,11 +842,9 @@ def update_argument(service, key, value):
     :param value: the value we set
     """
     print("Adding argument {} to nodes.".format(key))
-    remote_op = {
-        "action_str": "change of argument {} to {}".format(key, value),
-        "service": [{"name": service, "arguments_update": [{key: value}]}],
-    }
-    do_configure_op(remote_op)
+    batch = ConfigureBatch()
+    batch.update_argument(service, key, value)
+    batch.apply()
 
 
 def remove_argument(service, key):
@@ -188,11 +855,9 @@ def remove_argument(service, key):
     :param key: the argument we configure
     """
     print("Removing argument {} from nodes.".format(key))
-    remote_op = {
-        "action_str": "removal of argument {}".format(key),
-        "service": [{"name": service, "arguments_remove": [key]}],
-    }
-    do_configure_op(remote_op)
+    batch = ConfigureBatch()
+    batch.remove_argument(service, key)
+    batch.apply()
 
 
 def set_addon(addon, state):
@@ -202,22 +867,45 @@ def set_addon(addon, state):
     :param addon: the add-on name
     :param state: 'enable' or 'disable'
     """
-    if state not in ("enable", "disable"):
-        raise ValueError(
-            "Wrong value '{}' for state. Must be one of 'enable' or 'disable'".format(state)
-        )
-    else:
-        print("Setting add-on {} to {} on nodes.".format(addon, state))
-        remote_op = {
-            "action_str": "set of {} to {}".format(addon, state),
-            "addon": [{"name": addon, state: "true"}],
-        }
-        do_configure_op(remote_op)
+    batch = ConfigureBatch()
+    batch.set_addon(addon, state)
+    print("Setting add-on {} to {} on nodes.".format(addon, state))
+    batch.apply()
+
+
+def configure_batch(lines):
+    """
+    Apply many configuration changes on all nodes with a single /configure operation
+
+    :param lines: the changes, one per line in the form of the command line operations,
+                  e.g. "update_argument kube-apiserver --foo bar" or "restart apiserver"
+    """
+    batch = ConfigureBatch()
+    for line in lines:
+        args = shlex.split(line)
+        if not args:
+            continue
+        operation = args[0]
+        if operation == "restart" and len(args) == 2:
+            batch.restart(args[1])
+        elif operation == "update_argument" and len(args) == 4:
+            batch.update_argument(args[1], args[2], args[3])
+        elif operation == "remove_argument" and len(args) == 3:
+            batch.remove_argument(args[1], args[2])
+        elif operation == "set_addon" and len(args) == 3:
+            batch.set_addon(args[1], args[2])
+        else:
+            raise ValueError("Invalid operation '{}'".format(line.strip()))
+
+    print("Applying {} changes to nodes.".format(len(batch.actions)))
+    batch.apply()
 
 
 def usage():
     print("usage: dist_refresh_opt [OPERATION] [SERVICE] (ARGUMENT) (value)")
     print("OPERATION is one of restart, update_argument, remove_argument, set_addon")
+    print("usage: dist_refresh_opt batch < operations")
+    print("Apply many operations, read one per line from stdin, with a single restart per node")
 
 
 if __name__ == "__main__":
@@ -244,6 +932,15 @@ if __name__ == "__main__":
             assert False, "unhandled option"
 
     operation = args[0]
+    if operation == "batch":
+        try:
+            configure_batch(sys.stdin)
+        except ValueError as err:
+            print(err)
+            usage()
+            sys.exit(2)
+        exit(0)
+
     service = args[1]
     if operation == "restart":
         restart(service)
@@ -2,6 +2,7 @@
 
 import click
 
+from common.trace import enable_tracing
 from common.utils import (
     ensure_started,
     exit_if_no_permission,
@@ -16,7 +17,20 @@ from common.utils import (
     context_settings={"ignore_unknown_options": True, "help_option_names": ["-h", "--help"]},
 )
 @click.argument("addons", nargs=-1, required=True)
-def enable(addons) -> None:
+@click.option(
+    "--parallel",
+    is_flag=True,
+    default=False,
+    help="Enable independent addons concurrently, ordered by their requirements.",
+)
+@click.option(
+    "--trace",
+    is_flag=True,
+    default=False,
+    help="Record the time spent in each phase in $SNAP_DATA/var/log/microk8s-trace.jsonl. "
+    "Also enabled with MICROK8S_TRACE=1.",
+)
+def enable(addons, parallel, trace) -> None:
     """
     Enable a MicroK8s addon.
 
@@ -29,12 +43,15 @@ def enable(addons) -> None:
     if check_help_flag(addons):
         return
 
+    if trace:
+        enable_tracing()
+
     is_cluster_locked()
     exit_if_no_permission()
     ensure_started()
     wait_for_ready(timeout=30, with_ready_node=False)
 
-    xable("enable", addons)
+    xable("enable", addons, parallel)
 
 
 if __name__ == "__main__":
@@ -1,33 +1,83 @@
 #!/usr/bin/python3
+import concurrent.futures
+import contextlib
 import os
 import subprocess
 import sys
+import tempfile
 from typing import List
 
 import click
 
-from distributed_op import do_image_import
+from common.image_bundle import BundleError, read_bundle_index, write_bundle, write_oci_archive
+from distributed_op import IMAGE_PARALLEL_NODES, do_image_import
 
 CTR = "{}/microk8s-ctr.wrapper".format(os.getenv("SNAP"))
+FETCH_PARALLEL_IMAGES = 4
 
 images = click.Group()
 
 
-@images.command("import", help="Import OCI images into the MicroK8s cluster")
+@images.command(
+    "import",
+    help="Import OCI images or an image bundle into the MicroK8s cluster. Nodes whose "
+    "cluster agent reports the image blobs it already has (/image/blobs) only get the "
+    "missing ones, the others get the whole image.",
+)
 @click.argument("image", default="-")
-def import_images(image: str):
-
-    if image == "-":
-        image_data = sys.stdin.buffer.read()
-    else:
-        try:
-            with open(image, "rb") as fin:
-                image_data = fin.read()
-        except OSError as e:
-            click.echo("Error: failed to read {}: {}".format(image, e), err=True)
-            sys.exit(1)
-
-    do_image_import(image_data)
+@click.option(
+    "--parallel",
+    default=IMAGE_PARALLEL_NODES,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Push the images to this many nodes at a time",
+)
+@click.option(
+    "--bandwidth-limit",
+    default=0,
+    type=click.FloatRange(min=0),
+    help="Limit the total upload rate to this many MiB/s",
+)
+@click.option(
+    "--relay-fanout",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Have every node relay the images to this many other nodes, "
+    "after this node pushes them to --parallel nodes. Needs cluster agents serving "
+    "/image/relay, the images are pushed directly to the nodes of the others",
+)
+def import_images(image: str, parallel: int, bandwidth_limit: float, relay_fanout: int):
+    bandwidth_limit = bandwidth_limit * 1024 * 1024 or None
+
+    with contextlib.ExitStack() as stack:
+        if image == "-":
+            image = sys.stdin.buffer
+        else:
+            try:
+                with open(image, "rb"):
+                    pass
+                bundle = read_bundle_index(image)
+            except (OSError, BundleError) as e:
+                click.echo("Error: failed to read {}: {}".format(image, e), err=True)
+                sys.exit(1)
+
+            if bundle is not None:
+                if bundle["base"]:
+                    click.echo(
+                        "Importing a delta bundle, the nodes need the images of {}".format(
+                            bundle["base"]
+                        ),
+                        err=True,
+                    )
+                archive = stack.enter_context(tempfile.NamedTemporaryFile(prefix="microk8s-image-"))
+                write_oci_archive(image, bundle, archive)
+                archive.flush()
+                image = archive.name
+
+        results = do_image_import(image, parallel, bandwidth_limit, relay_fanout)
+
+    if any(error for _, (error, _, _) in results):
+        sys.exit(1)
 
 
 def get_all_ctr_images():
@@ -40,23 +90,80 @@ def get_all_ctr_images():
     return [tag for tag in images if tag and not tag.startswith("sha256:")]
 
 
+def get_incomplete_ctr_images(images: List[str]):
+    """
+    Return the images that have content missing from the containerd content store.
+    Only the image metadata is inspected, no layers are read.
+    """
+    complete = set()
+    for line in subprocess.check_output([CTR, "image", "check"]).decode().splitlines()[1:]:
+        # REF TYPE DIGEST STATUS SIZE UNPACKED
+        parts = line.split()
+        if len(parts) > 3 and parts[3] == "complete":
+            complete.add(parts[0])
+
+    return [image for image in images if image not in complete]
+
+
+def fetch_ctr_image(image: str):
+    """
+    Fetch the missing content of an image into containerd.
+    """
+    subprocess.check_call([CTR, "content", "fetch", "--all-platforms", image], stdout=sys.stderr)
+
+
 @images.command("export-local", help="Export OCI images from the current MicroK8s node")
 @click.argument("output", default="-")
 @click.argument("images", nargs=-1)
-def export_images(output: str, images: List[str]):
+@click.option(
+    "--bundle",
+    is_flag=True,
+    default=False,
+    help="Write a compressed image bundle that stores every blob once",
+)
+@click.option(
+    "--since",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Write a delta bundle without the blobs of this earlier bundle",
+)
+def export_images(output: str, images: List[str], bundle: bool, since: str):
+    base = None
+    if since:
+        try:
+            base = read_bundle_index(since)
+        except BundleError as e:
+            click.echo("Error: {}".format(e), err=True)
+            sys.exit(1)
+        if base is None:
+            click.echo("Error: {} is not an image bundle".format(since), err=True)
+            sys.exit(1)
+        bundle = True
+
     if not images:
         images = get_all_ctr_images()
 
-    for image in images:
-        click.echo("Checking {}".format(image), err=True)
-        try:
-            subprocess.check_call([CTR, "image", "export", "-", image], stdout=subprocess.DEVNULL)
-        except subprocess.CalledProcessError:
-            subprocess.check_call(
-                [CTR, "content", "fetch", "--all-platforms", image], stdout=sys.stderr
-            )
-
-    subprocess.check_call([CTR, "image", "export", output, *images])
+    click.echo("Checking {} images".format(len(images)), err=True)
+    incomplete = get_incomplete_ctr_images(images)
+    if incomplete:
+        click.echo("Fetching {}".format(", ".join(incomplete)), err=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_PARALLEL_IMAGES) as executor:
+            for _ in executor.map(fetch_ctr_image, incomplete):
+                pass
+
+    if not bundle:
+        subprocess.check_call([CTR, "image", "export", output, *images])
+        return
+
+    with tempfile.NamedTemporaryFile(prefix="microk8s-image-") as archive:
+        subprocess.check_call([CTR, "image", "export", archive.name, *images])
+        if output == "-":
+            index = write_bundle(archive.name, sys.stdout.buffer, base)
+        else:
+            with open(output, "wb") as fout:
+                index = write_bundle(archive.name, fout, base)
+    click.echo(
+        "Wrote image bundle {} with {} blobs".format(index["id"], len(index["blobs"])), err=True
+    )
 
 
 if __name__ == "__main__":
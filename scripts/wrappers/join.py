@@ -10,11 +10,9 @@ import ssl
 import string
 import subprocess
 import sys
-import time
 import ipaddress
 
 import click
-import requests
 import urllib3
 import yaml
 from common.cluster.utils import (
@@ -23,7 +21,9 @@ from common.cluster.utils import (
     get_cluster_agent_port,
     get_cluster_cidr,
     get_token,
+    get_kine_socket,
     get_valid_connection_parts,
+    is_service_active,
     is_low_memory_guard_enabled,
     is_node_running_dqlite,
     is_token_auth_enabled,
@@ -35,12 +35,18 @@ from common.cluster.utils import (
     try_set_file_permissions,
     snap,
     snap_data,
+    wait_for,
     FINGERPRINT_MIN_LEN,
     InvalidConnectionError,
 )
+from common.agent_client import agent_post
+from common.dqlite import DqliteError, get_dqlite_cluster
+from common.inventory import invalidate_inventory
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 CLUSTER_API = "cluster/api/v1.0"
+JOIN_STOP_TIMEOUT = 30
+JOIN_MEMBER_TIMEOUT = 60
 snapdata_path = os.environ.get("SNAP_DATA")
 snap_path = os.environ.get("SNAP")
 ca_cert_file_via_env = "${SNAP_DATA}/certs/ca.remote.crt"
@@ -206,11 +212,10 @@ def get_etcd_client_cert(master_ip, master_port, token):
     with open(cer_req_file) as fp:
         csr = fp.read()
         req_data = {"token": token, "request": csr}
-        # TODO: enable ssl verification
-        signed = requests.post(
-            "https://{}:{}/{}/sign-cert".format(master_ip, master_port, CLUSTER_API),
+        signed = agent_post(
+            "{}:{}".format(master_ip, master_port),
+            "{}/sign-cert".format(CLUSTER_API),
             json=req_data,
-            verify=False,
         )
         if signed.status_code != 200:
             print("Failed to sign certificate. {}".format(signed.json()["error"]))
@@ -246,11 +251,10 @@ def get_client_cert(master_ip, master_port, fname: str, token: str, subject: str
     csr = p.stdout.decode()
 
     req_data = {"token": token, "request": csr}
-    # TODO: enable ssl verification
-    signed = requests.post(
-        "https://{}:{}/{}/sign-cert".format(master_ip, master_port, CLUSTER_API),
+    signed = agent_post(
+        "{}:{}".format(master_ip, master_port),
+        "{}/sign-cert".format(CLUSTER_API),
         json=req_data,
-        verify=False,
     )
     if signed.status_code != 200:
         error = "Failed to sign {} certificate ({}).".format(fname, signed.status_code)
@@ -574,6 +578,45 @@ def store_callback_token(token):
     try_set_file_permissions(callback_token_file)
 
 
+def is_dqlite_stopped():
+    """
+    Check that the apiserver and k8s-dqlite are down and the kine socket is gone
+    """
+    try:
+        if is_service_active("apiserver") or is_service_active("k8s-dqlite"):
+            return False
+    except (subprocess.CalledProcessError, OSError):
+        # snapctl could not tell, check again later
+        return False
+    kine_socket = get_kine_socket(cluster_dir)
+    if not os.path.exists(kine_socket):
+        return True
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(kine_socket)
+        except OSError:
+            # a stale socket file nobody listens on
+            return True
+    return False
+
+
+def is_dqlite_member(host):
+    """
+    Check if this node shows up in the dqlite cluster members
+
+    :param host: the hostname others see of this node
+    """
+    try:
+        _, members = get_dqlite_cluster()
+    except DqliteError:
+        print("..", end=" ", flush=True)
+        return False
+    if any(host in member["Address"] for member in members):
+        return True
+    print(".", end=" ", flush=True)
+    return False
+
+
 def update_dqlite(cluster_cert, cluster_key, voters, host):
     """
     Configure the dqlite cluster
@@ -585,8 +628,10 @@ def update_dqlite(cluster_cert, cluster_key, voters, host):
     """
     service("stop", "apiserver")
     service("stop", "k8s-dqlite")
-    # will allow for apiservice-kicker to generate new certificates @5s loop rate
-    time.sleep(10)
+    # the join-in-progress lock keeps the apiservice-kicker from restarting the services,
+    # wait for them to go down and release the datastore before replacing it
+    if not wait_for(is_dqlite_stopped, JOIN_STOP_TIMEOUT):
+        print("The k8s-dqlite service did not stop in time, joining anyway.")
     shutil.rmtree(cluster_backup_dir, ignore_errors=True)
     shutil.move(cluster_dir, cluster_backup_dir)
     os.mkdir(cluster_dir)
@@ -615,29 +660,8 @@ def update_dqlite(cluster_cert, cluster_key, voters, host):
 
     service("start", "k8s-dqlite")
 
-    waits = 10
     print("Waiting for this node to finish joining the cluster.", end=" ", flush=True)
-    while waits > 0:
-        try:
-            out = subprocess.check_output(
-                "{snappath}/bin/dqlite -s file://{dbdir}/cluster.yaml -c {dbdir}/cluster.crt "
-                "-k {dbdir}/cluster.key -f json k8s .cluster".format(
-                    snappath=snap_path, dbdir=cluster_dir
-                ).split(),
-                timeout=4,
-                stderr=subprocess.STDOUT,
-            )
-            if host in out.decode():
-                break
-            else:
-                print(".", end=" ", flush=True)
-                time.sleep(5)
-                waits -= 1
-
-        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-            print("..", end=" ", flush=True)
-            time.sleep(2)
-            waits -= 1
+    wait_for(lambda: is_dqlite_member(host), JOIN_MEMBER_TIMEOUT)
     print(" ")
 
     # start kube-apiserver after dqlite comes up
@@ -1010,6 +1034,7 @@ If you would still like to join the cluster as a control plane node, use:
         join_etcd(connection_parts, verify)
 
     unmark_join_in_progress()
+    invalidate_inventory()
     print("Successfully joined the cluster.")
     sys.exit(0)
 
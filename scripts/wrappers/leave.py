@@ -1,5 +1,4 @@
 #!/usr/bin/python3
-import json
 import os
 import shutil
 import socket
@@ -19,6 +18,7 @@ from common.cluster.utils import (
     is_node_dqlite_worker,
     rebuild_x509_auth_client_configs,
 )
+from common.inventory import get_dqlite_members, invalidate_inventory
 
 snapdata_path = os.environ.get("SNAP_DATA")
 snap_path = os.environ.get("SNAP")
@@ -243,19 +243,12 @@ def is_leader_without_successor():
 
     :return: True if this node is the leader without a successor.
     """
-    out = subprocess.check_output(
-        "{snappath}/bin/dqlite -s file://{dbdir}/cluster.yaml -c {dbdir}/cluster.crt "
-        "-k {dbdir}/cluster.key -f json k8s .cluster".format(
-            snappath=snap_path, dbdir=cluster_dir
-        ).split()
-    )
     voters = 0
-    data = json.loads(out.decode())
     ep_addresses = []
-    for ep in data:
-        ep_addresses.append((ep["Address"], ep["Role"]))
+    for member in get_dqlite_members():
+        ep_addresses.append((member["address"], member["role"]))
         # Role == 0 means we are voters
-        if ep["Role"] == 0:
+        if member["role"] == 0:
             voters += 1
 
     local_ips = []
@@ -287,16 +280,7 @@ def get_dqlite_endpoints():
 
     :return: two lists with the endpoints
     """
-    out = subprocess.check_output(
-        "{snappath}/bin/dqlite -s file://{dbdir}/cluster.yaml -c {dbdir}/cluster.crt "
-        "-k {dbdir}/cluster.key -f json k8s .cluster".format(
-            snappath=snap_path, dbdir=cluster_dir
-        ).split()
-    )
-    data = json.loads(out.decode())
-    ep_addresses = []
-    for ep in data:
-        ep_addresses.append(ep["Address"])
+    ep_addresses = [member["address"] for member in get_dqlite_members()]
     local_ips = []
     for interface in netifaces.interfaces():
         if netifaces.AF_INET not in netifaces.ifaddresses(interface):
@@ -341,6 +325,8 @@ def leave():
     """
     The node will depart from the cluster it is in.
     """
+    # look at the current cluster membership, and drop it once the node left
+    invalidate_inventory()
     if is_node_running_dqlite():
         if is_node_dqlite_worker():
             reset_current_dqlite_worker_installation()
@@ -348,6 +334,7 @@ def leave():
             reset_current_dqlite_installation()
     else:
         reset_current_etcd_installation()
+    invalidate_inventory()
     sys.exit(0)
 
 
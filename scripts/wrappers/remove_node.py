@@ -15,6 +15,8 @@ from common.cluster.utils import (
     is_node_running_dqlite,
     is_token_auth_enabled,
 )
+from common.inventory import get_dqlite_members, get_nodes, invalidate_inventory
+from common.kubeclient import KubeApiError
 
 snap_path = os.environ.get("SNAP")
 snapdata_path = os.environ.get("SNAP_DATA")
@@ -33,19 +35,10 @@ def remove_dqlite_node(node, force=False):
             is_node_ip = False
 
         if is_node_ip:
-            node_info = subprocess.check_output(
-                "{}/microk8s-kubectl.wrapper get no -o json".format(snap_path).split()
-            )
-            info = json.loads(node_info.decode())
-            found = False
-            for n in info["items"]:
-                if found:
+            for n in get_nodes():
+                if n["ip"] == node:
+                    node = n["name"]
                     break
-                for a in n["status"]["addresses"]:
-                    if a["type"] == "InternalIP" and a["address"] == node:
-                        node = n["metadata"]["name"]
-                        found = True
-                        break
 
         # Make sure this node exists
         node_info = subprocess.check_output(
@@ -80,7 +73,7 @@ def remove_dqlite_node(node, force=False):
             )
             exit(1)
 
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, KubeApiError):
         print("Node {} does not exist in Kubernetes.".format(node))
         if force:
             print("Attempting to remove {} from dqlite.".format(node))
@@ -145,16 +138,7 @@ def get_dqlite_endpoints():
 
     :return: two lists with the endpoints
     """
-    out = subprocess.check_output(
-        "{snappath}/bin/dqlite -s file://{dbdir}/cluster.yaml -c {dbdir}/cluster.crt "
-        "-k {dbdir}/cluster.key -f json k8s .cluster".format(
-            snappath=snap_path, dbdir=cluster_dir
-        ).split()
-    )
-    data = json.loads(out.decode())
-    ep_addresses = []
-    for ep in data:
-        ep_addresses.append(ep["Address"])
+    ep_addresses = [member["address"] for member in get_dqlite_members()]
     local_ips = []
     for interface in netifaces.interfaces():
         if netifaces.AF_INET not in netifaces.ifaddresses(interface):
@@ -233,10 +217,15 @@ def reset(node, force):
     """
     Remove a node from the cluster
     """
-    if is_node_running_dqlite():
-        remove_dqlite_node(node, force)
-    else:
-        remove_node(node)
+    # look at the current cluster membership, and drop it once the node is removed
+    invalidate_inventory()
+    try:
+        if is_node_running_dqlite():
+            remove_dqlite_node(node, force)
+        else:
+            remove_node(node)
+    finally:
+        invalidate_inventory()
     sys.exit(0)
 
 
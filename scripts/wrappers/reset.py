@@ -18,6 +18,7 @@ from common.utils import (
     ensure_started,
     exit_if_no_root,
 )
+from common.kubeclient import KubeApiError, get_kube_client
 
 
 KUBECTL = os.path.expandvars("$SNAP/microk8s-kubectl.wrapper")
@@ -27,12 +28,11 @@ def exit_if_multinode():
     """
     Exit if we cannot get the list of nodes or if we are in a multinode cluster
     """
-    cmd = [KUBECTL, "get", "no", "-o", "name"]
-    res = run_silently(cmd)
-    if not res:
+    try:
+        nodes = get_kube_client().list("nodes")
+    except KubeApiError:
         print("Failed to query the cluster nodes.")
         sys.exit(1)
-    nodes = res.split()
     if len(nodes) > 1:
         print(
             "This is a multi-node MicroK8s deployment. Reset is applicable for single node clusters."
@@ -113,14 +113,9 @@ def clean_cluster():
     2. Restart so the cluster resets
     3. Delete any locks and addon binaries.
     """
-    cmd = [KUBECTL, "get", "ns", "-o=name"]
-    res = run_silently(cmd)
-    nss = []
-    if res:
-        nss = res.split()
+    nss = list_names("namespaces")
     resources = ["replicationcontrollers", "daemonsets", "deployments", "statefulsets"]
-    for ns in nss:
-        ns_name = ns.split("/")[-1]
+    for ns_name in nss:
         print(f"Cleaning resources in namespace {ns_name}")
         for rs in resources:
             # we remove first resources that are automatically recreated so we do not risk race conditions
@@ -134,12 +129,11 @@ def clean_cluster():
     remove_storage_classes()
     remove_non_namespaced_resources()
 
-    for ns in nss:
-        ns_name = ns.split("/")[-1]
+    for ns_name in nss:
         if ns_name in ["default", "kube-public", "kube-system", "kube-node-lease"]:
             continue
-        print(f"Removing {ns}")
-        cmd = [KUBECTL, "delete", ns, "--timeout=60s"]
+        print(f"Removing namespace/{ns_name}")
+        cmd = [KUBECTL, "delete", "namespace", ns_name, "--timeout=60s"]
         subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     restart_cluster()
@@ -152,16 +146,10 @@ def remove_storage_classes():
     Remove storage classes. Silence any output.
     """
     print("Removing StorageClasses")
-    cmd = [KUBECTL, "get", "storageclasses", "-o=name"]
-    res = run_silently(cmd)
-    classes = []
-    if res:
-        classes = res.split()
-    for cs in classes:
+    for cs in list_names("storageclasses"):
         if "microk8s-hostpath" in cs:
             continue
-        cmd = [KUBECTL, "delete", cs, "--timeout=60s"]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        delete_silently("storageclasses", cs)
 
 
 def remove_crds():
@@ -196,16 +184,10 @@ def remove_priority_classes():
     Remove priority classes. Silence any output.
     """
     print("Removing PriorityClasses")
-    cmd = [KUBECTL, "get", "priorityclasses", "-o=name"]
-    res = run_silently(cmd)
-    classes = []
-    if res:
-        classes = res.split()
-    for cs in classes:
+    for cs in list_names("priorityclasses"):
         if "system-cluster-critical" in cs or "system-node-critical" in cs:
             continue
-        cmd = [KUBECTL, "delete", cs, "--timeout=60s"]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        delete_silently("priorityclasses", cs)
 
 
 def reset_cert_reissue():
@@ -255,6 +237,26 @@ def remove_extra_resources(ns_name):
         subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
+def list_names(resource):
+    """
+    Return the names of all objects of a cluster-wide resource. Ignore any errors.
+    """
+    try:
+        return [item["metadata"]["name"] for item in get_kube_client().list(resource)]
+    except KubeApiError:
+        return []
+
+
+def delete_silently(resource, name):
+    """
+    Delete an object. Ignore any errors.
+    """
+    try:
+        get_kube_client().delete(resource, name, missing_ok=True)
+    except KubeApiError:
+        pass
+
+
 def run_silently(cmd):
     result = subprocess.run(
         cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
@@ -1,7 +1,13 @@
 #!/usr/bin/python3
 import argparse
+import datetime
+import queue
+import subprocess
 import sys
+import threading
+import time
 
+from common.kubeclient import KIND_RESOURCES, KubeApiError, get_kube_client
 from common.utils import (
     exit_if_no_permission,
     exit_if_stopped,
@@ -15,9 +21,15 @@ from common.utils import (
     get_addon_by_name,
     get_status,
     get_etcd_info,
+    get_node_name,
     is_external_etcd,
 )
 
+# seconds between full status checks while watching, for changes no watch covers
+WATCH_RESYNC_PERIOD = 30
+# seconds to coalesce bursts of watch events into one status check
+WATCH_DEBOUNCE = 0.5
+
 
 def print_short(isReady, enabled_addons, disabled_addons):
     if isReady:
@@ -171,6 +183,119 @@ def ha_cluster_formed(info):
     return ha_formed
 
 
+def print_watch_event(format, kind, name, state):
+    now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if format == "yaml":
+        print("---")
+        print("time: {}".format(now))
+        print("kind: {}".format(kind))
+        print("name: {}".format(name))
+        print("status: {}".format(state))
+    else:
+        print("{} {} {}: {}".format(now, kind, name, state))
+    sys.stdout.flush()
+
+
+def watch_resource(resource, triggers, prefixes=None, field_selector=None):
+    """
+    Watch a resource forever and put it on the triggers queue whenever an object
+    matching one of the name prefixes is added or deleted. Any change triggers
+    if no prefixes are given.
+
+    :param resource: the resource to watch
+    :param triggers: the queue to notify
+    :param prefixes: name prefixes of interest
+    :param field_selector: field selector for the watch
+    """
+    resource_version = None
+    delay = 1
+    while True:
+        try:
+            events = get_kube_client().watch(
+                resource,
+                field_selector=field_selector,
+                resource_version=resource_version,
+                timeout=300,
+            )
+            for event_type, obj in events:
+                if event_type == "ERROR":
+                    # most likely our resource version is too old, start over
+                    resource_version = None
+                    break
+                resource_version = obj["metadata"].get("resourceVersion", resource_version)
+                if event_type == "BOOKMARK":
+                    continue
+                if prefixes is None or (
+                    event_type != "MODIFIED"
+                    and any(obj["metadata"]["name"].startswith(p) for p in prefixes)
+                ):
+                    triggers.put(resource)
+            delay = 1
+        except KubeApiError as e:
+            if e.status_code == 410:
+                resource_version = None
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def watch_status(available_addons, format):
+    """
+    Stream cluster and addon state changes until interrupted.
+
+    :param available_addons: the addons to report on
+    :param format: pretty or yaml
+    """
+    triggers = queue.Queue()
+
+    prefixes = {}
+    for addon in available_addons:
+        kind, _, prefix = addon["check_status"].partition("/")
+        if kind in KIND_RESOURCES:
+            prefixes.setdefault(KIND_RESOURCES[kind], []).append(prefix)
+
+    watches = [(resource, names, None) for resource, names in prefixes.items()]
+    watches.append(("nodes", None, "metadata.name={}".format(get_node_name())))
+    for resource, names, field_selector in watches:
+        threading.Thread(
+            target=watch_resource,
+            args=(resource, triggers, names, field_selector),
+            daemon=True,
+        ).start()
+
+    is_ready = None
+    states = {}
+    while True:
+        ready = is_cluster_ready()
+        if ready != is_ready:
+            print_watch_event(format, "cluster", "microk8s", "running" if ready else "not running")
+            is_ready = ready
+
+        if is_ready:
+            try:
+                enabled, _ = get_status(available_addons, True)
+            except subprocess.CalledProcessError:
+                enabled = None
+
+            if enabled is not None:
+                enabled_names = set(
+                    "{}/{}".format(addon["repository"], addon["name"]) for addon in enabled
+                )
+                for addon in available_addons:
+                    name = "{}/{}".format(addon["repository"], addon["name"])
+                    state = "enabled" if name in enabled_names else "disabled"
+                    if states.get(name) != state:
+                        print_watch_event(format, "addon", name, state)
+                        states[name] = state
+
+        try:
+            triggers.get(timeout=WATCH_RESYNC_PERIOD)
+            time.sleep(WATCH_DEBOUNCE)
+            while not triggers.empty():
+                triggers.get_nowait()
+        except queue.Empty:
+            pass
+
+
 if __name__ == "__main__":
     exit_if_no_permission()
     exit_if_stopped()
@@ -196,6 +321,11 @@ if __name__ == "__main__":
         type=int,
         default=0,
     )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="stream cluster and addon state changes as they happen",
+    )
     parser.add_argument("-a", "--addon", help="check the status of an addon.", default="all")
     parser.add_argument(
         "--yaml", action="store_true", help="DEPRECATED, use '--format yaml' instead"
@@ -208,6 +338,15 @@ if __name__ == "__main__":
     timeout = args.timeout
     yaml_short = args.yaml
 
+    if args.watch:
+        available_addons = get_available_addons(get_current_arch())
+        if args.addon != "all":
+            available_addons = get_addon_by_name(available_addons, args.addon)
+        try:
+            watch_status(available_addons, args.format)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
     if wait_ready:
         is_ready = wait_for_ready(timeout)
     else:
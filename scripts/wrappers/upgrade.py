@@ -1,17 +1,37 @@
 #!/usr/bin/python3
+import concurrent.futures
+import functools
+import json
 import os
 import argparse
 import subprocess
+import threading
+import time
 
 import requests
 import urllib3
-from common.utils import exit_if_no_permission, is_cluster_locked
+from common.agent_client import (
+    AGENT_CONNECT_TIMEOUT,
+    AGENT_TIMEOUT,
+    agent_post,
+    get_agent_session,
+    is_connect_error,
+)
+from common.cluster.utils import get_internal_ip_from_get_node
+from common.inventory import get_nodes
+from common.kubeclient import KubeApiError, get_kube_client
+from common.utils import exit_if_no_permission, is_cluster_locked, is_node_ready
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 CLUSTER_API = "cluster/api/v1.0"
 snapdata_path = os.environ.get("SNAP_DATA")
 snap_path = os.environ.get("SNAP")
 
+HEALTH_TIMEOUT = 300
+HEALTH_INTERVAL = 5
+STEP_RETRIES = 1
+MASTER = "master"
+
 
 def upgrade_master(upgrade, phase):
     """
@@ -44,9 +64,13 @@ def node_upgrade(upgrade, phase, node_ep, token):
         upgrade_script = "{}/upgrade-scripts/{}/{}-node.sh".format(snap_path, upgrade, phase)
         if os.path.isfile(upgrade_script):
             remote_op = {"callback": token, "phase": phase, "upgrade": upgrade}
-            # TODO: handle ssl verification
-            res = requests.post(
-                "https://{}/{}/upgrade".format(node_ep, CLUSTER_API), json=remote_op, verify=False
+            # the upgrade scripts may take long to run and are not safe to run twice
+            res = agent_post(
+                node_ep,
+                "{}/upgrade".format(CLUSTER_API),
+                json=remote_op,
+                timeout=(AGENT_CONNECT_TIMEOUT, None),
+                retries=0,
             )
             if res.status_code != 200:
                 print("Failed to perform a {} on node {}".format(remote_op["upgrade"], node_ep))
@@ -56,69 +80,198 @@ def node_upgrade(upgrade, phase, node_ep, token):
         raise e
 
 
+class UpgradeJournal:
+    """
+    JSON lines journal of the steps of an upgrade. Every step is recorded when it
+    starts, and when it is done or failed with its duration and error, e.g.
+    {"time": 1700000000.0, "node": "10.0.0.2:25000", "step": "commit", "status": "done",
+     "seconds": 12.5}
+    The master node is recorded as "master". An upgrade resumed from its journal
+    skips the steps that are already done, a rollback undoes the prepare and commit
+    of its node.
+    """
+
+    def __init__(self, upgrade, resume=False):
+        self.path = journal_file(upgrade)
+        self.lock = threading.Lock()
+        self.done = set()
+        if resume:
+            for entry in read_journal(upgrade):
+                if entry["status"] == "done":
+                    self.mark_done(entry["node"], entry["step"])
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fout = open(self.path, "a" if resume else "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fout.close()
+
+    def mark_done(self, node, step):
+        if step == "rollback":
+            self.done.difference_update({(node, "prepare"), (node, "commit")})
+        else:
+            self.done.discard((node, "rollback"))
+        self.done.add((node, step))
+
+    def record(self, node, step, status, **details):
+        entry = {"time": time.time(), "node": node, "step": step, "status": status, **details}
+        with self.lock:
+            self.fout.write(json.dumps(entry) + "\n")
+            self.fout.flush()
+
+    def run(self, node, step, func, retries=0):
+        """
+        Run a step unless it is already done. Steps whose request never reached the node
+        are retried up to retries times. Other failures are not, the upgrade scripts may
+        have run already and are not safe to run twice, --resume runs them again.
+
+        :return: True if the step ran, False if it was already done
+        """
+        if (node, step) in self.done:
+            print("Skipping {} on {}, already done".format(step, node))
+            return False
+
+        for attempt in range(retries + 1):
+            self.record(node, step, "started", attempt=attempt + 1)
+            start = time.time()
+            try:
+                func()
+            except Exception as e:
+                self.record(node, step, "failed", seconds=time.time() - start, error=str(e))
+                if attempt == retries or not is_connect_error(e):
+                    raise
+                print("Retrying {} on {}".format(step, node))
+                continue
+            self.record(node, step, "done", seconds=time.time() - start)
+            with self.lock:
+                self.mark_done(node, step)
+            return True
+
+
+def journal_file(upgrade):
+    return "{}/var/log/upgrades/{}.jsonl".format(snapdata_path, upgrade)
+
+
+def legacy_log_file(upgrade):
+    return "{}/var/log/upgrades/{}.log".format(snapdata_path, upgrade)
+
+
+def read_legacy_commits(upgrade):
+    """
+    Read the nodes that started a commit from the log of upgrades run before the
+    journal, e.g. "master prepare\nnode commit 10.0.0.2:25000\nmaster commit"
+    """
+    committed = []
+    with open(legacy_log_file(upgrade), "r") as log:
+        for line in log:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1] == "commit":
+                node = parts[2] if parts[0] == "node" and len(parts) > 2 else MASTER
+                if node not in committed:
+                    committed.append(node)
+    return committed
+
+
+def read_journal(upgrade):
+    """
+    Read the journal of an upgrade, skipping a last line cut short by a crash
+    """
+    entries = []
+    try:
+        with open(journal_file(upgrade), "r") as fin:
+            for line in fin:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+
 def rollback(upgrade):
     """
-    The rollback method that oversees the rollback of the cluster
+    The rollback method that oversees the rollback of the cluster. Every node that
+    started a commit is rolled back, in the order the commits started.
     :param upgrade: which upgrade to call
     """
     # We should get the nodes without checking their existence from the API server
     node_info = get_nodes_info(safe=False)
 
-    upgrade_log_file = "{}/var/log/upgrades/{}.log".format(snapdata_path, upgrade)
-    with open(upgrade_log_file, "r") as log:
-        for line in log:
-            parts = line.split(" ")
-            node_type = parts[0]
-            phase = parts[1]
-            if node_type == "node":
-                node_ep = parts[2].rstrip()
-            else:
-                node_ep = "localhost"
-            if phase == "commit":
-                print("Rolling back {} on {}".format(phase, node_ep))
-                if node_type == "node":
-                    tokens = [t for ep, t in node_info if node_ep.startswith(ep)]
-                    if len(tokens) != 0:
-                        token = tokens[0]
-                        node_upgrade(upgrade, "rollback", node_ep, token)
-                else:
-                    upgrade_master(upgrade, "rollback")
-
-
-def run_upgrade(upgrade):
+    if os.path.exists(journal_file(upgrade)):
+        committed = []
+        for entry in read_journal(upgrade):
+            if entry["step"] == "commit" and entry["node"] not in committed:
+                committed.append(entry["node"])
+    elif os.path.exists(legacy_log_file(upgrade)):
+        committed = read_legacy_commits(upgrade)
+    else:
+        raise Exception("No record of upgrade {} was found".format(upgrade))
+
+    with UpgradeJournal(upgrade, resume=True) as journal:
+        for node_ep in committed:
+            print("Rolling back commit on {}".format(node_ep))
+            if node_ep == MASTER:
+                journal.run(MASTER, "rollback", lambda: upgrade_master(upgrade, "rollback"))
+                continue
+            tokens = [t for ep, t in node_info if node_ep.startswith(ep)]
+            if len(tokens) != 0:
+                token = tokens[0]
+                journal.run(
+                    node_ep,
+                    "rollback",
+                    functools.partial(node_upgrade, upgrade, "rollback", node_ep, token),
+                )
+
+
+def upgrade_failed(upgrade, error, keep_progress=False):
+    """
+    Roll back a failed upgrade, or keep its progress so that it can be resumed
+    :param upgrade: which upgrade failed
+    :param error: the error that stopped the upgrade
+    :param keep_progress: do not roll back the steps done so far
+    """
+    print("Error in upgrading. Error: {}".format(error))
+    if not keep_progress:
+        try:
+            rollback(upgrade)
+            exit(2)
+        except Exception as e:
+            print("Error in rolling back. Error: {}".format(e))
+
+    print("The steps done so far are kept. To retry from the failed step run:")
+    print("    microk8s upgrade --resume {}".format(upgrade))
+    print("To roll the upgrade back run:")
+    print("    microk8s upgrade --undo {}".format(upgrade))
+    exit(2)
+
+
+def run_upgrade(upgrade, resume=False, keep_progress=False):
     """
     The upgrade method that oversees the upgrade of the cluster
     :param upgrade: which upgrade to call
+    :param resume: skip the steps a previous run of the upgrade already did
+    :param keep_progress: do not roll back if the upgrade fails
     """
     node_info = get_nodes_info()
 
-    log_dir = "{}/var/log/upgrades".format(snapdata_path)
-    upgrade_log_file = "{}/{}.log".format(log_dir, upgrade)
     try:
-        os.makedirs(log_dir, exist_ok=True)
-        with open(upgrade_log_file, "w") as log:
-            log.writelines(["master prepare"])
-            upgrade_master(upgrade, "prepare")
-            log.flush()
-            for node_ep, token in node_info:
-                log.writelines(["\nnode prepare {}".format(node_ep)])
-                node_upgrade(upgrade, "prepare", node_ep, token)
-                log.flush()
-
-            for node_ep, token in node_info:
-                log.writelines(["\nnode commit {}".format(node_ep)])
-                node_upgrade(upgrade, "commit", node_ep, token)
-                log.flush()
-
-            log.writelines(["\nmaster commit"])
-            upgrade_master(upgrade, "commit")
-            log.flush()
+        with UpgradeJournal(upgrade, resume) as journal:
+            journal.run(MASTER, "prepare", lambda: upgrade_master(upgrade, "prepare"))
+            for phase in ("prepare", "commit"):
+                for node_ep, token in node_info:
+                    journal.run(
+                        node_ep,
+                        phase,
+                        functools.partial(node_upgrade, upgrade, phase, node_ep, token),
+                        STEP_RETRIES,
+                    )
+            journal.run(MASTER, "commit", lambda: upgrade_master(upgrade, "commit"))
 
     except Exception as e:
-        print("Error in upgrading. Error: {}".format(e))
-        log.close()
-        rollback(upgrade)
-        exit(2)
+        upgrade_failed(upgrade, e, keep_progress)
 
 
 def get_nodes_info(safe=True):
@@ -130,20 +283,19 @@ def get_nodes_info(safe=True):
     node_info = []
     if safe:
         try:
-            nodes = subprocess.check_output(
-                "{}/microk8s-kubectl.wrapper get no".format(snap_path).split()
-            )
+            # not the stored inventory, a node may have joined through another node
+            names = {node["name"] for node in get_nodes(refresh=True)}
             if os.path.isfile(callback_tokens_file):
                 with open(callback_tokens_file, "r+") as fp:
                     for _, line in enumerate(fp):
                         parts = line.split()
                         node_ep = parts[0]
                         host = node_ep.split(":")[0]
-                        if host not in nodes.decode():
+                        if host not in names:
                             print("Node {} not present".format(host))
                             continue
                         node_info.append((parts[0], parts[1]))
-        except subprocess.CalledProcessError:
+        except KubeApiError:
             print("Error in gathering cluster node information. Upgrade aborted.")
             exit(1)
     else:
@@ -156,6 +308,96 @@ def get_nodes_info(safe=True):
     return node_info
 
 
+def get_unhealthy_nodes(node_eps):
+    """
+    Return the nodes that are not Ready or whose cluster agent does not answer
+
+    :param node_eps: the node endpoints to check
+    """
+    try:
+        ready = set()
+        for node in get_kube_client().list("nodes"):
+            if is_node_ready(node):
+                ready.add(node["metadata"]["name"])
+                ready.add(get_internal_ip_from_get_node(node))
+    except KubeApiError:
+        return list(node_eps)
+
+    unhealthy = []
+    for node_ep in node_eps:
+        if node_ep.split(":")[0] not in ready:
+            unhealthy.append(node_ep)
+            continue
+        try:
+            # any answer means the agent is serving requests
+            get_agent_session(node_ep).get("https://{}/".format(node_ep), timeout=AGENT_TIMEOUT)
+        except requests.exceptions.RequestException:
+            unhealthy.append(node_ep)
+    return unhealthy
+
+
+def wait_for_healthy_nodes(node_eps, timeout=HEALTH_TIMEOUT):
+    """
+    Wait for nodes to be Ready with a responsive cluster agent
+
+    :param node_eps: the node endpoints to wait for
+    :param timeout: how long to wait in seconds
+    """
+    deadline = time.time() + timeout
+    while True:
+        node_eps = get_unhealthy_nodes(node_eps)
+        if not node_eps:
+            return
+        if time.time() > deadline:
+            raise Exception("Nodes {} did not become healthy".format(", ".join(node_eps)))
+        time.sleep(HEALTH_INTERVAL)
+
+
+def run_rolling_upgrade(upgrade, max_parallel, resume=False, keep_progress=False):
+    """
+    Upgrade the cluster in waves of at most max_parallel nodes. The nodes of a wave are
+    prepared and committed concurrently and the next wave starts only once they are
+    all healthy again.
+    :param upgrade: which upgrade to call
+    :param max_parallel: the maximum number of nodes upgraded at the same time
+    :param resume: skip the steps a previous run of the upgrade already did
+    :param keep_progress: do not roll back if the upgrade fails
+    """
+    node_info = get_nodes_info()
+
+    try:
+        with (
+            UpgradeJournal(upgrade, resume) as journal,
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor,
+        ):
+            journal.run(MASTER, "prepare", lambda: upgrade_master(upgrade, "prepare"))
+
+            for i in range(0, len(node_info), max_parallel):
+                wave = node_info[i : i + max_parallel]
+                print("Upgrading {}".format(", ".join(node_ep for node_ep, _ in wave)))
+                ran = False
+                for phase in ("prepare", "commit"):
+                    futures = [
+                        executor.submit(
+                            journal.run,
+                            node_ep,
+                            phase,
+                            functools.partial(node_upgrade, upgrade, phase, node_ep, token),
+                            STEP_RETRIES,
+                        )
+                        for node_ep, token in wave
+                    ]
+                    for f in futures:
+                        ran = f.result() or ran
+                if ran:
+                    wait_for_healthy_nodes([node_ep for node_ep, _ in wave])
+
+            journal.run(MASTER, "commit", lambda: upgrade_master(upgrade, "commit"))
+
+    except Exception as e:
+        upgrade_failed(upgrade, e, keep_progress)
+
+
 def list_upgrades():
     """
     List all available upgrades
@@ -183,6 +425,25 @@ if __name__ == "__main__":
     parser.add_argument(
         "-u", "--undo", help="rollback a specific upgrade", nargs="?", type=str, default=None
     )
+    parser.add_argument(
+        "--resume",
+        help="resume a failed upgrade from the last good step",
+        metavar="UPGRADE",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--keep-progress",
+        help="keep the steps done when an upgrade fails instead of rolling it back, "
+        "so that it can be resumed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-parallel",
+        help="upgrade the nodes in rolling waves of this many nodes",
+        type=int,
+        default=None,
+    )
     args = parser.parse_args()
 
     run = args.run
@@ -191,10 +452,21 @@ if __name__ == "__main__":
 
     if ls:
         list_upgrades()
-    elif run:
-        run_upgrade(run)
+    elif (run or args.resume) and args.max_parallel:
+        run_rolling_upgrade(
+            run or args.resume,
+            max(1, args.max_parallel),
+            resume=not run,
+            keep_progress=args.keep_progress,
+        )
+    elif run or args.resume:
+        run_upgrade(run or args.resume, resume=not run, keep_progress=args.keep_progress)
     elif undo:
-        rollback(undo)
+        try:
+            rollback(undo)
+        except Exception as e:
+            print("Error in rolling back. Error: {}".format(e))
+            exit(2)
     else:
         print("Unknown option")
         exit(1)
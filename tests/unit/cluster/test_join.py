@@ -1,4 +1,6 @@
 import os
+import socket
+import subprocess
 from shutil import rmtree
 from unittest import mock
 
@@ -22,6 +24,7 @@ def test_command_errors_if_no_arguments():
     assert "Error: Missing argument" in result.output
 
 
+@mock.patch("join.is_dqlite_member", return_value=True)
 @mock.patch("subprocess.check_call")
 @mock.patch("os.chown")
 @mock.patch("os.chmod")
@@ -33,6 +36,7 @@ def test_join_dqlite_master_node(
     mock_chmod,
     mock_chown,
     mock_subprocess_check_call,
+    mock_is_dqlite_member,
     tmp_path,
 ):
     """
@@ -151,3 +155,57 @@ def test_join_dqlite_master_node(
     mock_subprocess_check_call.assert_any_call(
         [f"{snap}/actions/common/utils.sh", "create_user_certs_and_configs"], stdout=-3, stderr=-3
     )
+
+
+@mock.patch("time.sleep")
+def test_wait_for_backs_off_until_condition(mock_sleep):
+    results = iter([False, False, False, True])
+    assert join.wait_for(lambda: next(results), 60, backoff_min=0.5, backoff_max=1)
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5, 1, 1]
+
+
+@mock.patch("time.sleep")
+def test_wait_for_times_out(mock_sleep):
+    with mock.patch("time.time", side_effect=[100, 100, 101, 102]):
+        assert not join.wait_for(lambda: False, 1.5, backoff_min=1)
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 0.5]
+
+
+@mock.patch("subprocess.check_output")
+def test_is_service_active(mock_check_output):
+    mock_check_output.return_value = (
+        b"Service                   Startup  Current   Notes\n"
+        b"microk8s.daemon-kubelite  enabled  inactive  -\n"
+    )
+    assert not join.is_service_active("apiserver")
+    mock_check_output.assert_called_once_with(["snapctl", "services", "microk8s.daemon-kubelite"])
+
+    mock_check_output.return_value = (
+        b"Service                     Startup  Current  Notes\n"
+        b"microk8s.daemon-k8s-dqlite  enabled  active   -\n"
+    )
+    assert join.is_service_active("k8s-dqlite")
+
+
+@mock.patch("join.is_service_active", return_value=False)
+def test_is_dqlite_stopped(mock_is_service_active, tmp_path):
+    with mock.patch("join.cluster_dir", str(tmp_path)):
+        assert join.is_dqlite_stopped()
+
+        # kine names its socket after the endpoint, see dbctl.get_kine_endpoint
+        kine_socket = tmp_path / "kine.sock:12379"
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(kine_socket))
+            server.listen()
+            # kine still serves the datastore
+            assert not join.is_dqlite_stopped()
+        # a stale socket file is left behind
+        assert kine_socket.exists()
+        assert join.is_dqlite_stopped()
+
+        mock_is_service_active.return_value = True
+        assert not join.is_dqlite_stopped()
+
+        # a failing snapctl does not abort the join, the services are checked again
+        mock_is_service_active.side_effect = subprocess.CalledProcessError(1, "snapctl")
+        assert not join.is_dqlite_stopped()
@@ -0,0 +1,18 @@
+import pytest
+import requests
+import urllib3
+
+
+@pytest.fixture
+def connect_error():
+    """
+    Build the error requests raises when the connection to an agent is refused
+    """
+
+    def make():
+        reason = urllib3.exceptions.NewConnectionError(None, "Connection refused")
+        return requests.exceptions.ConnectionError(
+            urllib3.exceptions.MaxRetryError(None, "/", reason)
+        )
+
+    return make
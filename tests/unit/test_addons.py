@@ -21,7 +21,14 @@ from addons import (
     validate_addons_file,
     validate_addons_repo,
 )
-from common.utils import parse_xable_addon_args, get_available_addons
+from common.utils import (
+    build_resource_index,
+    get_available_addons,
+    get_status,
+    is_addon_enabled,
+    parse_xable_addon_args,
+    write_json_atomically,
+)
 
 ADDONS = [
     ("core", "addon1"),
@@ -73,6 +80,105 @@ def test_get_available_addons(snap_common_mock, listdir_mock, strict_mock, confi
             assert addon["name"] in result
 
 
+@patch("common.utils.is_strict", return_value=False)
+@patch("common.utils.snap_data")
+@patch("common.utils.snap_common")
+def test_get_available_addons_catalog(snap_common_mock, snap_data_mock, strict_mock, tmp_path):
+    snap_common_mock.return_value = tmp_path / "common"
+    snap_data_mock.return_value = tmp_path / "data"
+    (tmp_path / "data" / "var").mkdir(parents=True)
+    repo_dir = tmp_path / "common" / "addons" / "core"
+    repo_dir.mkdir(parents=True)
+    (repo_dir / "addons.yaml").write_text(REPO_YAML)
+
+    assert [addon["name"] for addon in get_available_addons("amd64")] == ["dns"]
+    assert (tmp_path / "data" / "var" / "cache" / "addons-catalog.json").exists()
+
+    # the compiled catalog is used while addons.yaml is unchanged
+    with patch("common.utils.yaml.safe_load") as safe_load_mock:
+        assert [addon["name"] for addon in get_available_addons("amd64")] == ["dns"]
+        safe_load_mock.assert_not_called()
+    strict_mock.assert_called_once()
+
+    # a changed addons.yaml is parsed again
+    (repo_dir / "addons.yaml").write_text(REPO_YAML.replace('name: "dns"', 'name: "dns2"'))
+    assert [addon["name"] for addon in get_available_addons("amd64")] == ["dns2"]
+
+
+def test_write_json_atomically(tmp_path):
+    path = tmp_path / "cache" / "data.json"
+    path.parent.mkdir()
+    write_json_atomically(path, {"a": 1})
+    write_json_atomically(path, {"a": 2})
+    assert path.read_text() == '{"a":2}'
+    # the temporary file is private to the process and never left behind
+    assert os.listdir(path.parent) == ["data.json"]
+
+    with patch("common.utils.os.replace", side_effect=OSError("read-only")):
+        with pytest.raises(OSError):
+            write_json_atomically(path, {"a": 3})
+    assert os.listdir(path.parent) == ["data.json"]
+    assert path.read_text() == '{"a":2}'
+
+
+RESOURCE_NAMES = """pod/coredns-7745f9f87f-2j7kl
+pod/hostpath-provisioner-58694c9f4b-8bzlx
+service/kubernetes
+deployment.apps/coredns
+ingressclass.networking.k8s.io/public
+clusterrole.rbac.authorization.k8s.io/cluster-admin
+"""
+
+
+def test_build_resource_index():
+    index = build_resource_index(RESOURCE_NAMES)
+    assert index["pod"] == [
+        "coredns-7745f9f87f-2j7kl",
+        "hostpath-provisioner-58694c9f4b-8bzlx",
+    ]
+    assert index["deployment.apps"] == ["coredns"]
+    assert "" not in index
+
+
+@pytest.mark.parametrize(
+    "check_status, result",
+    [
+        ("pod/coredns", True),
+        ("pod/hostpath-provisioner", True),
+        ("pod/metrics-server", False),
+        ("deployment.apps/coredns", True),
+        ("ingressclass.networking.k8s.io/public", True),
+        ("clusterrole.rbac.authorization.k8s.io/cluster-admin", True),
+        ("clusterrole.rbac.authorization.k8s.io/cluster-admins", False),
+        ("daemonset.apps/calico-node", False),
+    ],
+)
+def test_is_addon_enabled(check_status, result):
+    index = build_resource_index(RESOURCE_NAMES)
+    assert is_addon_enabled(check_status, index) == result
+
+
+def test_is_addon_enabled_file(tmp_path):
+    lock = tmp_path / "ha-cluster"
+    assert not is_addon_enabled(str(lock), {})
+    lock.touch()
+    assert is_addon_enabled(str(lock), {})
+
+
+@patch("common.utils.kubectl_get_names", return_value=RESOURCE_NAMES)
+def test_get_status(kubectl_get_names_mock):
+    available = [
+        {"name": "dns", "check_status": "pod/coredns"},
+        {"name": "metrics-server", "check_status": "pod/metrics-server"},
+    ]
+    enabled, disabled = get_status(available, True)
+    assert [addon["name"] for addon in enabled] == ["dns"]
+    assert [addon["name"] for addon in disabled] == ["metrics-server"]
+    kubectl_get_names_mock.assert_called_once()
+
+    assert get_status(available, False) == ([], [])
+
+
 @pytest.mark.parametrize(
     "args, result",
     [
@@ -0,0 +1,58 @@
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+import urllib3
+
+from common.agent_client import AGENT_TIMEOUT, agent_post, get_agent_session
+
+
+def test_get_agent_session_is_shared_per_endpoint():
+    session = get_agent_session("10.0.0.1:25000")
+    assert get_agent_session("10.0.0.1:25000") is session
+    assert get_agent_session("10.0.0.2:25000") is not session
+    assert session.verify is False
+
+
+@patch("common.agent_client.time.sleep")
+@patch("common.agent_client.requests.Session.post")
+def test_agent_post_retries_connection_errors(post_mock, sleep_mock, connect_error):
+    post_mock.side_effect = [connect_error(), Mock(status_code=200)]
+    assert agent_post("10.0.0.1:25000", "cluster/api/v1.0/configure").status_code == 200
+    post_mock.assert_called_with(
+        "https://10.0.0.1:25000/cluster/api/v1.0/configure", timeout=AGENT_TIMEOUT
+    )
+    sleep_mock.assert_called_once_with(1)
+
+    post_mock.reset_mock()
+    post_mock.side_effect = connect_error()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        agent_post("10.0.0.1:25000", "cluster/api/v2.0/image/import", retries=0)
+    assert post_mock.call_count == 1
+
+
+@patch("common.agent_client.time.sleep")
+@patch("common.agent_client.requests.Session.post")
+def test_agent_post_retries_connect_timeouts(post_mock, sleep_mock):
+    post_mock.side_effect = [requests.exceptions.ConnectTimeout(), Mock(status_code=200)]
+    assert agent_post("10.0.0.1:25000", "cluster/api/v1.0/configure").status_code == 200
+    assert post_mock.call_count == 2
+
+
+@patch("common.agent_client.requests.Session.post")
+def test_agent_post_does_not_retry_dropped_connections(post_mock):
+    # the request was sent, the agent may be running it
+    post_mock.side_effect = requests.exceptions.ConnectionError(
+        urllib3.exceptions.ProtocolError("Connection aborted.", ConnectionResetError())
+    )
+    with pytest.raises(requests.exceptions.ConnectionError):
+        agent_post("10.0.0.1:25000", "cluster/api/v1.0/upgrade")
+    assert post_mock.call_count == 1
+
+
+@patch("common.agent_client.requests.Session.post")
+def test_agent_post_does_not_retry_read_timeouts(post_mock):
+    post_mock.side_effect = requests.exceptions.ReadTimeout()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        agent_post("10.0.0.1:25000", "cluster/api/v1.0/upgrade")
+    assert post_mock.call_count == 1
@@ -0,0 +1,112 @@
+import argparse
+import hashlib
+import io
+import os
+import tarfile
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import dbctl
+from common.dqlite import DqliteError
+
+
+def test_parse_mix():
+    assert dbctl.parse_mix("70:20:10") == [70, 20, 10]
+    assert dbctl.parse_mix("0:1:0") == [0, 1, 0]
+    for mix in ("70:30", "a:b:c", "0:0:0", "-1:1:1"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            dbctl.parse_mix(mix)
+
+
+def test_positive_int():
+    assert dbctl.positive_int("3") == 3
+    for value in ("0", "-1", "x"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            dbctl.positive_int(value)
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert dbctl.percentile(samples, 50) == 50
+    assert dbctl.percentile(samples, 99) == 99
+    assert dbctl.percentile([3], 95) == 3
+    assert dbctl.percentile([], 50) is None
+
+
+def test_voter_round_trips():
+    members = [
+        {"ID": 1, "Address": "10.0.0.1:19001", "Role": 0},
+        {"ID": 2, "Address": "10.0.0.2:19001", "Role": 0},
+        {"ID": 3, "Address": "10.0.0.3:19001", "Role": 2},
+    ]
+    client = MagicMock()
+    client.connect.side_effect = [MagicMock(), DqliteError("refused")]
+
+    round_trips = dbctl.voter_round_trips(client, members, samples=3)
+
+    assert list(round_trips) == ["10.0.0.1:19001", "10.0.0.2:19001"]
+    assert len(round_trips["10.0.0.1:19001"]) == 3
+    assert isinstance(round_trips["10.0.0.2:19001"], DqliteError)
+    assert client.leader.call_count == 4
+
+
+def test_archive_dump_and_verify(tmp_path):
+    dump = tmp_path / "dump"
+    (dump / "db").mkdir(parents=True)
+    (dump / "db" / "state.db").write_bytes(os.urandom(10000))
+    (dump / "info").write_text("backup")
+    contents = {
+        "db/state.db": (dump / "db" / "state.db").read_bytes(),
+        "info": b"backup",
+    }
+
+    out = io.BytesIO()
+    digest = dbctl.archive_dump(str(dump), "backup-1", out)
+
+    assert digest == hashlib.sha256(out.getvalue()).hexdigest()
+    # the dump files are removed once archived
+    assert not (dump / "info").exists()
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:gz") as tar:
+        assert tar.getnames() == [
+            "backup-1",
+            "backup-1/db",
+            "backup-1/info",
+            "backup-1/db/state.db",
+            "backup-1/SHA256SUMS",
+        ]
+        tar.extractall(tmp_path / "restore")
+
+    restored = tmp_path / "restore" / "backup-1"
+    assert dbctl.verify_dump(str(restored)) == []
+    assert not (restored / "SHA256SUMS").exists()
+    for path, data in contents.items():
+        assert (restored / path).read_bytes() == data
+
+
+def test_verify_dump_mismatch(tmp_path):
+    (tmp_path / "info").write_text("tampered")
+    (tmp_path / "SHA256SUMS").write_text(
+        "{}  info\n{}  missing\n".format(hashlib.sha256(b"backup").hexdigest(), "0" * 64)
+    )
+    assert dbctl.verify_dump(str(tmp_path)) == ["info", "missing"]
+    assert (tmp_path / "SHA256SUMS").exists()
+
+
+def test_verify_dump_without_manifest(tmp_path):
+    (tmp_path / "info").write_text("backup")
+    assert dbctl.verify_dump(str(tmp_path)) == []
+
+
+@patch("dbctl.run_command", return_value=0)
+@patch("dbctl.archive_dump", side_effect=OSError("No space left on device"))
+def test_backup_removes_partial_archive(archive_dump_mock, run_command_mock, tmp_path):
+    fname = str(tmp_path / "backup-1")
+    with pytest.raises(SystemExit):
+        dbctl.backup(fname)
+
+    # the partial archive was created, then cleaned up
+    fout = archive_dump_mock.call_args.args[2]
+    assert fout.name == fname + ".tar.gz.part"
+    assert os.listdir(tmp_path) == []
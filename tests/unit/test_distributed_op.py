@@ -0,0 +1,409 @@
+import contextlib
+import io
+import json
+import tarfile
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from distributed_op import (
+    NODE_REACHED,
+    NODE_UNKNOWN,
+    NODE_UNREACHABLE,
+    build_relay_tree,
+    configure_batch,
+    configure_node,
+    do_configure_op,
+    do_image_import,
+    get_cluster_agent_endpoints,
+    get_missing_blobs,
+    ImageTee,
+    is_local_endpoint,
+    plan_image_push,
+    relay_tree_endpoints,
+    run_on_nodes,
+)
+
+
+ENDPOINTS = [("10.0.0.1:25000", "token1"), ("10.0.0.2:25000", "token2"), ("10.0.0.3:25000", "t3")]
+
+
+@patch("distributed_op.is_node_running_dqlite", return_value=False)
+@patch("distributed_op.get_nodes")
+def test_get_cluster_agent_endpoints_lists_nodes_once(get_nodes_mock, dqlite_mock, tmp_path):
+    tokens = tmp_path / "callback-tokens.txt"
+    tokens.write_text("node1:25000 token1\nnode2:25000 token2\ngone:25000 token3\n")
+    get_nodes_mock.return_value = [{"name": "node1"}, {"name": "node2"}]
+
+    with patch("distributed_op.callback_tokens_file", str(tokens)):
+        assert get_cluster_agent_endpoints() == [
+            ("node1:25000", "token1"),
+            ("node2:25000", "token2"),
+        ]
+    get_nodes_mock.assert_called_once_with(refresh=True)
+
+
+@patch("distributed_op.get_cluster_agent_port", return_value="25000")
+@patch("distributed_op.get_callback_token", return_value="tok\n")
+@patch("distributed_op.is_node_running_dqlite", return_value=True)
+@patch("distributed_op.socket.gethostname", return_value="node1")
+@patch("distributed_op.is_same_server", side_effect=lambda hostname, ip: ip == "10.0.0.5")
+@patch("distributed_op.get_nodes")
+def test_get_cluster_agent_endpoints_dqlite_marks_self(get_nodes_mock, *mocks):
+    get_nodes_mock.return_value = [
+        {"name": "node1", "ip": "10.0.0.5", "agent_endpoint": "10.0.0.5:25000"},
+        {"name": "node2", "ip": "10.0.0.6", "agent_endpoint": "10.0.0.6:25000"},
+    ]
+    assert get_cluster_agent_endpoints() == [("10.0.0.6:25000", "tok")]
+
+    endpoints = get_cluster_agent_endpoints(include_self=True)
+    assert endpoints == [("127.0.0.1:25000", "tok"), ("10.0.0.6:25000", "tok")]
+    assert [is_local_endpoint(node_ep) for node_ep, _ in endpoints] == [True, False]
+
+
+def test_run_on_nodes_is_concurrent():
+    def slow(node_ep, token, value):
+        time.sleep(0.2)
+        return token + value
+
+    start = time.time()
+    results = run_on_nodes(slow, ENDPOINTS, "!")
+    assert time.time() - start < 0.5
+    assert results == [(ep, token + "!") for ep, token in ENDPOINTS]
+
+
+@patch("common.agent_client.time.sleep")
+@patch("common.agent_client.requests.Session.post")
+def test_configure_node_retries_connection_errors(post_mock, sleep_mock, connect_error):
+    post_mock.side_effect = [connect_error(), Mock(status_code=200)]
+    assert configure_node("10.0.0.1:25000", "token\n", {"action_str": "restart"}) == (
+        NODE_REACHED,
+        None,
+    )
+    assert post_mock.call_count == 2
+    assert post_mock.call_args.kwargs["json"]["callback"] == "token"
+    assert post_mock.call_args.kwargs["timeout"]
+
+    post_mock.reset_mock()
+    post_mock.side_effect = connect_error()
+    state, error = configure_node("10.0.0.1:25000", "token", {"action_str": "restart"})
+    assert state == NODE_UNREACHABLE and error
+    assert post_mock.call_count == 3
+
+
+@patch("common.agent_client.requests.Session.post")
+def test_configure_node_does_not_retry_read_timeouts(post_mock):
+    post_mock.side_effect = requests.exceptions.ReadTimeout()
+    state, error = configure_node("10.0.0.1:25000", "token", {"action_str": "restart"})
+    assert state == NODE_UNKNOWN and error
+    post_mock.assert_called_once()
+
+
+@patch("distributed_op.configure_node")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_configure_op(get_endpoints_mock, configure_node_mock, capsys):
+    configure_node_mock.side_effect = [
+        (NODE_REACHED, None),
+        (NODE_REACHED, "status code 500"),
+        (NODE_REACHED, None),
+    ]
+    do_configure_op({"action_str": "restart kubelite"})
+    assert configure_node_mock.call_count == 3
+    out = capsys.readouterr().out
+    assert "10.0.0.2:25000 status code 500" in out
+    assert "Performed a restart kubelite on 2/3 nodes." in out
+
+    # every node is attempted before failing on unreachable nodes
+    configure_node_mock.reset_mock()
+    configure_node_mock.side_effect = [
+        (NODE_UNREACHABLE, "refused"),
+        (NODE_REACHED, None),
+        (NODE_REACHED, None),
+    ]
+    with pytest.raises(SystemExit):
+        do_configure_op({"action_str": "restart kubelite"})
+    assert configure_node_mock.call_count == 3
+
+    # a request that timed out waiting for the answer was delivered
+    capsys.readouterr()
+    configure_node_mock.reset_mock()
+    configure_node_mock.side_effect = [
+        (NODE_UNKNOWN, "read timed out"),
+        (NODE_REACHED, None),
+        (NODE_REACHED, None),
+    ]
+    do_configure_op({"action_str": "restart kubelite"})
+    out = capsys.readouterr().out
+    assert "Sent a restart kubelite to node 10.0.0.1:25000, outcome unknown" in out
+    assert "Failed to reach" not in out
+
+
+@patch("distributed_op.IMAGE_CHUNK_SIZE", 4)
+def test_image_tee_skips_closed_streams():
+    tee = ImageTee(io.BytesIO(b"0123456789" * 10), ["a", "b"])
+    tee.close("b")
+    reader = threading.Thread(target=tee.run)
+    reader.start()
+    assert b"".join(tee.stream("a")) == b"0123456789" * 10
+    reader.join(timeout=5)
+    assert not reader.is_alive()
+
+
+@patch("distributed_op.IMAGE_CHUNK_SIZE", 4)
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_streams_stdin_to_every_node(get_endpoints_mock, post_mock):
+    received = []
+
+    def post(url, data, **kwargs):
+        received.append(b"".join(data))
+        return Mock(status_code=200)
+
+    post_mock.side_effect = post
+    do_image_import(io.BytesIO(b"image contents"))
+    assert received == [b"image contents"] * len(ENDPOINTS)
+
+
+@patch("distributed_op.IMAGE_CHUNK_SIZE", 4)
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_pushes_in_waves(get_endpoints_mock, post_mock, capsys):
+    received = []
+
+    def post(url, data, **kwargs):
+        received.append(b"".join(data))
+        if "10.0.0.2" in url:
+            return Mock(status_code=500, content=b"import failed")
+        return Mock(status_code=200)
+
+    post_mock.side_effect = post
+    results = do_image_import(io.BytesIO(b"image contents"), parallel=2)
+    assert received == [b"image contents"] * len(ENDPOINTS)
+    assert [error for _, (error, _, _) in results] == [None, "import failed", None]
+    assert "Failed to import images on 10.0.0.2:25000: import failed" in capsys.readouterr().out
+
+
+def make_oci_archive(path):
+    manifest = {
+        "config": {"digest": "sha256:ccc"},
+        "layers": [{"digest": "sha256:bbb"}, {"digest": "sha256:ddd"}],
+    }
+    with tarfile.open(path, "w") as tar:
+        for name, data in [
+            ("index.json", json.dumps({"manifests": [{"digest": "sha256:aaa"}]}).encode()),
+            ("blobs/sha256/aaa", json.dumps(manifest).encode()),
+            ("blobs/sha256/bbb", b"layer" * 100),
+            ("blobs/sha256/ccc", b'{"config": {}}'),
+            ("blobs/sha256/ddd", b"other layer" * 100),
+        ]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_pushes_missing_blobs(get_endpoints_mock, post_mock, tmp_path):
+    make_oci_archive(tmp_path / "image.tar")
+    received = {}
+
+    def post(url, data=None, json=None, **kwargs):
+        if url.endswith("/image/blobs"):
+            assert json == {"digests": ["sha256:aaa", "sha256:bbb", "sha256:ccc", "sha256:ddd"]}
+            if "10.0.0.2" in url:
+                return Mock(status_code=404)
+            missing = ["sha256:bbb"] if "10.0.0.1" in url else []
+            return Mock(status_code=200, json=Mock(return_value={"missing": missing}))
+
+        with tarfile.open(fileobj=io.BytesIO(b"".join(data))) as tar:
+            received[url.split("/")[2]] = sorted(tar.getnames())
+        return Mock(status_code=200)
+
+    post_mock.side_effect = post
+    do_image_import(str(tmp_path / "image.tar"))
+    # the manifest and the config are always pushed
+    assert received == {
+        "10.0.0.1:25000": [
+            "blobs/sha256/aaa",
+            "blobs/sha256/bbb",
+            "blobs/sha256/ccc",
+            "index.json",
+        ],
+        "10.0.0.2:25000": [
+            "blobs/sha256/aaa",
+            "blobs/sha256/bbb",
+            "blobs/sha256/ccc",
+            "blobs/sha256/ddd",
+            "index.json",
+        ],
+        "10.0.0.3:25000": ["blobs/sha256/aaa", "blobs/sha256/ccc", "index.json"],
+    }
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        Mock(status_code=500),
+        Mock(status_code=200, json=Mock(side_effect=ValueError("not json"))),
+        Mock(status_code=200, json=Mock(return_value={"result": "ok"})),
+        Mock(status_code=200, json=Mock(return_value={"missing": "sha256:aaa"})),
+        Mock(status_code=200, json=Mock(return_value={"missing": ["sha256:zzz"]})),
+        requests.exceptions.ConnectionError("Connection reset by peer"),
+    ],
+)
+@patch("common.agent_client.requests.Session.post")
+def test_get_missing_blobs_needs_a_valid_reply(post_mock, reply):
+    post_mock.side_effect = [reply]
+    assert get_missing_blobs("10.0.0.1:25000", "token1", ["sha256:aaa", "sha256:bbb"]) is None
+
+
+@patch("distributed_op.get_missing_blobs", return_value={"sha256:bbb", "sha256:ddd"})
+def test_plan_image_push_streams_the_original_when_all_layers_are_missing(
+    get_missing_blobs_mock, tmp_path
+):
+    image = str(tmp_path / "image.tar")
+    make_oci_archive(image)
+    with contextlib.ExitStack() as stack:
+        assert plan_image_push(image, ENDPOINTS, stack) == [(image, ENDPOINTS)]
+
+
+def test_build_relay_tree():
+    endpoints = [("10.0.0.{}:25000".format(i), "t") for i in range(7)]
+    tree = build_relay_tree(endpoints, 2)
+    assert [n["endpoint"] for n in tree] == ["10.0.0.0:25000", "10.0.0.1:25000"]
+    assert [n["endpoint"] for n in tree[0]["children"]] == ["10.0.0.2:25000", "10.0.0.3:25000"]
+    assert [n["endpoint"] for n in tree[1]["children"]] == ["10.0.0.4:25000", "10.0.0.5:25000"]
+    assert [n["endpoint"] for n in tree[0]["children"][0]["children"]] == ["10.0.0.6:25000"]
+    assert relay_tree_endpoints(tree) == [endpoints[i] for i in [0, 2, 6, 3, 1, 4, 5]]
+
+    chain = build_relay_tree(endpoints[:3], 1)
+    assert chain[0]["children"][0]["children"][0]["endpoint"] == "10.0.0.2:25000"
+
+    # the local node pushes to three roots, the others relay to two nodes each
+    tree = build_relay_tree(endpoints, 2, 3)
+    assert [n["endpoint"] for n in tree] == ["10.0.0.0:25000", "10.0.0.1:25000", "10.0.0.2:25000"]
+    assert [n["endpoint"] for n in tree[0]["children"]] == ["10.0.0.3:25000", "10.0.0.4:25000"]
+    assert [n["endpoint"] for n in tree[1]["children"]] == ["10.0.0.5:25000", "10.0.0.6:25000"]
+    assert tree[2]["children"] == []
+
+
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_relays(get_endpoints_mock, post_mock):
+    received = []
+
+    def post(url, data, headers, **kwargs):
+        received.append((url, b"".join(data)))
+        if url.endswith("/image/relay"):
+            # the tokens of the other nodes are not handed out
+            assert json.loads(headers["x-microk8s-relay"]) == [
+                {
+                    "endpoint": "10.0.0.2:25000",
+                    "children": [{"endpoint": "10.0.0.3:25000", "children": []}],
+                }
+            ]
+            report = {"endpoint": "10.0.0.2:25000", "error": None, "size": 5, "seconds": 1}
+            return Mock(status_code=200, json=Mock(return_value={"nodes": [report, report]}))
+        return Mock(status_code=200)
+
+    post_mock.side_effect = post
+    results = do_image_import(io.BytesIO(b"image"), parallel=1, relay_fanout=1)
+    assert received == [("https://10.0.0.1:25000/cluster/api/v2.0/image/relay", b"image")]
+    assert [(ep, error) for ep, (error, _, _) in results] == [
+        ("10.0.0.1:25000", None),
+        ("10.0.0.2:25000", None),
+        ("10.0.0.3:25000", "no relay report from 10.0.0.1:25000"),
+    ]
+
+
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_relay_falls_back_to_direct_push(get_endpoints_mock, post_mock):
+    received = []
+
+    def post(url, data, **kwargs):
+        received.append((url, b"".join(data)))
+        return Mock(status_code=404 if url.endswith("/image/relay") else 200)
+
+    post_mock.side_effect = post
+    results = do_image_import(io.BytesIO(b"image"), relay_fanout=2)
+    assert sorted(url for url, _ in received if url.endswith("/image/import")) == [
+        "https://{}/cluster/api/v2.0/image/import".format(ep) for ep, _ in ENDPOINTS
+    ]
+    assert all(error is None for _, (error, _, _) in results)
+
+
+@pytest.mark.parametrize("relay_status", [200, None])
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints", return_value=ENDPOINTS)
+def test_do_image_import_relay_without_report(get_endpoints_mock, post_mock, relay_status):
+    received = []
+
+    def post(url, data, **kwargs):
+        received.append(url.split("/")[2] + " " + url.rsplit("/", 1)[1])
+        b"".join(data)  # drain the image stream
+        if url.endswith("/image/relay") and relay_status is None:
+            raise requests.exceptions.ConnectionError("Connection reset by peer")
+        return Mock(status_code=200, json=Mock(side_effect=ValueError("no report")))
+
+    post_mock.side_effect = post
+    results = do_image_import(io.BytesIO(b"image"), parallel=1, relay_fanout=2)
+    # the root is pushed to directly only if it failed, its subtree always is
+    expected = ["10.0.0.1:25000 relay", "10.0.0.2:25000 import", "10.0.0.3:25000 import"]
+    if relay_status is None:
+        expected.insert(1, "10.0.0.1:25000 import")
+    assert received == expected
+    assert [ep for ep, _ in results] == [ep for ep, _ in ENDPOINTS]
+    assert all(error is None for _, (error, _, _) in results)
+
+
+@patch("common.agent_client.requests.Session.post")
+@patch("distributed_op.get_cluster_agent_endpoints")
+def test_do_image_import_imports_locally(get_endpoints_mock, post_mock, tmp_path):
+    ctr = tmp_path / "ctr"
+    ctr.write_text('#!/bin/sh\ncat > "{}"\n'.format(tmp_path / "imported"))
+    ctr.chmod(0o755)
+    get_endpoints_mock.return_value = [("127.0.0.1:25000", "token")] + ENDPOINTS[:1]
+    post_mock.return_value = Mock(status_code=200)
+
+    with patch("distributed_op.CTR", str(ctr)):
+        results = do_image_import(io.BytesIO(b"image"))
+    assert (tmp_path / "imported").read_bytes() == b"image"
+    assert [call.args[0] for call in post_mock.call_args_list] == [
+        "https://10.0.0.1:25000/cluster/api/v2.0/image/import"
+    ]
+    assert all(error is None for _, (error, _, _) in results)
+
+
+@patch("distributed_op.do_configure_op")
+def test_configure_batch_restarts_services_once(do_configure_op_mock):
+    changes = [
+        "update_argument kube-apiserver --foo bar",
+        "remove_argument kube-apiserver --baz",
+        "update_argument kube-apiserver --event-ttl '2h 0m'",
+        "",
+        "set_addon dns enable",
+    ]
+    restarts = ["restart apiserver", "restart apiserver"]
+    # restarts come after the argument and addon changes, whatever the order of the lines
+    for lines in (changes + restarts, restarts + changes, changes[:1] + restarts + changes[1:]):
+        do_configure_op_mock.reset_mock()
+        configure_batch(lines)
+        remote_op = do_configure_op_mock.call_args.args[0]
+        assert list(remote_op) == ["action_str", "addon", "service"]
+        assert remote_op["service"] == [
+            {
+                "name": "kube-apiserver",
+                "arguments_update": [{"--foo": "bar"}, {"--event-ttl": "2h 0m"}],
+                "arguments_remove": ["--baz"],
+            },
+            {"name": "apiserver", "restart": "yes"},
+        ]
+        assert remote_op["addon"] == [{"name": "dns", "enable": "true"}]
+        do_configure_op_mock.assert_called_once()
+
+    with pytest.raises(ValueError):
+        configure_batch(["restart"])
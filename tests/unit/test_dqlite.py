@@ -0,0 +1,176 @@
+import socket
+import struct
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from common.dqlite import (
+    REQUEST_CLUSTER,
+    REQUEST_EXEC_SQL,
+    REQUEST_LEADER,
+    REQUEST_OPEN,
+    REQUEST_QUERY_SQL,
+    RESPONSE_DB,
+    RESPONSE_FAILURE,
+    RESPONSE_NODE,
+    RESPONSE_NODES,
+    RESPONSE_RESULT,
+    RESPONSE_ROWS,
+    ROWS_DONE,
+    ROWS_PART,
+    DqliteClient,
+    DqliteError,
+    encode_message,
+    encode_params,
+    read_message,
+)
+
+MEMBERS = [
+    {"ID": 3297041220608546238, "Address": "10.0.0.1:19001", "Role": 0},
+    {"ID": 12, "Address": "[fd00::2]:19001", "Role": 2},
+]
+
+
+def text(value):
+    data = value.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 8)
+
+
+def node_response(node_id, address):
+    return encode_message(RESPONSE_NODE, struct.pack("<Q", node_id) + text(address))
+
+
+def nodes_response(members):
+    body = struct.pack("<Q", len(members))
+    for m in members:
+        body += struct.pack("<Q", m["ID"]) + text(m["Address"]) + struct.pack("<Q", m["Role"])
+    return encode_message(RESPONSE_NODES, body)
+
+
+def failure_response(message):
+    return encode_message(RESPONSE_FAILURE, struct.pack("<Q", 1) + text(message))
+
+
+def serve(responses):
+    """
+    Answer the leader and cluster requests of a client over a socket pair
+    """
+    client, server = socket.socketpair()
+
+    def run():
+        with server:
+            assert read_message(server) == (REQUEST_LEADER, struct.pack("<Q", 0))
+            assert read_message(server) == (REQUEST_CLUSTER, struct.pack("<Q", 1))
+            server.sendall(b"".join(responses))
+
+    threading.Thread(target=run, daemon=True).start()
+    return client
+
+
+def test_query():
+    sock = serve([node_response(1, "10.0.0.1:19001"), nodes_response(MEMBERS)])
+    with sock:
+        assert DqliteClient().query(sock) == ("10.0.0.1:19001", MEMBERS)
+
+
+def test_query_failure():
+    sock = serve([failure_response("not leader"), failure_response("not leader")])
+    with sock, pytest.raises(DqliteError, match="not leader"):
+        DqliteClient().query(sock)
+
+
+def test_cluster_asks_the_leader(tmp_path):
+    (tmp_path / "info.yaml").write_text("Address: 10.0.0.2:19001\nID: 2\nRole: 0\n")
+    (tmp_path / "cluster.yaml").write_text("- Address: 10.0.0.1:19001\n  ID: 1\n  Role: 0\n")
+    socks = {
+        "10.0.0.2:19001": serve([node_response(1, "10.0.0.1:19001"), failure_response("no")]),
+        "10.0.0.1:19001": serve([node_response(1, "10.0.0.1:19001"), nodes_response(MEMBERS)]),
+    }
+    client = DqliteClient(cluster_dir=tmp_path)
+    assert client.addresses() == ["10.0.0.2:19001", "10.0.0.1:19001"]
+    with patch.object(client, "connect", side_effect=lambda address: socks[address]):
+        assert client.cluster() == ("10.0.0.1:19001", MEMBERS)
+
+
+def test_cluster_unreachable(tmp_path):
+    (tmp_path / "info.yaml").write_text("Address: 10.0.0.2:19001\n")
+    client = DqliteClient(cluster_dir=tmp_path)
+    with patch.object(client, "connect", side_effect=ConnectionRefusedError()):
+        with pytest.raises(DqliteError, match="10.0.0.2:19001"):
+            client.cluster()
+
+
+def rows_response(rows, marker=ROWS_DONE, columns=("id", "value")):
+    body = struct.pack("<Q", len(columns)) + b"".join(text(c) for c in columns)
+    for row in rows:
+        # an integer and a blob column
+        body += bytes([0x41]) + b"\0" * 7 + struct.pack("<q", row[0])
+        body += struct.pack("<Q", len(row[1])) + row[1] + b"\0" * (-len(row[1]) % 8)
+    return encode_message(RESPONSE_ROWS, body + struct.pack("<Q", marker))
+
+
+def serve_requests(expected, responses):
+    client, server = socket.socketpair()
+
+    def run():
+        with server:
+            for request, response in zip(expected, responses):
+                assert read_message(server)[0] == request
+                server.sendall(response)
+
+    threading.Thread(target=run, daemon=True).start()
+    return client
+
+
+def test_encode_params():
+    assert encode_params(()) == b"\0" * 8
+    assert encode_params((7, "ab", b"xyz", None)) == (
+        bytes([4, 1, 3, 4, 5, 0, 0, 0])
+        + struct.pack("<q", 7)
+        + b"ab\0"
+        + b"\0" * 5
+        + struct.pack("<Q", 3)
+        + b"xyz"
+        + b"\0" * 5
+        + struct.pack("<Q", 0)
+    )
+
+
+def test_open_database():
+    client, server = socket.socketpair()
+
+    def run():
+        with server:
+            # the name, no flags and the default VFS
+            request = (REQUEST_OPEN, text("microk8s-bench") + struct.pack("<Q", 0) + text(""))
+            assert read_message(server) == request
+            server.sendall(encode_message(RESPONSE_DB, struct.pack("<II", 7, 0)))
+
+    threading.Thread(target=run, daemon=True).start()
+    with client:
+        assert DqliteClient().open_database(client, "microk8s-bench") == 7
+
+
+def test_exec_sql():
+    result = encode_message(RESPONSE_RESULT, struct.pack("<QQ", 5, 1))
+    with serve_requests([REQUEST_EXEC_SQL], [result]) as sock:
+        assert DqliteClient().exec_sql(sock, 0, "INSERT INTO t VALUES (?)", (1,)) == (5, 1)
+
+
+def test_query_sql_reads_all_parts():
+    responses = [
+        rows_response([(1, b"a" * 9)], marker=ROWS_PART) + rows_response([(2, b""), (3, b"ccc")])
+    ]
+    with serve_requests([REQUEST_QUERY_SQL], responses) as sock:
+        assert DqliteClient().query_sql(sock, 0, "SELECT id, value FROM t") == [
+            (1, b"a" * 9),
+            (2, b""),
+            (3, b"ccc"),
+        ]
+
+
+def test_query_sql_failure():
+    with serve_requests([REQUEST_QUERY_SQL], [failure_response("no such table: t")]) as sock:
+        with pytest.raises(DqliteError, match="no such table"):
+            DqliteClient().query_sql(sock, 0, "SELECT id FROM t")
@@ -1,6 +1,12 @@
+import threading
+import time
+
+import pytest
 from click.testing import CliRunner
 from enable import enable as command
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+
+from common.utils import addon_dependency_graph, run_addon_hooks_parallel
 
 
 def test_command_help_arguments():
@@ -25,3 +31,128 @@ def test_command_shows_addon_help_message(xable_mock):
         result = runner.invoke(command, ["dns", "--", help_flag])
         assert result.output.startswith("Addon dns does not yet have a help message.")
         xable_mock.assert_not_called()
+
+
+@patch("enable.wait_for_ready")
+@patch("enable.ensure_started")
+@patch("enable.exit_if_no_permission")
+@patch("enable.is_cluster_locked")
+@patch("enable.xable")
+def test_command_parallel(xable_mock, *mocks):
+    runner = CliRunner()
+    result = runner.invoke(command, ["--parallel", "dns", "ingress"])
+    assert result.exit_code == 0
+    xable_mock.assert_called_once_with("enable", ("dns", "ingress"), True)
+
+
+AVAILABLE_ADDONS = [
+    {"repository": "core", "name": "dns", "requires": []},
+    {"repository": "core", "name": "ingress", "requires": ["dns"]},
+    {"repository": "core", "name": "observability", "requires": ["core/dns", "hostpath-storage"]},
+    {"repository": "core", "name": "hostpath-storage", "requires": []},
+    {"repository": "core", "name": "registry"},
+]
+ENABLED_ADDONS = [("core", "hostpath-storage")]
+BATCH = [
+    ("core", "dns", []),
+    ("core", "ingress", []),
+    ("core", "observability", []),
+]
+
+
+def test_addon_dependency_graph():
+    graph = addon_dependency_graph("enable", BATCH, AVAILABLE_ADDONS, ENABLED_ADDONS)
+    assert graph == {
+        ("core", "dns"): set(),
+        ("core", "ingress"): {("core", "dns")},
+        # hostpath-storage is not in the batch but already enabled
+        ("core", "observability"): {("core", "dns")},
+    }
+
+    graph = addon_dependency_graph("disable", BATCH, AVAILABLE_ADDONS)
+    assert graph == {
+        ("core", "dns"): {("core", "ingress"), ("core", "observability")},
+        ("core", "ingress"): set(),
+        ("core", "observability"): set(),
+    }
+
+
+def test_addon_dependency_graph_runs_undeclared_alone():
+    batch = [("core", "registry", []), ("core", "dns", []), ("core", "ingress", [])]
+    graph = addon_dependency_graph("enable", batch, AVAILABLE_ADDONS)
+    # registry does not declare its requirements, its hook may enable anything
+    assert graph == {
+        ("core", "registry"): set(),
+        ("core", "dns"): {("core", "registry")},
+        ("core", "ingress"): {("core", "dns"), ("core", "registry")},
+    }
+
+    # the hook of observability enables hostpath-storage itself
+    graph = addon_dependency_graph("enable", BATCH, AVAILABLE_ADDONS)
+    assert graph[("core", "observability")] == {("core", "dns"), ("core", "ingress")}
+
+
+def test_addon_dependency_graph_cycle():
+    available = [
+        {"repository": "core", "name": "a", "requires": ["b"]},
+        {"repository": "core", "name": "b", "requires": ["a"]},
+    ]
+    with pytest.raises(SystemExit):
+        addon_dependency_graph("enable", [("core", "a", []), ("core", "b", [])], available)
+
+
+def test_run_addon_hooks_parallel():
+    lock = threading.Lock()
+    started = []
+    concurrent = {"now": 0, "max": 0}
+
+    def run_hook(action, repo_name, addon_name, args, capture):
+        with lock:
+            started.append(addon_name)
+            concurrent["now"] += 1
+            concurrent["max"] = max(concurrent["max"], concurrent["now"])
+        time.sleep(0.05)
+        with lock:
+            concurrent["now"] -= 1
+        return Mock(returncode=0, stdout=b"")
+
+    batch = BATCH + [("core", "hostpath-storage", [])]
+    graph = addon_dependency_graph("enable", batch, AVAILABLE_ADDONS, ENABLED_ADDONS)
+    with patch("common.utils.run_addon_hook", side_effect=run_hook):
+        assert run_addon_hooks_parallel("enable", batch, graph, 4) == 0
+
+    assert started.index("dns") < started.index("ingress")
+    assert started.index("hostpath-storage") < started.index("observability")
+    assert concurrent["max"] > 1
+
+
+def test_run_addon_hooks_parallel_stops_on_failure():
+    def run_hook(action, repo_name, addon_name, args, capture):
+        return Mock(returncode=3 if addon_name == "dns" else 0, stdout=b"")
+
+    graph = addon_dependency_graph("enable", BATCH, AVAILABLE_ADDONS, ENABLED_ADDONS)
+    with patch("common.utils.run_addon_hook", side_effect=run_hook) as run_hook_mock:
+        assert run_addon_hooks_parallel("enable", BATCH, graph, 4) == 3
+
+    # nothing that requires dns was started
+    assert [c.args[2] for c in run_hook_mock.call_args_list] == ["dns"]
+
+
+def test_run_addon_hooks_parallel_attaches_lone_hooks(capsys):
+    def run_hook(action, repo_name, addon_name, args, capture):
+        return Mock(returncode=0, stdout=b"output\n" if capture else None)
+
+    batch = [("core", "registry", []), ("core", "dns", []), ("core", "hostpath-storage", [])]
+    graph = addon_dependency_graph("enable", batch, AVAILABLE_ADDONS)
+    with patch("common.utils.run_addon_hook", side_effect=run_hook) as run_hook_mock:
+        assert run_addon_hooks_parallel("enable", batch, graph, 4) == 0
+
+    # registry runs on its own and may prompt, the others run together
+    assert [(c.args[2], c.args[4]) for c in run_hook_mock.call_args_list] == [
+        ("registry", False),
+        ("dns", True),
+        ("hostpath-storage", True),
+    ]
+    out = capsys.readouterr().out
+    assert "----- enable core/registry -----" not in out
+    assert "----- enable core/dns -----\noutput\n" in out
@@ -0,0 +1,75 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from common.image_bundle import open_blob, read_bundle_index, write_bundle, write_oci_archive
+
+
+def blob(data):
+    return "blobs/sha256/{}".format(hashlib.sha256(data).hexdigest()), data
+
+
+def write_archive(path, members):
+    with tarfile.open(path, "w") as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def read_archive(path):
+    with tarfile.open(path) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar if m.isfile()}
+
+
+BASE_LAYER = blob(b"base layer " * 1000)
+APP_LAYER = blob(os.urandom(4096))
+INDEX = ("index.json", json.dumps({"manifests": []}).encode())
+
+
+def test_bundle_roundtrip(tmp_path):
+    members = [INDEX, BASE_LAYER, APP_LAYER, BASE_LAYER]
+    write_archive(tmp_path / "images.tar", members)
+    with open(tmp_path / "images.bundle", "wb") as fout:
+        index = write_bundle(tmp_path / "images.tar", fout)
+
+    assert read_bundle_index(tmp_path / "images.bundle") == index
+    assert index["base"] is None
+    assert len(index["blobs"]) == 2
+    base_entry = index["blobs"]["sha256:" + BASE_LAYER[0].rsplit("/", 1)[1]]
+    assert base_entry["compression"] == "gzip"
+    assert base_entry["size"] < base_entry["length"]
+    # random data does not compress and is stored as is
+    assert index["blobs"]["sha256:" + APP_LAYER[0].rsplit("/", 1)[1]]["compression"] == "none"
+
+    with open(tmp_path / "images.bundle", "rb") as fin:
+        assert open_blob(fin, index, "sha256:" + APP_LAYER[0].rsplit("/", 1)[1]).read() == (
+            APP_LAYER[1]
+        )
+
+    with open(tmp_path / "out.tar", "wb") as fout:
+        write_oci_archive(tmp_path / "images.bundle", index, fout)
+    assert read_archive(tmp_path / "out.tar") == dict(members)
+
+
+def test_delta_bundle(tmp_path):
+    write_archive(tmp_path / "v1.tar", [INDEX, BASE_LAYER])
+    with open(tmp_path / "v1.bundle", "wb") as fout:
+        base = write_bundle(tmp_path / "v1.tar", fout)
+
+    write_archive(tmp_path / "v2.tar", [INDEX, BASE_LAYER, APP_LAYER])
+    with open(tmp_path / "v2.bundle", "wb") as fout:
+        delta = write_bundle(tmp_path / "v2.tar", fout, base)
+
+    assert delta["base"] == base["id"]
+    assert list(delta["blobs"]) == ["sha256:" + APP_LAYER[0].rsplit("/", 1)[1]]
+    with open(tmp_path / "out.tar", "wb") as fout:
+        write_oci_archive(tmp_path / "v2.bundle", delta, fout)
+    assert read_archive(tmp_path / "out.tar") == dict([INDEX, APP_LAYER])
+
+
+def test_read_bundle_index_of_plain_archive(tmp_path):
+    write_archive(tmp_path / "images.tar", [INDEX, BASE_LAYER])
+    assert read_bundle_index(tmp_path / "images.tar") is None
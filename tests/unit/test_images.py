@@ -0,0 +1,42 @@
+import subprocess
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from images import CTR, export_images, get_incomplete_ctr_images
+
+CHECK_OUTPUT = b"""REF TYPE DIGEST STATUS SIZE UNPACKED
+docker.io/library/nginx:latest application/vnd.oci.image.index.v1+json sha256:aa complete (7/7) 67.3 MiB/67.3 MiB true
+docker.io/library/redis:7 application/vnd.oci.image.index.v1+json sha256:bb incomplete (2/8) 4.1 MiB/45.2 MiB false
+"""
+
+
+@patch("images.subprocess.check_output", return_value=CHECK_OUTPUT)
+def test_get_incomplete_ctr_images(check_output_mock):
+    images = [
+        "docker.io/library/nginx:latest",
+        "docker.io/library/redis:7",
+        "docker.io/library/x:1",
+    ]
+    assert get_incomplete_ctr_images(images) == images[1:]
+    check_output_mock.assert_called_once_with([CTR, "image", "check"])
+
+
+@patch("images.subprocess.check_call")
+@patch("images.subprocess.check_output", return_value=CHECK_OUTPUT)
+def test_export_images_fetches_incomplete_images_once(check_output_mock, check_call_mock):
+    images = ["docker.io/library/nginx:latest", "docker.io/library/redis:7"]
+    result = CliRunner().invoke(export_images, ["out.tar", *images])
+    assert result.exit_code == 0
+    assert [call.args[0] for call in check_call_mock.call_args_list] == [
+        [CTR, "content", "fetch", "--all-platforms", "docker.io/library/redis:7"],
+        [CTR, "image", "export", "out.tar", *images],
+    ]
+
+
+@patch("images.subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "ctr"))
+@patch("images.subprocess.check_output", return_value=CHECK_OUTPUT)
+def test_export_images_fails_on_fetch_errors(check_output_mock, check_call_mock):
+    result = CliRunner().invoke(export_images, ["out.tar", "docker.io/library/redis:7"])
+    assert result.exit_code != 0
+    assert check_call_mock.call_count == 1
@@ -0,0 +1,78 @@
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+
+from common import inventory
+
+
+@pytest.fixture(autouse=True)
+def inventory_file(tmp_path):
+    path = tmp_path / "cache" / "cluster-inventory.json"
+    with patch("common.inventory.inventory_file", return_value=path):
+        yield path
+
+
+NODES = [
+    {
+        "metadata": {
+            "name": "node1",
+            "labels": {"node.kubernetes.io/microk8s-controlplane": "microk8s-controlplane"},
+        },
+        "status": {"addresses": [{"type": "InternalIP", "address": "10.0.0.1"}]},
+    },
+    {
+        "metadata": {"name": "node2", "labels": {"node.kubernetes.io/microk8s-worker": "w"}},
+        "status": {"addresses": [{"type": "InternalIP", "address": "10.0.0.2"}]},
+    },
+]
+
+
+@patch("common.inventory.get_kube_client")
+def test_get_nodes_is_shared(client_mock, inventory_file):
+    client_mock.return_value.list.return_value = NODES
+    expected = [
+        {
+            "name": "node1",
+            "ip": "10.0.0.1",
+            "control_plane": True,
+            "agent_endpoint": "10.0.0.1:25000",
+        },
+        {
+            "name": "node2",
+            "ip": "10.0.0.2",
+            "control_plane": False,
+            "agent_endpoint": "10.0.0.2:25000",
+        },
+    ]
+    assert inventory.get_nodes() == expected
+    assert inventory.get_nodes() == expected
+    client_mock.return_value.list.assert_called_once_with("nodes")
+    assert json.loads(inventory_file.read_text())["nodes"]["items"] == expected
+
+    inventory.invalidate_inventory()
+    assert inventory.get_nodes() == expected
+    assert client_mock.return_value.list.call_count == 2
+
+    # a refresh skips the stored nodes and stores the new list
+    assert inventory.get_nodes(refresh=True) == expected
+    assert client_mock.return_value.list.call_count == 3
+    assert inventory.get_nodes() == expected
+    assert client_mock.return_value.list.call_count == 3
+    assert sorted(p.name for p in inventory_file.parent.iterdir()) == [inventory_file.name]
+
+
+@patch("common.inventory.fetch_dqlite_members")
+@patch("common.inventory.get_kube_client")
+def test_inventory_sections_expire(client_mock, fetch_dqlite_mock, inventory_file):
+    client_mock.return_value.list.return_value = NODES
+    fetch_dqlite_mock.return_value = [{"address": "10.0.0.1:19001", "role": 0}]
+    inventory.get_nodes()
+    assert inventory.get_dqlite_members() == fetch_dqlite_mock.return_value
+
+    with patch("common.inventory.time.time", return_value=time.time() + inventory.INVENTORY_TTL):
+        inventory.get_nodes()
+    assert client_mock.return_value.list.call_count == 2
+    assert inventory.get_dqlite_members() == fetch_dqlite_mock.return_value
+    fetch_dqlite_mock.assert_called_once_with()
@@ -0,0 +1,99 @@
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from common.kubeclient import KubeApiError, KubeClient, resource_path
+
+KUBECONFIG = """
+apiVersion: v1
+clusters:
+- cluster:
+    certificate-authority-data: Q0FEQVRB
+    server: https://127.0.0.1:16443
+  name: microk8s-cluster
+contexts:
+- context:
+    cluster: microk8s-cluster
+    user: admin
+  name: microk8s
+current-context: microk8s
+kind: Config
+preferences: {}
+users:
+- name: admin
+  user:
+    token: secret
+"""
+
+
+@pytest.mark.parametrize(
+    "args, path",
+    [
+        (("nodes",), "api/v1/nodes"),
+        (("nodes", None, "node-1"), "api/v1/nodes/node-1"),
+        (("pods", "kube-system"), "api/v1/namespaces/kube-system/pods"),
+        (("deployments", "default", "web"), "apis/apps/v1/namespaces/default/deployments/web"),
+        (("storageclasses",), "apis/storage.k8s.io/v1/storageclasses"),
+    ],
+)
+def test_resource_path(args, path):
+    assert resource_path(*args) == path
+
+
+def test_resource_path_unknown_resource():
+    with pytest.raises(ValueError):
+        resource_path("widgets")
+
+
+def test_from_kubeconfig(tmp_path):
+    kubeconfig = tmp_path / "client.config"
+    kubeconfig.write_text(KUBECONFIG)
+
+    client = KubeClient.from_kubeconfig(kubeconfig)
+    assert client.server == "https://127.0.0.1:16443"
+    assert client.session.headers["Authorization"] == "Bearer secret"
+    with open(client.session.verify) as f:
+        assert f.read() == "CADATA"
+
+
+def test_from_kubeconfig_missing(tmp_path):
+    with pytest.raises(KubeApiError):
+        KubeClient.from_kubeconfig(tmp_path / "missing.config")
+
+
+def test_request_errors():
+    client = KubeClient("https://127.0.0.1:16443")
+    client.session.request = Mock(
+        return_value=Mock(status_code=404, reason="Not Found", json=lambda: {"message": "gone"})
+    )
+    with pytest.raises(KubeApiError) as err:
+        client.get("nodes", "node-1")
+    assert err.value.status_code == 404
+    assert str(err.value) == "gone"
+
+    # missing objects are fine when deleting with missing_ok
+    client.delete("nodes", "node-1", missing_ok=True)
+
+    client.session.request = Mock(side_effect=requests.exceptions.ConnectionError("refused"))
+    with pytest.raises(KubeApiError) as err:
+        client.list("nodes")
+    assert err.value.status_code is None
+
+
+def test_watch():
+    client = KubeClient("https://127.0.0.1:16443")
+    response = Mock(status_code=200)
+    response.__enter__ = Mock(return_value=response)
+    response.__exit__ = Mock(return_value=False)
+    response.iter_lines.return_value = [
+        b'{"type": "ADDED", "object": {"metadata": {"name": "node-1"}}}',
+        b"",
+        b'{"type": "DELETED", "object": {"metadata": {"name": "node-1"}}}',
+    ]
+    with patch.object(client.session, "request", return_value=response) as request_mock:
+        events = [(t, o["metadata"]["name"]) for t, o in client.watch("nodes", timeout=10)]
+
+    assert events == [("ADDED", "node-1"), ("DELETED", "node-1")]
+    assert request_mock.call_args.kwargs["params"]["watch"] == "true"
+    assert request_mock.call_args.kwargs["params"]["timeoutSeconds"] == 10
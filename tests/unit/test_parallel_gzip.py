@@ -0,0 +1,26 @@
+import gzip
+import hashlib
+import io
+import os
+
+from common.parallel_gzip import ParallelGzipWriter
+
+
+def test_round_trip_in_order():
+    data = os.urandom(1000) * 300
+    out = io.BytesIO()
+    with ParallelGzipWriter(out, threads=3, chunk_size=4096) as gz:
+        for i in range(0, len(data), 1500):
+            gz.write(data[i : i + 1500])
+
+    compressed = out.getvalue()
+    assert gzip.decompress(compressed) == data
+    assert gz.size == len(compressed)
+    assert gz.hexdigest() == hashlib.sha256(compressed).hexdigest()
+
+
+def test_empty_stream_is_valid_gzip():
+    out = io.BytesIO()
+    with ParallelGzipWriter(out):
+        pass
+    assert gzip.decompress(out.getvalue()) == b""
@@ -0,0 +1,106 @@
+import queue
+from unittest.mock import Mock, patch
+
+import pytest
+
+from common.kubeclient import KubeApiError
+from common.utils import is_cluster_ready, is_node_ready, wait_for_ready
+from status import watch_resource
+
+
+def node(name, ready):
+    return {
+        "metadata": {"name": name},
+        "status": {"conditions": [{"type": "Ready", "status": "True" if ready else "False"}]},
+    }
+
+
+def test_is_node_ready():
+    assert is_node_ready(node("n1", True))
+    assert not is_node_ready(node("n1", False))
+    assert not is_node_ready({"status": {}})
+
+
+@patch("common.utils.get_node_name", return_value="n1")
+@patch("common.utils.get_kube_client")
+def test_is_cluster_ready(get_kube_client_mock, get_node_name_mock):
+    client = get_kube_client_mock.return_value
+    client.get.return_value = node("n1", True)
+    assert is_cluster_ready()
+    client.request.assert_called_once()
+    assert client.request.call_args.args == ("GET", "readyz")
+    client.get.assert_called_once_with("nodes", "n1")
+    client.list.assert_not_called()
+
+    client.get.return_value = node("n1", False)
+    assert not is_cluster_ready()
+    assert is_cluster_ready(with_ready_node=False)
+
+
+@patch("common.utils.get_node_name", return_value="n1")
+@patch("common.utils.get_kube_client")
+def test_is_cluster_ready_apiserver_not_ready(get_kube_client_mock, get_node_name_mock):
+    client = get_kube_client_mock.return_value
+    client.request = Mock(side_effect=KubeApiError("not ready", status_code=500))
+    assert not is_cluster_ready()
+    assert not is_cluster_ready(with_ready_node=False)
+    client.get.assert_not_called()
+
+
+@patch("common.utils.get_node_name", return_value="renamed")
+@patch("common.utils.get_kube_client")
+def test_is_cluster_ready_unknown_node_name(get_kube_client_mock, get_node_name_mock):
+    client = get_kube_client_mock.return_value
+    client.get.side_effect = KubeApiError("not found", status_code=404)
+    client.list.return_value = [node("n1", False), node("n2", True)]
+    assert is_cluster_ready()
+
+
+@patch("common.utils.time.sleep")
+@patch("common.utils.wait_for_ready_event", return_value=True)
+@patch("common.utils.is_cluster_ready", side_effect=[False, True])
+def test_wait_for_ready_on_event(is_cluster_ready_mock, wait_event_mock, sleep_mock):
+    assert wait_for_ready(timeout=30)
+    wait_event_mock.assert_called_once()
+    sleep_mock.assert_not_called()
+
+
+@patch("common.utils.time.sleep")
+@patch("common.utils.wait_for_ready_event", side_effect=KubeApiError("refused"))
+@patch("common.utils.is_cluster_ready", side_effect=[False, False, True])
+def test_wait_for_ready_falls_back_to_polling(is_cluster_ready_mock, wait_event_mock, sleep_mock):
+    assert wait_for_ready(timeout=30)
+    assert sleep_mock.call_count == 2
+    # backoff grows between attempts
+    assert sleep_mock.call_args_list[0].args[0] < sleep_mock.call_args_list[1].args[0]
+
+
+@patch("common.utils.wait_for_ready_event", return_value=False)
+@patch("common.utils.is_cluster_ready", return_value=False)
+def test_wait_for_ready_timeout(is_cluster_ready_mock, wait_event_mock):
+    assert not wait_for_ready(timeout=0.01)
+
+
+class StopWatch(Exception):
+    pass
+
+
+@patch("status.time.sleep", side_effect=StopWatch)
+@patch("status.get_kube_client")
+def test_watch_resource_triggers(get_kube_client_mock, sleep_mock):
+    get_kube_client_mock.return_value.watch.side_effect = [
+        [
+            ("ADDED", {"metadata": {"name": "coredns-abc", "resourceVersion": "1"}}),
+            ("ADDED", {"metadata": {"name": "web-abc", "resourceVersion": "2"}}),
+            ("MODIFIED", {"metadata": {"name": "coredns-abc", "resourceVersion": "3"}}),
+            ("DELETED", {"metadata": {"name": "coredns-abc", "resourceVersion": "4"}}),
+        ],
+        KubeApiError("closed"),
+    ]
+    triggers = queue.Queue()
+    with pytest.raises(StopWatch):
+        watch_resource("pods", triggers, ["coredns"])
+
+    assert triggers.qsize() == 2
+    # the watch resumes from the last seen resource version
+    assert get_kube_client_mock.return_value.watch.call_args.kwargs["resource_version"] == "4"
@@ -0,0 +1,53 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from common.trace import span, traced
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    trace_file = tmp_path / "microk8s-trace.jsonl"
+    with patch("common.trace.trace_file", return_value=trace_file):
+        yield trace_file
+
+
+def read_events(trace_file):
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f]
+
+
+@patch.dict(os.environ, {"MICROK8S_TRACE": "1"})
+def test_span(trace_file):
+    with span("hook", addon="core/dns"):
+        pass
+    with pytest.raises(ValueError):
+        with span("failing"):
+            raise ValueError()
+
+    events = read_events(trace_file)
+    assert [e["name"] for e in events] == ["hook", "failing"]
+    assert events[0]["ph"] == "X"
+    assert events[0]["args"]["addon"] == "core/dns"
+    assert events[0]["dur"] >= 0
+
+
+@patch.dict(os.environ, {"MICROK8S_TRACE": "1"})
+def test_traced(trace_file):
+    @traced("wait_for_ready")
+    def wait(timeout):
+        return timeout
+
+    assert wait(timeout=30) == 30
+    events = read_events(trace_file)
+    assert events[0]["name"] == "wait_for_ready"
+    assert events[0]["args"]["timeout"] == "30"
+
+
+@patch.dict(os.environ, {"MICROK8S_TRACE": "0"})
+def test_span_disabled(trace_file):
+    with span("hook"):
+        pass
+    assert not trace_file.exists()
@@ -0,0 +1,172 @@
+from unittest.mock import Mock, call, patch
+
+import pytest
+
+import upgrade
+
+NODES = [("10.0.0.{}:25000".format(i), "token{}".format(i)) for i in range(1, 6)]
+
+
+@pytest.fixture
+def upgrade_mocks(tmp_path):
+    with (
+        patch("upgrade.snapdata_path", str(tmp_path)),
+        patch("upgrade.get_nodes_info", return_value=NODES),
+        patch("upgrade.upgrade_master") as master_mock,
+        patch("upgrade.node_upgrade") as node_mock,
+        patch("upgrade.wait_for_healthy_nodes") as wait_mock,
+    ):
+        yield master_mock, node_mock, wait_mock
+
+
+def test_run_rolling_upgrade(upgrade_mocks, tmp_path):
+    master_mock, node_mock, wait_mock = upgrade_mocks
+    upgrade.run_rolling_upgrade("001-upgrade", 2)
+
+    assert master_mock.call_args_list == [
+        call("001-upgrade", "prepare"),
+        call("001-upgrade", "commit"),
+    ]
+    assert wait_mock.call_args_list == [
+        call([ep for ep, _ in NODES[0:2]]),
+        call([ep for ep, _ in NODES[2:4]]),
+        call([ep for ep, _ in NODES[4:5]]),
+    ]
+    phases = [(c.args[1], c.args[2]) for c in node_mock.call_args_list]
+    # every node of a wave is prepared before any of them is committed
+    assert sorted(phases[0:2]) == [("prepare", ep) for ep, _ in NODES[0:2]]
+    assert sorted(phases[2:4]) == [("commit", ep) for ep, _ in NODES[0:2]]
+    assert len(phases) == 2 * len(NODES)
+
+    journal = upgrade.read_journal("001-upgrade")
+    assert [(e["node"], e["step"], e["status"]) for e in journal[:2]] == [
+        ("master", "prepare", "started"),
+        ("master", "prepare", "done"),
+    ]
+    assert journal[-1]["node"] == "master" and journal[-1]["step"] == "commit"
+    assert len(journal) == 2 * (2 + 2 * len(NODES))
+
+
+def test_run_rolling_upgrade_stops_on_unhealthy_nodes(upgrade_mocks):
+    master_mock, node_mock, wait_mock = upgrade_mocks
+    wait_mock.side_effect = Exception("Nodes 10.0.0.1:25000 did not become healthy")
+
+    with pytest.raises(SystemExit):
+        upgrade.run_rolling_upgrade("001-upgrade", 2, keep_progress=True)
+    assert node_mock.call_count == 4
+    master_mock.assert_called_once_with("001-upgrade", "prepare")
+
+
+def test_run_upgrade_rolls_back_on_failure(upgrade_mocks):
+    master_mock, node_mock, _ = upgrade_mocks
+    node_mock.side_effect = lambda upgrade_name, phase, node_ep, token: (
+        phase == "commit" and node_ep == NODES[1][0] and 1 / 0
+    )
+    with pytest.raises(SystemExit):
+        upgrade.run_upgrade("001-upgrade")
+
+    rollbacks = [c.args[2] for c in node_mock.call_args_list if c.args[1] == "rollback"]
+    assert rollbacks == [ep for ep, _ in NODES[:2]]
+    assert call("001-upgrade", "commit") not in master_mock.call_args_list
+
+
+def test_run_upgrade_retries_and_resumes(upgrade_mocks, connect_error):
+    master_mock, node_mock, _ = upgrade_mocks
+    unreachable, failing = NODES[2][0], NODES[3][0]
+    errors = {unreachable: [connect_error()]}
+
+    def node_upgrade(upgrade_name, phase, node_ep, token):
+        if phase == "commit" and errors.get(node_ep):
+            raise errors[node_ep].pop()
+        if phase == "commit" and node_ep == failing:
+            raise Exception("node is flaky")
+
+    node_mock.side_effect = node_upgrade
+    with pytest.raises(SystemExit):
+        upgrade.run_upgrade("001-upgrade", keep_progress=True)
+    # only the step that never reached its node is retried, nothing is rolled back
+    commits = [c.args[2] for c in node_mock.call_args_list if c.args[1] == "commit"]
+    assert commits == [ep for ep, _ in NODES[:3]] + [unreachable, failing]
+    assert call("001-upgrade", "commit") not in master_mock.call_args_list
+
+    node_mock.reset_mock()
+    master_mock.reset_mock()
+    node_mock.side_effect = None
+    upgrade.run_upgrade("001-upgrade", resume=True)
+    assert [(c.args[1], c.args[2]) for c in node_mock.call_args_list] == [
+        ("commit", ep) for ep, _ in NODES[3:]
+    ]
+    master_mock.assert_called_once_with("001-upgrade", "commit")
+
+
+def test_rollback_undoes_started_commits(upgrade_mocks):
+    master_mock, node_mock, _ = upgrade_mocks
+    node_mock.side_effect = lambda upgrade_name, phase, node_ep, token: (
+        phase == "commit" and node_ep == NODES[1][0] and 1 / 0
+    )
+    with pytest.raises(SystemExit):
+        upgrade.run_upgrade("001-upgrade", keep_progress=True)
+
+    node_mock.reset_mock()
+    node_mock.side_effect = None
+    upgrade.rollback("001-upgrade")
+    assert node_mock.call_args_list == [
+        call("001-upgrade", "rollback", ep, token) for ep, token in NODES[:2]
+    ]
+    master_mock.assert_called_once_with("001-upgrade", "prepare")
+
+    # resuming after the undo upgrades the rolled back nodes again
+    node_mock.reset_mock()
+    upgrade.run_upgrade("001-upgrade", resume=True)
+    assert [(c.args[1], c.args[2]) for c in node_mock.call_args_list] == [
+        ("prepare", ep) for ep, _ in NODES[:2]
+    ] + [("commit", ep) for ep, _ in NODES]
+
+    # and they can be undone again
+    node_mock.reset_mock()
+    upgrade.rollback("001-upgrade")
+    assert [c.args[2] for c in node_mock.call_args_list] == [ep for ep, _ in NODES]
+
+
+def test_rollback_legacy_log(upgrade_mocks, tmp_path):
+    master_mock, node_mock, _ = upgrade_mocks
+    (tmp_path / "var/log/upgrades").mkdir(parents=True)
+    (tmp_path / "var/log/upgrades/001-upgrade.log").write_text(
+        "master prepare\nnode prepare {0}\nnode prepare {1}\n"
+        "node commit {0}\nnode commit {1}\nmaster commit".format(NODES[0][0], NODES[1][0])
+    )
+    upgrade.rollback("001-upgrade")
+    assert node_mock.call_args_list == [
+        call("001-upgrade", "rollback", ep, token) for ep, token in NODES[:2]
+    ]
+    master_mock.assert_called_once_with("001-upgrade", "rollback")
+
+
+def test_rollback_without_record(upgrade_mocks):
+    _, node_mock, _ = upgrade_mocks
+    with pytest.raises(Exception, match="No record of upgrade 001-upgrade"):
+        upgrade.rollback("001-upgrade")
+    node_mock.assert_not_called()
+
+
+@patch("upgrade.get_agent_session")
+@patch("upgrade.get_kube_client")
+def test_get_unhealthy_nodes(client_mock, session_mock):
+    def node(name, ip, ready):
+        return {
+            "metadata": {"name": name},
+            "status": {
+                "addresses": [{"type": "InternalIP", "address": ip}],
+                "conditions": [{"type": "Ready", "status": ready}],
+            },
+        }
+
+    client_mock.return_value.list.return_value = [
+        node("node1", "10.0.0.1", "True"),
+        node("node2", "10.0.0.2", "False"),
+        node("node3", "10.0.0.3", "True"),
+    ]
+    session_mock.return_value = Mock()
+    assert upgrade.get_unhealthy_nodes(["node1:25000", "10.0.0.2:25000", "10.0.0.3:25000"]) == [
+        "10.0.0.2:25000"
+    ]